@@ -1,30 +1,146 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import cached_property
 from operator import itemgetter
-from typing import Dict, Union
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-import langchain_community.vectorstores as vectorstores
-from langchain_core.messages import BaseMessage
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, BaseMessageChunk, AIMessage, HumanMessage, SystemMessage
 from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_core.pydantic_v1 import BaseModel, Field, validator
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableParallel, RunnableLambda, RunnableGenerator, RunnableConfig
+from langchain_core.runnables.utils import ConfigurableFieldSpec, get_unique_config_specs
+from langchain_core.vectorstores import VectorStore
 
-from utils.history import MessageHistory
+from utils.cache import SemanticCache, read_index_version
+from utils.context import ContextPacker
+from utils.embeddings import get_embeddings
+from utils.filters import parse_filters
+from utils.history import SessionHistoryStore
+from utils.lexical import BM25Index, HybridRetriever
+from utils.metrics import REGISTRY, STAGE_SECONDS
+from utils.retrieval import MMRRetriever, with_filters
+from utils.timing import StageTimer
+from utils.vectorstore import get_vector_store_class
+
+SESSION_ID_KEY = "session_id"
+DEFAULT_SESSION_ID = "default"
+STAGES = ("retrieval", "context", "history", "prompt", "model")
+
+CACHE_LOOKUPS = REGISTRY.counter(
+    "chatbot_cache_lookups_total",
+    "Lookups of the semantic answer cache.",
+    labels=("result",)
+)
+INDEX_RELOADS = REGISTRY.counter(
+    "chatbot_index_reloads_total",
+    "Reloads of the vector store after the index was updated."
+)
+
+
+class ChatInput(BaseModel):
+    """Input of the chat chain."""
+
+    role: str
+    content: str
+    filters: Optional[Dict[str, Any]] = Field(
+        None,
+        description="Metadata filters of the retrieved documents: after, before, max_age_days, source, package and "
+                    "region."
+    )
+
+    @validator("filters")
+    def check_filters(cls, filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # Reject invalid filters with the request, rather than when retrieving; a ValueError is a validation error
+        parse_filters(filters)
+        return filters
+
+
+class _SessionConfigMixin:
+    """Declares the session id as a configurable field of a runnable, so that LangServe accepts it."""
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return get_unique_config_specs([
+            *super().config_specs,
+            ConfigurableFieldSpec(
+                id=SESSION_ID_KEY,
+                annotation=str,
+                name="Session ID",
+                description="Unique identifier of the conversation.",
+                default=DEFAULT_SESSION_ID,
+                is_shared=True
+            )
+        ])
+
+
+class _SessionLambda(_SessionConfigMixin, RunnableLambda):
+    pass
+
+
+class _SessionGenerator(_SessionConfigMixin, RunnableGenerator):
+    pass
+
+
+def _get_session_id(config: Optional[RunnableConfig]) -> str:
+    return (config or {}).get("configurable", {}).get(SESSION_ID_KEY, DEFAULT_SESSION_ID)
+
+
+@contextmanager
+def _cancel_pending(futures: Iterable[Union[Future, asyncio.Future]]) -> Iterator[None]:
+    # Stop generating the remaining answers if the caller stops early or an answer failed
+    try:
+        yield
+    finally:
+        for future in futures:
+            future.cancel()
 
 
 class ChatBot:
     def __init__(self, model_name: str, embeddings_model_name: str,
                  db_type: str, db_path: str, search_type: str = "mmr",
-                 search_kwargs: Dict[str, any] = None) -> None:
-        self.model = ChatOpenAI(model=model_name)
-        self.embeddings = OpenAIEmbeddings(model=embeddings_model_name)
-        self.history = MessageHistory(history_key="history")
-        self.db = getattr(vectorstores, db_type)(
-            persist_directory=db_path,
-            embedding_function=self.embeddings
-        )
-        self.retriever = self.db.as_retriever(
-            search_type=search_type,
-            search_kwargs=search_kwargs
+                 search_kwargs: Dict[str, any] = None,
+                 max_sessions: int = 1024, session_timeout: Optional[float] = 3600.0,
+                 history_db_path: Optional[str] = None,
+                 history_token_limit: Optional[int] = None, summarize_history: bool = False,
+                 cache_threshold: Optional[float] = None, cache_size: int = 1024,
+                 cache_ttl: Optional[float] = None, hybrid: bool = False, lexical_k: int = 20,
+                 model: Optional[BaseChatModel] = None, embeddings: Optional[Embeddings] = None,
+                 time_stages: bool = False, context_token_budget: Optional[int] = 2000,
+                 shared_history: bool = False) -> None:
+        self.model_name = model_name
+        self.embeddings_model_name = embeddings_model_name
+        self.db_type = db_type
+        self.db_path = db_path
+        self.search_type = search_type
+        self.search_kwargs = search_kwargs
+        self.cache_threshold = cache_threshold
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.hybrid = hybrid
+        self.lexical_k = lexical_k
+        self.context_token_budget = context_token_budget
+        self._model = model
+        self._embeddings = embeddings
+        self.index_version = None
+        self.reload_lock = threading.Lock()
+        self.timer = StageTimer(STAGES, root_stage="chat", histogram=STAGE_SECONDS) if time_stages else None
+        self.sessions = SessionHistoryStore(
+            history_key="history",
+            max_sessions=max_sessions,
+            idle_timeout=session_timeout,
+            db_path=history_db_path,
+            write_through=shared_history,
+            token_limit=history_token_limit,
+            model_name=model_name,
+            summarizer=self._summarize if summarize_history else None
         )
         self.prompt = ChatPromptTemplate.from_messages([
             (
@@ -47,22 +163,208 @@ class ChatBot:
             )
         ])
 
-        self.main = (
-            {
-                "context": itemgetter("content") | self.retriever,
-                "role": itemgetter("role"),
-                "content": itemgetter("content")
-            }
-            | RunnablePassthrough.assign(
-                history=RunnableLambda(self.history.load_messages) | itemgetter("history")
-            )
-            | self.prompt
-            | RunnableLambda(self._add_message)  # Save user response to history
-            | self.model
-            | RunnableLambda(self._add_message)  # Save AI response to history
+    # The model, the embeddings, the vector store and the chain are only built when first used, so that creating a
+    # ChatBot is cheap and the heavy imports and the opening of the store are deferred to warm_up() or to the first
+    # request
+
+    @cached_property
+    def model(self) -> BaseChatModel:
+        if self._model is not None:
+            return self._model
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(model=self.model_name)
+
+    @cached_property
+    def embeddings(self) -> Embeddings:
+        if self._embeddings is not None:
+            return self._embeddings
+        return get_embeddings(self.embeddings_model_name, db_path=self.db_path)
+
+    @cached_property
+    def cache(self) -> Optional[SemanticCache]:
+        if self.cache_threshold is None:
+            return None
+        return SemanticCache(
+            self.embeddings,
+            threshold=self.cache_threshold,
+            max_size=self.cache_size,
+            ttl=self.cache_ttl,
+            db_path=self.db_path
         )
 
-    def _add_message(self, input: Union[BaseMessage, ChatPromptValue]) \
+    @cached_property
+    def db(self) -> VectorStore:
+        return self._open_db()
+
+    @cached_property
+    def retriever(self) -> BaseRetriever:
+        return self._build_retriever(self.db)
+
+    def _open_db(self) -> VectorStore:
+        # Read the version first, so that an index updated while the store is opened is reloaded again
+        self.index_version = read_index_version(self.db_path)
+        return get_vector_store_class(self.db_type)(
+            persist_directory=self.db_path,
+            embedding_function=self.embeddings
+        )
+
+    def _build_retriever(self, db: VectorStore) -> BaseRetriever:
+        # The metadata filters are applied on each call, together with those of the request
+        search_kwargs = {key: value for key, value in (self.search_kwargs or {}).items() if key != "filter"}
+        # Stores that do not return the embeddings of the candidates are re-ranked by LangChain instead
+        if self.search_type == "mmr" and MMRRetriever.supports(db):
+            retriever = MMRRetriever(
+                vectorstore=db,
+                embeddings=self.embeddings,
+                search_kwargs=search_kwargs
+            )
+        else:
+            retriever = db.as_retriever(
+                search_type=self.search_type,
+                search_kwargs=search_kwargs
+            )
+        if self.hybrid:
+            retriever = HybridRetriever(
+                vector_retriever=retriever,
+                lexical_index=BM25Index.load(self.db_path),
+                k=(self.search_kwargs or {}).get("k", 4),
+                lexical_k=self.lexical_k
+            )
+        return retriever
+
+    @cached_property
+    def packer(self) -> Optional[ContextPacker]:
+        # Merge overlapping chunks and fit them to a token budget, rather than passing the raw documents to the prompt
+        if self.context_token_budget is None:
+            return None
+        return ContextPacker(token_budget=self.context_token_budget, model_name=self.model_name)
+
+    @cached_property
+    def main(self) -> Runnable:
+        # The retriever and the model are resolved on each call, so the chain is built without them
+        context = RunnableLambda(self._get_retriever, afunc=self._aget_retriever).with_config(run_name="retrieval")
+        if self.context_token_budget is not None:
+            context = context | RunnableLambda(self._pack_context).with_config(run_name="context")
+
+        # Retrieval and history loading are independent, so they run concurrently before the prompt is built
+        main = (
+            RunnableParallel(
+                context=context,
+                history=(
+                    _SessionLambda(self._load_messages, afunc=self._aload_messages) | itemgetter("history")
+                ).with_config(run_name="history"),
+                role=itemgetter("role"),
+                content=itemgetter("content")
+            )
+            | self.prompt.with_config(run_name="prompt")
+            | _SessionLambda(self._add_message, afunc=self._aadd_message)  # Save user response to history
+            | RunnableLambda(self._get_model, afunc=self._aget_model).with_config(run_name="model")
+            | _SessionGenerator(self._record_stream, self._arecord_stream)  # Save AI response to history
+        ).with_config(run_name="chat").with_types(input_type=ChatInput)
+        if self.timer is not None:
+            main = main.with_config(callbacks=[self.timer])
+        return main
+
+    def _filtered_retriever(self, filters: Optional[Dict[str, Any]] = None) -> BaseRetriever:
+        # Filters of the request override the default filters of the same name
+        filters = {**(self.search_kwargs or {}).get("filter", {}), **(filters or {})}
+        return with_filters(self.retriever, filters)
+
+    def _get_retriever(self, inputs: Dict[str, Any]) -> Runnable:
+        return itemgetter("content") | self._filtered_retriever(inputs.get("filters"))
+
+    async def _aget_retriever(self, inputs: Dict[str, Any]) -> Runnable:
+        return self._get_retriever(inputs)
+
+    def _get_model(self, prompt: ChatPromptValue) -> BaseChatModel:
+        return self.model
+
+    async def _aget_model(self, prompt: ChatPromptValue) -> BaseChatModel:
+        return self.model
+
+    def _pack_context(self, docs: List[Document]) -> str:
+        return self.packer.pack(docs)
+
+    def warm_up(self) -> None:
+        """
+        Builds the components of the chatbot and loads the index into memory, so that the first request does not
+        pay for them.
+        """
+        _ = self.main, self.retriever, self.model, self.cache, self.packer
+        self._warm_up_db(self.db)
+
+    @staticmethod
+    def _warm_up_db(db: VectorStore) -> None:
+        if hasattr(db, "warm_up"):
+            db.warm_up()
+        elif hasattr(db, "_collection"):
+            # Chroma loads its HNSW index on the first query
+            peek = db._collection.peek(1)
+            if peek["embeddings"]:
+                db._collection.query(query_embeddings=peek["embeddings"][:1], n_results=1)
+
+    @staticmethod
+    def _release_shared_client(db: VectorStore) -> None:
+        # Chroma shares a single client per path, which keeps serving the index it loaded in memory, so it is
+        # forgotten for the store to be reopened on a fresh client. The collection of the previous store keeps the
+        # previous client, so that requests in flight finish on it.
+        identifier = getattr(getattr(db, "_client", None), "_identifier", None)
+        if identifier is not None:
+            from chromadb.api.client import SharedSystemClient
+            SharedSystemClient._identifer_to_system.pop(identifier, None)
+
+    def reload_index(self, force: bool = False) -> bool:
+        """
+        Reopens the vector store and rebuilds the retriever if the index version changed since the store was opened,
+        as it does after the indexer updated the index. The new store is loaded before it replaces the previous one,
+        and requests in flight finish on the previous one, so that no request waits on or fails because of the reload.
+
+        Args:
+            force (bool): Whether to reload even if the index version did not change. Defaults to False.
+
+        Returns:
+            bool: Whether the index was reloaded.
+        """
+        # A reload already in progress will pick up the latest version
+        if not self.reload_lock.acquire(blocking=False):
+            return False
+        try:
+            if "db" not in self.__dict__ or (not force and read_index_version(self.db_path) == self.index_version):
+                return False
+            self._release_shared_client(self.db)
+            db = self._open_db()
+            self._warm_up_db(db)
+            retriever = self._build_retriever(db)
+            # The chain resolves the retriever on each call, so swapping the attributes is enough
+            self.__dict__.update(db=db, retriever=retriever)
+            INDEX_RELOADS.inc()
+            return True
+        finally:
+            self.reload_lock.release()
+
+    def _summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        transcript = "\n".join(f"{message.type}: {message.content}" for message in messages)
+        return self.model.invoke([
+            SystemMessage(content="Update the running summary of a conversation with the new lines below. "
+                                  "Keep names, places, dates and figures, and answer with at most 150 words."),
+            HumanMessage(content=f"Current summary:\n{summary or '(empty)'}\n\nNew lines:\n{transcript}")
+        ]).content
+
+    def _load_messages(self, inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        return self.sessions.load_messages(_get_session_id(config))
+
+    async def _aload_messages(self, inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        if self.sessions.blocking:
+            return await asyncio.to_thread(self._load_messages, inputs, config)
+        return self._load_messages(inputs, config)
+
+    async def _aadd_message(self, input: Union[BaseMessage, ChatPromptValue], config: RunnableConfig) \
+            -> Union[BaseMessage, ChatPromptValue]:
+        if self.sessions.blocking:
+            return await asyncio.to_thread(self._add_message, input, config)
+        return self._add_message(input, config)
+
+    def _add_message(self, input: Union[BaseMessage, ChatPromptValue], config: RunnableConfig) \
             -> Union[BaseMessage, ChatPromptValue]:
         message = None
         if isinstance(input, BaseMessage):
@@ -70,12 +372,214 @@ class ChatBot:
         elif isinstance(input, ChatPromptValue):
             message = input.to_messages()[-1]
         if message:
-            self.history.add_message(message)
+            self.sessions.add_message(_get_session_id(config), message)
         return input
 
-    def get_response(self, message: str) -> str:
-        response = self.main.invoke({"role": "user", "content": message}).content
+    def _record_stream(self, chunks: Iterator[BaseMessageChunk], config: RunnableConfig) \
+            -> Iterator[BaseMessageChunk]:
+        # Pass the chunks through as they arrive, and save the whole message once the model is done
+        message = None
+        for chunk in chunks:
+            message = chunk if message is None else message + chunk
+            yield chunk
+        if message is not None:
+            self.sessions.add_message(_get_session_id(config), AIMessage(content=message.content))
+
+    async def _arecord_stream(self, chunks: AsyncIterator[BaseMessageChunk], config: RunnableConfig) \
+            -> AsyncIterator[BaseMessageChunk]:
+        message = None
+        async for chunk in chunks:
+            message = chunk if message is None else message + chunk
+            yield chunk
+        if message is not None:
+            await self._aadd_message(AIMessage(content=message.content), config)
+
+    def _has_history(self, session_id: str) -> bool:
+        return bool(self.sessions.get(session_id).get_messages())
+
+    def _lookup_cache(self, message: str, session_id: str, filters: Optional[Dict[str, Any]] = None) \
+            -> Tuple[Optional[np.ndarray], Optional[str]]:
+        # Cached answers were not retrieved with the filters of the request, and the cache is shared by all the
+        # sessions, so only the opening questions of conversations, answered without any history, are cached
+        if self.cache is None or filters or self._has_history(session_id):
+            return None, None
+        vector = self.cache.embed(message)
+        response = self.cache.lookup(vector)
+        CACHE_LOOKUPS.inc(result="miss" if response is None else "hit")
+        if response is not None:
+            # Keep the conversation consistent with what the chain would have recorded
+            self.sessions.add_message(session_id, HumanMessage(content=f"user: {message}"))
+            self.sessions.add_message(session_id, AIMessage(content=response))
+        return vector, response
+
+    async def _alookup_cache(self, message: str, session_id: str, filters: Optional[Dict[str, Any]] = None) \
+            -> Tuple[Optional[np.ndarray], Optional[str]]:
+        # Cached answers were not retrieved with the filters of the request, nor with the history of the session
+        if self.cache is None or filters:
+            return None, None
+        if self.sessions.blocking:
+            has_history = await asyncio.to_thread(self._has_history, session_id)
+        else:
+            has_history = self._has_history(session_id)
+        if has_history:
+            return None, None
+        vector = await self.cache.aembed(message)
+        response = self.cache.lookup(vector)
+        CACHE_LOOKUPS.inc(result="miss" if response is None else "hit")
+        if response is not None:
+            config = {"configurable": {SESSION_ID_KEY: session_id}}
+            await self._aadd_message(HumanMessage(content=f"user: {message}"), config)
+            await self._aadd_message(AIMessage(content=response), config)
+        return vector, response
+
+    def _batch_prompts(self, messages: List[str], role: str, filters: Optional[Dict[str, Any]]) \
+            -> List[ChatPromptValue]:
+        # Retrieve the documents of all the questions together, with a single embedding request when supported
+        retriever = self._filtered_retriever(filters)
+        if hasattr(retriever, "batch_retrieve"):
+            rankings = retriever.batch_retrieve(messages)
+        else:
+            rankings = retriever.batch(messages)
+        return [
+            self.prompt.invoke({
+                "context": self.packer.pack(docs) if self.packer is not None else docs,
+                "history": [],
+                "role": role,
+                "content": message
+            })
+            for message, docs in zip(messages, rankings)
+        ]
+
+    def batch_responses(self, messages: List[str], role: str = "user", max_concurrency: int = 8,
+                        return_exceptions: bool = False, filters: Optional[Dict[str, Any]] = None) \
+            -> Iterator[Tuple[int, Union[str, Exception]]]:
+        """
+        Answers independent questions in bulk, such as templated questions for a daily digest. The questions are
+        retrieved together, the answers are generated concurrently, and neither the conversation history nor the
+        answer cache is used.
+
+        Args:
+            messages (List[str]): The questions.
+            role (str): The role of the author of the questions. Defaults to "user".
+            max_concurrency (int): The maximum number of answers generated at once. Defaults to 8.
+            return_exceptions (bool): Whether to yield the exception of a failed answer instead of raising it.
+                Defaults to False.
+            filters (Optional[Dict[str, Any]]): The metadata filters of the retrieved documents, see parse_filters.
+                Defaults to the filters of the search arguments.
+
+        Yields:
+            Tuple[int, Union[str, Exception]]: The index of a question and its answer, as soon as it is generated.
+        """
+        if not messages:
+            return
+        prompts = self._batch_prompts(messages, role, filters)
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        futures = {executor.submit(self.model.invoke, prompt): index for index, prompt in enumerate(prompts)}
+        # The submitted answers still run, and the threads exit once they are done
+        executor.shutdown(wait=False)
+        with _cancel_pending(futures):
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result().content
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    yield futures[future], e
+
+    async def abatch_responses(self, messages: List[str], role: str = "user", max_concurrency: int = 8,
+                               return_exceptions: bool = False, filters: Optional[Dict[str, Any]] = None) \
+            -> AsyncIterator[Tuple[int, Union[str, Exception]]]:
+        """
+        Answers independent questions in bulk, asynchronously. See batch_responses.
+
+        Args:
+            messages (List[str]): The questions.
+            role (str): The role of the author of the questions. Defaults to "user".
+            max_concurrency (int): The maximum number of answers generated at once. Defaults to 8.
+            return_exceptions (bool): Whether to yield the exception of a failed answer instead of raising it.
+                Defaults to False.
+            filters (Optional[Dict[str, Any]]): The metadata filters of the retrieved documents, see parse_filters.
+                Defaults to the filters of the search arguments.
+
+        Yields:
+            Tuple[int, Union[str, Exception]]: The index of a question and its answer, as soon as it is generated.
+        """
+        if not messages:
+            return
+        prompts = await asyncio.to_thread(self._batch_prompts, messages, role, filters)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(index: int, prompt: ChatPromptValue) -> Tuple[int, Union[str, Exception]]:
+            async with semaphore:
+                try:
+                    return index, (await self.model.ainvoke(prompt)).content
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    return index, e
+
+        tasks = [asyncio.create_task(answer(index, prompt)) for index, prompt in enumerate(prompts)]
+        with _cancel_pending(tasks):
+            for task in asyncio.as_completed(tasks):
+                yield await task
+
+    def get_response(self, message: str, session_id: str = DEFAULT_SESSION_ID,
+                     filters: Optional[Dict[str, Any]] = None) -> str:
+        vector, response = self._lookup_cache(message, session_id, filters)
+        if response is not None:
+            return response
+        response = self.main.invoke(
+            {"role": "user", "content": message, "filters": filters},
+            config={"configurable": {SESSION_ID_KEY: session_id}}
+        ).content
+        if vector is not None:
+            self.cache.update(vector, response)
         return response
 
+    def stream_response(self, message: str, session_id: str = DEFAULT_SESSION_ID,
+                        filters: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        vector, response = self._lookup_cache(message, session_id, filters)
+        if response is not None:
+            yield response
+            return
+        tokens = []
+        for chunk in self.main.stream(
+                {"role": "user", "content": message, "filters": filters},
+                config={"configurable": {SESSION_ID_KEY: session_id}}
+        ):
+            tokens.append(chunk.content)
+            yield chunk.content
+        if vector is not None:
+            self.cache.update(vector, "".join(tokens))
+
+    async def aget_response(self, message: str, session_id: str = DEFAULT_SESSION_ID,
+                            filters: Optional[Dict[str, Any]] = None) -> str:
+        vector, response = await self._alookup_cache(message, session_id, filters)
+        if response is not None:
+            return response
+        response = (await self.main.ainvoke(
+            {"role": "user", "content": message, "filters": filters},
+            config={"configurable": {SESSION_ID_KEY: session_id}}
+        )).content
+        if vector is not None:
+            self.cache.update(vector, response)
+        return response
+
+    async def astream_response(self, message: str, session_id: str = DEFAULT_SESSION_ID,
+                               filters: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        vector, response = await self._alookup_cache(message, session_id, filters)
+        if response is not None:
+            yield response
+            return
+        tokens = []
+        async for chunk in self.main.astream(
+                {"role": "user", "content": message, "filters": filters},
+                config={"configurable": {SESSION_ID_KEY: session_id}}
+        ):
+            tokens.append(chunk.content)
+            yield chunk.content
+        if vector is not None:
+            self.cache.update(vector, "".join(tokens))
+
     def get_main(self):
         return self.main
@@ -1,9 +1,5 @@
-import os
-
 from chatbot import ChatBot
 
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-
 bot = ChatBot(
     model_name="gpt-3.5-turbo",
     embeddings_model_name="text-embedding-3-small",
@@ -19,5 +15,7 @@ bot = ChatBot(
 
 while True:
     message = input("You: ")
-    response = bot.get_response(message)
-    print(f"Bot: {response}")
+    print("Bot: ", end="", flush=True)
+    for token in bot.stream_response(message):
+        print(token, end="", flush=True)
+    print()
@@ -0,0 +1,347 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chatbot import ChatBot
+from scripts.chunker import chunk
+from scripts.filter import filter_content
+from scripts.indexer import update_index
+from scripts.load_test import load_test
+from utils.document import iter_documents, save_documents
+from utils.fakes import FakeChatModel, FakeEmbeddings
+from utils.retrieval import MMRRetriever
+from utils.vectorstore import get_vector_store_class
+
+SCENARIOS = ("ingestion", "index", "query", "startup", "load")
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a fresh interpreter, so that the imports are measured cold
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from chatbot import ChatBot
+from server import create_app
+from utils.fakes import FakeChatModel, FakeEmbeddings
+imported = time.perf_counter()
+bot = ChatBot(model_name="gpt-3.5-turbo", embeddings_model_name="fake", db_type={db_type!r}, db_path={db_path!r},
+              model=FakeChatModel(), embeddings=FakeEmbeddings())
+app = create_app(bot)
+created = time.perf_counter()
+bot.warm_up()
+warmed = time.perf_counter()
+bot.get_response("Quelles sont les nouvelles de Québec ?")
+answered = time.perf_counter()
+print(json.dumps({{"import": imported - start, "create": created - imported, "warm_up": warmed - created,
+                  "first_response": answered - warmed, "total": answered - start}}))
+"""
+
+CITIES = ["Montréal", "Québec", "Gatineau", "Sherbrooke", "Trois-Rivières", "Saguenay", "Lévis", "Laval",
+          "Rimouski", "Longueuil"]
+REGIONS = ["Montréal", "Capitale-Nationale", "Outaouais", "Estrie", "Mauricie", "Saguenay–Lac-Saint-Jean",
+           "Chaudière-Appalaches", "Laval", "Bas-Saint-Laurent", "Montérégie"]
+ACTORS = ["le gouvernement du Québec", "la ville", "le conseil municipal", "Hydro-Québec", "le ministère de la Santé",
+          "le ministère des Transports", "la Société de transport", "le centre de services scolaire"]
+ACTIONS = ["annonce", "investit", "prévoit", "reporte", "lance", "évalue", "approuve", "suspend"]
+TOPICS = ["la réfection du pont", "un nouveau parc", "la construction d'une école", "l'agrandissement de l'hôpital",
+          "le déneigement des rues", "un projet de logements abordables", "le prolongement du métro",
+          "la protection de la rivière", "un festival d'été", "la rénovation de la bibliothèque"]
+DETAILS = ["Les travaux doivent commencer au printemps.", "Les citoyens seront consultés cet automne.",
+           "Le budget total atteint {amount} millions de dollars.", "Le projet touche {count} ménages.",
+           "L'opposition réclame plus de transparence.", "Les délais s'expliquent par la pénurie de main-d'œuvre.",
+           "Une séance d'information aura lieu à l'hôtel de ville.", "Le chantier devrait durer {count} semaines."]
+
+
+def generate_corpus(num_docs: int = 1000, sentences_per_doc: int = 40, seed: int = 0) -> List[Document]:
+    """
+    Generates a reproducible synthetic corpus of French news articles about Quebec, with metadata similar to the
+    downloaded datasets.
+
+    Args:
+        num_docs (int): The number of articles. Defaults to 1000.
+        sentences_per_doc (int): The number of sentences of each article. Defaults to 40.
+        seed (int): The seed of the generator. Defaults to 0.
+
+    Returns:
+        List[Document]: The articles.
+    """
+    rng = random.Random(seed)
+    docs = []
+    for i in range(num_docs):
+        city_index = rng.randrange(len(CITIES))
+        city = CITIES[city_index]
+        sentences = []
+        for _ in range(sentences_per_doc):
+            sentences.append(f"À {city}, {rng.choice(ACTORS)} {rng.choice(ACTIONS)} {rng.choice(TOPICS)}.")
+            sentences.append(rng.choice(DETAILS).format(amount=rng.randint(1, 900), count=rng.randint(2, 5000)))
+        published = date(2023, 1, 1) + timedelta(days=rng.randrange(365))
+        docs.append(Document(
+            page_content=f"{city} : {rng.choice(TOPICS)}\n\n" + " ".join(sentences),
+            metadata={
+                "source": f"nouvelle-{i}",
+                "url": f"https://www.donneesquebec.ca/nouvelles/{i}",
+                "region": REGIONS[city_index],
+                "date": published.isoformat()
+            }
+        ))
+    return docs
+
+
+def generate_queries(num_queries: int = 100, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        f"Que {rng.choice(['prévoit', 'annonce', 'fait'])} {rng.choice(ACTORS)} pour {rng.choice(TOPICS)} "
+        f"à {rng.choice(CITIES)} ?"
+        for _ in range(num_queries)
+    ]
+
+
+def _percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    samples_ms = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(samples_ms.mean()),
+        "p50_ms": float(np.percentile(samples_ms, 50)),
+        "p95_ms": float(np.percentile(samples_ms, 95)),
+        "p99_ms": float(np.percentile(samples_ms, 99))
+    }
+
+
+def _timed(function: Callable) -> Tuple[float, any]:
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def bench_ingestion(docs: List[Document], work_dir: str, chunk_size: int = 500, chunk_overlap: int = 50,
+                    workers: int = 1) -> Dict[str, Dict[str, float]]:
+    """
+    Measures the throughput of each ingestion step: saving and loading documents, filtering and chunking.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The duration and throughput of each step.
+    """
+    num_bytes = sum(len(doc.page_content.encode("utf-8")) for doc in docs)
+    path = os.path.join(work_dir, "documents")
+
+    def stats(seconds: float, count: int) -> Dict[str, float]:
+        return {"seconds": seconds, "docs_per_s": count / seconds, "mb_per_s": num_bytes / seconds / 1e6}
+
+    save_seconds, _ = _timed(lambda: save_documents(path, (doc.copy(deep=True) for doc in docs)))
+    load_seconds, loaded = _timed(lambda: list(iter_documents(path)))
+    filter_seconds, filtered = _timed(lambda: list(filter_content(loaded)))
+    chunk_seconds, chunks = _timed(lambda: list(chunk(filtered, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                      workers=workers)))
+    return {
+        "save": stats(save_seconds, len(docs)),
+        "load": stats(load_seconds, len(loaded)),
+        "filter": stats(filter_seconds, len(filtered)),
+        "chunk": {**stats(chunk_seconds, len(filtered)), "chunks": len(chunks), "workers": workers}
+    }
+
+
+def bench_index(chunks: List[Document], db_path: str, db_type: str = "LocalVectorStore",
+                embedding_latency: float = 0.0, batch_size: int = 100, max_concurrency: int = None) \
+        -> Dict[str, Dict[str, float]]:
+    """
+    Measures the time to build an index from scratch, then to update it when nothing changed.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The duration and results of the build and of the update.
+    """
+    embeddings = FakeEmbeddings(latency=embedding_latency)
+
+    def run() -> Dict[str, int]:
+        return update_index(chunks, db_path=db_path, db_type=db_type, embedding_function=embeddings,
+                            batch_size=batch_size, max_concurrency=max_concurrency)
+
+    build_seconds, build_result = _timed(run)
+    update_seconds, update_result = _timed(run)
+    return {
+        "build": {"seconds": build_seconds, "docs_per_s": len(chunks) / build_seconds, **build_result},
+        "update": {"seconds": update_seconds, "docs_per_s": len(chunks) / update_seconds, **update_result},
+        "embedding_requests": embeddings.calls
+    }
+
+
+def bench_query(db_path: str, db_type: str, queries: List[str], search_params: Sequence[Tuple[int, int]]) \
+        -> Dict[str, Dict[str, float]]:
+    """
+    Measures the latency percentiles of retrieval at several k and fetch_k, and of a whole chatbot response.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The latency percentiles of each configuration.
+    """
+    embeddings = FakeEmbeddings()
+    store = get_vector_store_class(db_type)(persist_directory=db_path, embedding_function=embeddings)
+    results = {}
+    for k, fetch_k in search_params:
+        retriever = MMRRetriever(vectorstore=store, embeddings=embeddings, search_kwargs={"k": k, "fetch_k": fetch_k})
+        latencies = [_timed(lambda: retriever.invoke(query))[0] for query in queries]
+        results[f"retrieval_k{k}_fetch{fetch_k}"] = _percentiles(latencies)
+
+    bot = ChatBot(
+        model_name="gpt-3.5-turbo",
+        embeddings_model_name="fake",
+        db_type=db_type,
+        db_path=db_path,
+        search_kwargs={"k": 5, "fetch_k": 50},
+        model=FakeChatModel(),
+        embeddings=embeddings
+    )
+    latencies = [_timed(lambda: bot.get_response(query, session_id=str(i)))[0] for i, query in enumerate(queries)]
+    results["get_response"] = _percentiles(latencies)
+    return results
+
+
+def bench_startup(db_path: str, db_type: str, runs: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Measures the cold start of a server process: importing the modules, creating the chatbot and the application,
+    warming up the chatbot, and answering the first request.
+
+    Returns:
+        Dict[str, Dict[str, float]]: The latency percentiles of each step of the startup.
+    """
+    script = STARTUP_SCRIPT.format(root=ROOT_DIR, db_type=db_type, db_path=db_path)
+    samples: Dict[str, List[float]] = {}
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                env={**os.environ, "ANONYMIZED_TELEMETRY": "False"}).stdout
+        for step, seconds in json.loads(output.strip().splitlines()[-1]).items():
+            samples.setdefault(step, []).append(seconds)
+    return {step: _percentiles(seconds) for step, seconds in samples.items()}
+
+
+def run_benchmarks(scenarios: Sequence[str] = SCENARIOS, num_docs: int = 1000, num_queries: int = 100,
+                   db_type: str = "LocalVectorStore", chunk_size: int = 500, chunk_overlap: int = 50,
+                   workers: int = 1, embedding_latency: float = 0.0, max_concurrency: int = None,
+                   search_params: Sequence[Tuple[int, int]] = ((4, 20), (5, 50), (10, 100)),
+                   load_requests: int = 200, load_concurrency: int = 50, seed: int = 0) -> Dict[str, any]:
+    """
+    Runs the benchmark scenarios offline, on a synthetic corpus with fake embeddings and chat model.
+
+    Args:
+        scenarios (Sequence[str]): The scenarios to run, among "ingestion", "index", "query", "startup" and "load".
+            The query and startup scenarios build the index if the index scenario is skipped. Defaults to all.
+        num_docs (int): The number of documents of the corpus. Defaults to 1000.
+        num_queries (int): The number of queries of the query scenario. Defaults to 100.
+        db_type (str): The type of the vector store. Defaults to "LocalVectorStore".
+        chunk_size (int): The size of the chunks, in tokens. Defaults to 500.
+        chunk_overlap (int): The overlap between chunks, in tokens. Defaults to 50.
+        workers (int): The number of chunking processes. Defaults to 1.
+        embedding_latency (float): The simulated latency (in seconds) of an embedding request. Defaults to 0.0.
+        max_concurrency (int): The number of concurrent embedding requests when indexing. Defaults to sequential.
+        search_params (Sequence[Tuple[int, int]]): The k and fetch_k of the retrieval configurations to measure.
+        load_requests (int): The number of requests of the load scenario. Defaults to 200.
+        load_concurrency (int): The number of concurrent requests of the load scenario. Defaults to 50.
+        seed (int): The seed of the corpus and queries. Defaults to 0.
+
+    Returns:
+        Dict[str, any]: The parameters and environment of the run, and the results of each scenario.
+    """
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": {
+                "num_docs": num_docs, "num_queries": num_queries, "db_type": db_type, "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap, "workers": workers, "embedding_latency": embedding_latency,
+                "max_concurrency": max_concurrency, "search_params": [list(params) for params in search_params],
+                "seed": seed
+            }
+        },
+        "results": {}
+    }
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        docs = generate_corpus(num_docs, seed=seed)
+        if "ingestion" in scenarios:
+            report["results"]["ingestion"] = bench_ingestion(docs, work_dir, chunk_size, chunk_overlap, workers)
+        db_path = os.path.join(work_dir, "db")
+        if "index" in scenarios or "query" in scenarios or "startup" in scenarios:
+            chunks = list(chunk(docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=workers))
+            index_results = bench_index(chunks, db_path, db_type, embedding_latency, max_concurrency=max_concurrency)
+            if "index" in scenarios:
+                report["results"]["index"] = index_results
+        if "query" in scenarios:
+            queries = generate_queries(num_queries, seed=seed + 1)
+            report["results"]["query"] = bench_query(db_path, db_type, queries, search_params)
+        if "startup" in scenarios:
+            report["results"]["startup"] = bench_startup(db_path, db_type)
+        if "load" in scenarios:
+            report["results"]["load"] = load_test(requests=load_requests, concurrency=load_concurrency,
+                                                  num_docs=num_docs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and retrieval pipeline offline.")
+    parser.add_argument("--scenarios", type=str, nargs="+", default=list(SCENARIOS), choices=SCENARIOS,
+                        help="The scenarios to run. Defaults to all.")
+    parser.add_argument("--num-docs", type=int, default=1000,
+                        help="The number of documents of the synthetic corpus. Defaults to 1000.")
+    parser.add_argument("--num-queries", type=int, default=100,
+                        help="The number of queries of the query scenario. Defaults to 100.")
+    parser.add_argument("--db-type", type=str, default="LocalVectorStore",
+                        help="The type of the vector store. Defaults to \"LocalVectorStore\".")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="The size of the chunks, in tokens. Defaults to 500.")
+    parser.add_argument("--chunk-overlap", type=int, default=50,
+                        help="The overlap between chunks, in tokens. Defaults to 50.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of chunking processes. Defaults to 1.")
+    parser.add_argument("--embedding-latency", type=float, default=0.0,
+                        help="The simulated latency in seconds of an embedding request. Defaults to 0.")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="The number of concurrent embedding requests when indexing. Defaults to sequential.")
+    parser.add_argument("--search-params", type=str, nargs="+", default=["4:20", "5:50", "10:100"],
+                        help="The k:fetch_k retrieval configurations to measure. Defaults to 4:20 5:50 10:100.")
+    parser.add_argument("--load-requests", type=int, default=200,
+                        help="The number of requests of the load scenario. Defaults to 200.")
+    parser.add_argument("--load-concurrency", type=int, default=50,
+                        help="The number of concurrent requests of the load scenario. Defaults to 50.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed of the synthetic corpus and queries. Defaults to 0.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="The JSON file to write the results to. Defaults to the standard output.")
+
+    args = parser.parse_args()
+    report = run_benchmarks(
+        scenarios=args.scenarios,
+        num_docs=args.num_docs,
+        num_queries=args.num_queries,
+        db_type=args.db_type,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        workers=args.workers,
+        embedding_latency=args.embedding_latency,
+        max_concurrency=args.max_concurrency,
+        search_params=[tuple(int(value) for value in params.split(":")) for params in args.search_params],
+        load_requests=args.load_requests,
+        load_concurrency=args.load_concurrency,
+        seed=args.seed
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
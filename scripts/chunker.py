@@ -1,58 +1,115 @@
 import argparse
+import os
+from itertools import chain
+from typing import Iterable, Iterator, Optional
 
 from langchain.docstore.document import Document
 from langchain_text_splitters import TokenTextSplitter
 
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.parallel import map_batches
+
+# Splitter of the current worker process, created once by _init_worker
+_splitter: Optional[TokenTextSplitter] = None
+
 
-def chunk(documents: list[Document],
+def _init_worker(chunk_size: int, chunk_overlap: int, model_name: str) -> None:
+    global _splitter
+    _splitter = TokenTextSplitter.from_tiktoken_encoder(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        model_name=model_name,
+    )
+
+
+def _split_batch(documents: list[Document]) -> list[Document]:
+    return _splitter.split_documents(documents)
+
+
+def chunk(documents: Iterable[Document],
           chunk_size: int = 4000, chunk_overlap: int = 200,
-          model_name: str = "gpt-3.5-turbo-0125") -> list[Document]:
+          model_name: str = "gpt-3.5-turbo-0125",
+          workers: int = 1, batch_size: int = 64) -> Iterator[Document]:
     """
-    Splits a list of documents into chunks.
+    Lazily splits documents into chunks.
 
-    This function takes a list of documents and splits each document into chunks of a specified size.
+    This function takes documents and splits each document into chunks of a specified size.
     The chunks can overlap, and the size of the overlap can also be specified.
     The function uses a specific model for splitting the documents.
-    If a path is provided, the function will save the chunked documents to that path.
+    Documents are split one at a time as the result is consumed. With more than one worker, batches of documents
+    are split in a process pool and the chunks are yielded in the original order.
 
     Args:
-        documents (list[Document]): The list of documents to be chunked.
+        documents (Iterable[Document]): The documents to be chunked.
         chunk_size (int, optional): The size of each chunk. Defaults to 4000.
         chunk_overlap (int, optional): The size of the overlap between chunks. Defaults to 200.
         model_name (str, optional): The name of the LLM to select the encoding for the token counter.
             Defaults to "gpt-3.5-turbo-0125".
+        workers (int, optional): The number of worker processes. Defaults to 1 (in-process).
+        batch_size (int, optional): The number of documents sent to a worker at once. Defaults to 64.
 
-    Returns:
-        list[Document]: The list of chunked documents.
+    Yields:
+        Document: The chunked documents.
     """
+    if workers > 1:
+        batches = map_batches(_split_batch, documents, batch_size, workers, initializer=_init_worker,
+                              initargs=(chunk_size, chunk_overlap, model_name))
+        yield from chain.from_iterable(batches)
+        return
     splitter = TokenTextSplitter.from_tiktoken_encoder(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         model_name=model_name,
     )
-    return splitter.split_documents(documents)
+    for document in documents:
+        yield from splitter.split_documents([document])
 
 
 if __name__ == "__main__":
-    import os
-    import sys
-    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from utils.document import get_documents, save_documents
+    from utils.document import iter_documents, save_documents
+    from utils.manifest import run_incremental
+    from utils.metrics import REGISTRY
 
     parser = argparse.ArgumentParser(description="Splits a list of documents into chunks.")
     parser.add_argument("--input", type=str, required=True,
-                        help="The input directory containing the documents.")
+                        help="The input directory or packed .jsonl corpus containing the documents.")
     parser.add_argument("--output", type=str, required=True,
-                        help="The output directory to save the chunked documents.")
+                        help="The output directory or packed .jsonl corpus to save the chunked documents.")
     parser.add_argument("--chunk-size", type=int, default=4000,
                         help="The size of each chunk.")
     parser.add_argument("--chunk-overlap", type=int, default=200,
                         help="The size of the overlap between chunks.")
     parser.add_argument("--model-name", type=str, default="gpt-3.5-turbo-0125",
                         help="The name of the LLM to select the encoding for the token counter.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of worker processes.")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="The number of documents sent to a worker at once.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only chunk the sources that changed since the last incremental run into the output "
+                             "directory.")
 
     args = parser.parse_args()
+    documents_counter = REGISTRY.counter("chunker_documents_total", "Documents read by the chunker.")
+    chunks_counter = REGISTRY.counter("chunker_chunks_total", "Chunks written by the chunker.")
+    run_seconds = REGISTRY.histogram("chunker_run_seconds", "Duration of the chunker runs.")
+
+    def count(docs, counter):
+        for doc in docs:
+            counter.inc()
+            yield doc
+
+    def process(docs):
+        chunks = chunk(count(docs, documents_counter), chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                       model_name=args.model_name, workers=args.workers, batch_size=args.batch_size)
+        return count(chunks, chunks_counter)
 
-    docs = get_documents(path=args.input)
-    docs = chunk(docs, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, model_name=args.model_name)
-    save_documents(path=args.output, documents=docs)
+    with run_seconds.time():
+        if args.incremental:
+            params = {"chunk_size": args.chunk_size, "chunk_overlap": args.chunk_overlap, "model_name": args.model_name}
+            print(run_incremental(args.input, args.output, process, params=params))
+        else:
+            save_documents(path=args.output, documents=process(iter_documents(path=args.input)))
+    print(REGISTRY.summary("chunker_"))
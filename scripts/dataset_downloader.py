@@ -4,14 +4,37 @@ Downloads all datasets from the Données Québec portal using the CKAN API.
 """
 
 import argparse
+import json
 import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+from urllib.parse import urlparse
 
 import requests
 import logging
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.metrics import REGISTRY
+
+BASE_URL = "https://www.donneesquebec.ca/recherche/api/3/action/"
+RESOURCE_FORMATS = ["csv", "xlsx", "xls", "json", "sqlite", "pdf"]
+
+RESOURCES = REGISTRY.counter("downloader_resources_total", "Outcome of the resource downloads.", labels=("status",))
+DOWNLOADED_BYTES = REGISTRY.counter("downloader_bytes_total", "Bytes downloaded.")
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    "downloader_resource_seconds",
+    "Duration of the resource downloads, retries included.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+PACKAGE_ERRORS = REGISTRY.counter("downloader_package_errors_total", "Packages whose details could not be fetched.")
+
 
 def sanitize_filename(filename: str) -> str:
     """
@@ -26,18 +49,33 @@ def sanitize_filename(filename: str) -> str:
     return re.sub(r"[\\/:*?\"<>|]", "", filename)
 
 
-def get_package_list() -> list[str]:
+def _unique_path(path: str, suffix: str, taken: set) -> str:
+    # Resources whose names sanitize to the same file are told apart by a suffix, so that no two concurrent
+    # downloads share a file, and the path is remembered
+    root, extension = os.path.splitext(path)
+    candidate, index = path, 1
+    while candidate.lower() in taken:
+        candidate = f"{root}-{sanitize_filename(suffix)}{f'-{index}' if index > 1 else ''}{extension}"
+        index += 1
+    taken.add(candidate.lower())
+    return candidate
+
+
+def get_package_list(base_url: str = BASE_URL, session: Optional[requests.Session] = None) -> list[str]:
     """
     Fetches the package list from the Données Québec using the CKAN API.
 
+    Args:
+        base_url (str, optional): The base URL of the CKAN action API. Defaults to the Données Québec portal.
+        session (requests.Session, optional): The HTTP session to use. Defaults to a new connection.
+
     Returns:
         list[str]: The list of package names. If an error occurs, an empty list is returned.
     """
 
     logger = logging.getLogger(__name__)
-    base_url = "https://www.donneesquebec.ca/recherche/api/3/action/"
     package_list_endpoint = f"{base_url}package_list"
-    response = requests.get(package_list_endpoint)
+    response = (session or requests).get(package_list_endpoint)
 
     if response.status_code != 200:
         logger.error(f"Error fetching package list: "
@@ -51,96 +89,254 @@ def get_package_list() -> list[str]:
         return []
 
 
-def get_packages(output_dir: str = "", package_list: list[str] = None, max_retries: int = 12, delay: int = 5) -> None:
+def create_session(pool_size: int = 16) -> requests.Session:
     """
-    Downloads all packages from the Données Québec portal using the CKAN API.
+    Creates an HTTP session whose connection pools are large enough to be shared by all download threads.
 
     Args:
-        output_dir (str, optional): The directory where the downloaded packages will be stored. Defaults to the current directory.
-        package_list (list[str], optional): The list of package names to download. If None, all packages will be downloaded. Defaults to None.
-        max_retries (int, optional): The maximum number of retries for each download attempt. Defaults to 12.
-        delay (int, optional): The delay (in seconds) between each retry. Defaults to 5.
+        pool_size (int, optional): The maximum number of connections kept per host. Defaults to 16.
+
+    Returns:
+        requests.Session: The HTTP session.
     """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    if package_list is None:
-        package_list = get_package_list()
 
+class HostLimiter:
+    """
+    Limits the number of concurrent requests sent to each host.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.semaphores: dict[str, threading.Semaphore] = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, url: str) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self.lock:
+            return self.semaphores.setdefault(host, threading.Semaphore(self.limit))
+
+
+def _fetch_package(session: requests.Session, base_url: str, package_name: str,
+                   package_log_info: str) -> Optional[dict]:
     logger = logging.getLogger(__name__)
-    base_url = "https://www.donneesquebec.ca/recherche/api/3/action/"
+    endpoint = f"{base_url}package_show?id={package_name}"
+    response = session.get(endpoint)
 
-    for package_index, package_name in enumerate(package_list):
-        package_log_info = f"package {package_index + 1}/{len(package_list)} ({package_name})"
+    if response.status_code != 200:
+        logger.error(f"Error fetching details for {package_log_info}: "
+                     f"status code {response.status_code}.")
+        return None
 
-        endpoint = f"{base_url}package_show?id={package_name}"
-        response = requests.get(endpoint)
+    try:
+        data = response.json()
+    except Exception as e:
+        logger.error(f"Error parsing JSON for {package_log_info}: {e}.")
+        return None
 
-        if response.status_code != 200:
-            logger.error(f"Error fetching details for {package_log_info}: "
-                         f"status code {response.status_code}.")
-            continue
+    package_success = data.get("success", False)
+    package_result = data.get("result")
+    if not (package_success and package_result):
+        logger.error(f"Error fetching details for {package_log_info}: "
+                     f"unsuccessful.")
+        return None
+    return package_result
+
+
+def download_resource(session: requests.Session, limiter: HostLimiter, url: str, path: str,
+                      description: str, log_info: str, max_retries: int = 12, delay: int = 5,
+                      chunk_size: int = 1024 * 1024) -> bool:
+    """
+    Downloads a resource to a file, resuming partial downloads with HTTP Range requests and skipping resources
+    that did not change since the last download according to their ETag or Last-Modified headers.
+
+    The download is written to a ".part" file that is only renamed once complete, and the validators of the
+    response are stored in a ".part.http.json" file that is renamed to ".http.json" along with it.
+
+    Args:
+        session (requests.Session): The HTTP session to use.
+        limiter (HostLimiter): The per-host concurrency limiter.
+        url (str): The URL of the resource.
+        path (str): The path of the downloaded file.
+        description (str): The description of the progress bar.
+        log_info (str): The description of the resource in log messages.
+        max_retries (int, optional): The maximum number of retries. Defaults to 12.
+        delay (int, optional): The delay (in seconds) between each retry. Defaults to 5.
+        chunk_size (int, optional): The size (in bytes) of the streamed chunks. Defaults to 1 MiB.
+
+    Returns:
+        bool: True if the resource was downloaded or is up to date, False otherwise.
+    """
+    with DOWNLOAD_SECONDS.time():
+        status = _download_resource(session, limiter, url, path, description, log_info, max_retries, delay,
+                                    chunk_size)
+    RESOURCES.inc(status=status)
+    return status != "failed"
+
+
+def _read_validators(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _download_resource(session: requests.Session, limiter: HostLimiter, url: str, path: str, description: str,
+                       log_info: str, max_retries: int, delay: int, chunk_size: int) -> str:
+    logger = logging.getLogger(__name__)
+    part_path = f"{path}.part"
+    # The validators of the complete file only replace the previous ones once the download is complete, so that a
+    # failed download of a changed resource is never mistaken for an up-to-date one
+    validators_path = f"{path}.http.json"
+    part_validators_path = f"{part_path}.http.json"
+
+    for retry_index in range(max_retries):
+        headers = {}
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if resume_from:
+            headers["Range"] = f"bytes={resume_from}-"
+            # Only resume if the resource did not change since the partial download started
+            part_validators = _read_validators(part_validators_path)
+            if "etag" in part_validators or "last-modified" in part_validators:
+                headers["If-Range"] = part_validators.get("etag", part_validators.get("last-modified"))
+        elif os.path.exists(path):
+            # Conditional request for a complete download
+            validators = _read_validators(validators_path)
+            if "etag" in validators:
+                headers["If-None-Match"] = validators["etag"]
+            if "last-modified" in validators:
+                headers["If-Modified-Since"] = validators["last-modified"]
 
         try:
-            data = response.json()
+            with limiter(url), session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 304:
+                    logger.info(f"Skipping {log_info}: not modified.")
+                    return "not_modified"
+                if response.status_code == 416:
+                    # The partial file is unusable, start over
+                    os.remove(part_path)
+                    raise requests.HTTPError(f"range not satisfiable from byte {resume_from}")
+                response.raise_for_status()
+
+                mode = "ab" if response.status_code == 206 else "wb"
+                offset = resume_from if response.status_code == 206 else 0
+                resource_size = int(response.headers.get("content-length", 0)) + offset
+                validators = {k: response.headers[k] for k in ("etag", "last-modified") if k in response.headers}
+                with open(part_validators_path, "w", encoding="utf-8") as file:
+                    json.dump(validators, file)
+
+                with tqdm(total=resource_size, initial=offset, unit="B", unit_scale=True, desc=description,
+                          leave=False) as progress_bar:
+                    with open(part_path, mode) as file:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            if not chunk:
+                                continue
+                            file.write(chunk)
+                            progress_bar.update(len(chunk))
+                            DOWNLOADED_BYTES.inc(len(chunk))
+            os.replace(part_path, path)
+            os.replace(part_validators_path, validators_path)
+            return "downloaded"
         except Exception as e:
-            logger.error(f"Error parsing JSON for {package_log_info}: {e}.")
+            logger.error(f"Error downloading {log_info}: {e}.")
+            logger.info(f"Retrying in {delay} second(s)... "
+                        f"{max_retries - retry_index - 1} retrie(s) remaining.")
+            if retry_index < max_retries - 1:
+                time.sleep(delay)
             continue
+    return "failed"
 
-        package_success = data.get("success", False)
-        package_result = data.get("result")
-        if not (package_success and package_result):
-            logger.error(f"Error fetching details for {package_log_info}: "
-                         f"unsuccessful.")
-            continue
 
-        package_title = package_result.get("title")
-        if not package_title:
-            package_title = package_name
-        package_dir = os.path.join(output_dir, "datasets", sanitize_filename(package_title))
-        os.makedirs(package_dir, exist_ok=True)
+def get_packages(output_dir: str = "", package_list: list[str] = None, max_retries: int = 12, delay: int = 5,
+                 base_url: str = BASE_URL, workers: int = 8, per_host_limit: int = 4,
+                 chunk_size: int = 1024 * 1024) -> None:
+    """
+    Downloads all packages from the Données Québec portal using the CKAN API.
 
-        resource_list = package_result.get("resources", [])
-        for resource_index, resource in enumerate(resource_list):
-            resource_log_info = f"resource {resource_index + 1}/{len(resource_list)} for {package_log_info}"
+    Package details and resources are fetched concurrently by a thread pool sharing a pooled HTTP session, with a
+    limit on the number of concurrent requests per host.
 
-            resource_format = resource.get("format")
-            resource_name = resource.get("name")
-            resource_url = resource.get("url")
+    Args:
+        output_dir (str, optional): The directory where the downloaded packages will be stored. Defaults to the current directory.
+        package_list (list[str], optional): The list of package names to download. If None, all packages will be downloaded. Defaults to None.
+        max_retries (int, optional): The maximum number of retries for each download attempt. Defaults to 12.
+        delay (int, optional): The delay (in seconds) between each retry. Defaults to 5.
+        base_url (str, optional): The base URL of the CKAN action API. Defaults to the Données Québec portal.
+        workers (int, optional): The number of download threads. Defaults to 8.
+        per_host_limit (int, optional): The maximum number of concurrent requests per host. Defaults to 4.
+        chunk_size (int, optional): The size (in bytes) of the streamed chunks. Defaults to 1 MiB.
+    """
 
-            if not (resource_format and resource_name and resource_url):
-                logger.warning(f"Skipping {resource_log_info}: missing metadata.")
-                continue
+    session = create_session(pool_size=max(workers, per_host_limit))
+    limiter = HostLimiter(per_host_limit)
+
+    if package_list is None:
+        package_list = get_package_list(base_url=base_url, session=session)
+
+    logger = logging.getLogger(__name__)
 
-            resource_format = resource_format.lower()
-            if resource_format not in ["csv", "xlsx", "xls", "json", "sqlite", "pdf"]:
-                logger.warning(f"Skipping {resource_log_info}: incompatible format.")
+    def fetch_package(package_index: int, package_name: str) -> Optional[dict]:
+        package_log_info = f"package {package_index + 1}/{len(package_list)} ({package_name})"
+        with limiter(base_url):
+            return _fetch_package(session, base_url, package_name, package_log_info)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        package_futures = {
+            executor.submit(fetch_package, package_index, package_name): (package_index, package_name)
+            for package_index, package_name in enumerate(package_list)
+        }
+        download_futures = []
+        resource_paths = set()
+        for package_future in as_completed(package_futures):
+            package_index, package_name = package_futures[package_future]
+            package_log_info = f"package {package_index + 1}/{len(package_list)} ({package_name})"
+            package_result = package_future.result()
+            if package_result is None:
+                PACKAGE_ERRORS.inc()
                 continue
 
-            resource_dir = os.path.join(package_dir, f"{sanitize_filename(resource_name)}.{resource_format}")
-            for retry_index in range(max_retries):
-                try:
-                    resource_response = requests.get(resource_url, stream=True)
-                    resource_size = int(resource_response.headers.get("content-length", 0))
-                    description = (f"Downloading resource {resource_index + 1}/{len(resource_list)} "
-                                   f"of package {package_index + 1}/{len(package_list)}")
-
-                    with tqdm(total=resource_size, unit="B", unit_scale=True, desc=description) as progress_bar:
-                        with open(resource_dir, "wb") as file:
-                            for chunk in resource_response.iter_content(chunk_size=1024):
-                                if not chunk:
-                                    continue
-                                file.write(chunk)
-                                progress_bar.update(len(chunk))
-                    break
-                except Exception as e:
-                    logger.error(f"Error downloading {resource_log_info}: {e}.")
-                    logger.info(f"Retrying in {delay} second(s)... "
-                                f"{max_retries - retry_index - 1} retrie(s) remaining.")
-                    if os.path.exists(resource_dir):
-                        os.remove(resource_dir)
-                    if retry_index < max_retries - 1:
-                        time.sleep(delay)
+            package_title = package_result.get("title")
+            if not package_title:
+                package_title = package_name
+            package_dir = os.path.join(output_dir, "datasets", sanitize_filename(package_title))
+            os.makedirs(package_dir, exist_ok=True)
+
+            resource_list = package_result.get("resources", [])
+            for resource_index, resource in enumerate(resource_list):
+                resource_log_info = f"resource {resource_index + 1}/{len(resource_list)} for {package_log_info}"
+
+                resource_format = resource.get("format")
+                resource_name = resource.get("name")
+                resource_url = resource.get("url")
+
+                if not (resource_format and resource_name and resource_url):
+                    logger.warning(f"Skipping {resource_log_info}: missing metadata.")
                     continue
 
+                resource_format = resource_format.lower()
+                if resource_format not in RESOURCE_FORMATS:
+                    logger.warning(f"Skipping {resource_log_info}: incompatible format.")
+                    continue
+
+                resource_dir = _unique_path(
+                    os.path.join(package_dir, f"{sanitize_filename(resource_name)}.{resource_format}"),
+                    resource.get("id") or str(resource_index), resource_paths
+                )
+                description = (f"Downloading resource {resource_index + 1}/{len(resource_list)} "
+                               f"of package {package_index + 1}/{len(package_list)}")
+                download_futures.append(executor.submit(
+                    download_resource, session, limiter, resource_url, resource_dir, description,
+                    resource_log_info, max_retries=max_retries, delay=delay, chunk_size=chunk_size
+                ))
+
+        for download_future in as_completed(download_futures):
+            download_future.result()
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="[%(levelname).4s] %(message)s")
@@ -150,6 +346,10 @@ if __name__ == "__main__":
     parser.add_argument("--package_list", type=str, nargs="+", default=None, help="The list of package names to download.")
     parser.add_argument("--max_retries", type=int, default=12, help="The maximum number of retries for each download attempt.")
     parser.add_argument("--delay", type=int, default=5, help="The delay (in seconds) between each retry.")
+    parser.add_argument("--base_url", type=str, default=BASE_URL, help="The base URL of the CKAN action API.")
+    parser.add_argument("--workers", type=int, default=8, help="The number of download threads.")
+    parser.add_argument("--per_host_limit", type=int, default=4, help="The maximum number of concurrent requests per host.")
+    parser.add_argument("--chunk_size", type=int, default=1024 * 1024, help="The size (in bytes) of the streamed chunks.")
 
     args = parser.parse_args()
 
@@ -157,5 +357,10 @@ if __name__ == "__main__":
         output_dir=args.output_dir,
         package_list=args.package_list,
         max_retries=args.max_retries,
-        delay=args.delay
+        delay=args.delay,
+        base_url=args.base_url,
+        workers=args.workers,
+        per_host_limit=args.per_host_limit,
+        chunk_size=args.chunk_size
     )
+    logging.getLogger(__name__).info(f"Metrics:\n{REGISTRY.summary('downloader_')}")
@@ -0,0 +1,431 @@
+"""
+extractor.py
+Extracts documents from the resources downloaded by dataset_downloader.py.
+"""
+
+import argparse
+import codecs
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.document import is_packed, save_documents
+from utils.metrics import REGISTRY
+
+EXTRACTABLE_FORMATS = ["csv", "xlsx", "xls", "json", "sqlite", "pdf"]
+SKIPPED_SUFFIXES = (".part", ".http.json")
+
+RESOURCES = REGISTRY.counter("extractor_resources_total", "Outcome of the resource extractions.",
+                             labels=("format", "status"))
+DOCUMENTS = REGISTRY.counter("extractor_documents_total", "Documents extracted from the resources.")
+
+Table = Tuple[str, Iterator[Dict[str, Any]]]
+
+
+def _open_text(path: str):
+    # Quebec open data is published both in UTF-8 and in Windows-1252
+    with open(path, "rb") as file:
+        head = file.read(64 * 1024)
+    try:
+        head.decode("utf-8-sig")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # A multibyte character may be cut at the end of the sample
+        encoding = "utf-8-sig" if e.start >= len(head) - 3 else "cp1252"
+    return open(path, "r", encoding=encoding, errors="replace", newline="")
+
+
+def _read_csv(path: str, batch_size: int) -> Iterator[Table]:
+    with _open_text(path) as file:
+        sample = file.read(64 * 1024)
+        file.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        yield "", csv.DictReader(file, dialect=dialect)
+
+
+def _iter_sheet_rows(rows: Iterator[Tuple[Any, ...]]) -> Iterator[Dict[str, Any]]:
+    header = None
+    for row in rows:
+        if header is None:
+            if any(value not in (None, "") for value in row):
+                header = [str(value) if value not in (None, "") else f"column_{i + 1}" for i, value in enumerate(row)]
+            continue
+        yield dict(zip(header, row))
+
+
+def _read_xlsx(path: str, batch_size: int) -> Iterator[Table]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Reading XLSX files requires openpyxl")
+    # Read-only mode streams the rows instead of loading the whole workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield sheet.title, _iter_sheet_rows(sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def _read_xls(path: str, batch_size: int) -> Iterator[Table]:
+    try:
+        import xlrd
+    except ImportError:
+        raise ValueError("Reading XLS files requires xlrd")
+    workbook = xlrd.open_workbook(path, on_demand=True)
+    try:
+        for index in range(workbook.nsheets):
+            sheet = workbook.sheet_by_index(index)
+            yield sheet.name, _iter_sheet_rows(sheet.row_values(i) for i in range(sheet.nrows))
+            workbook.unload_sheet(index)
+    finally:
+        workbook.release_resources()
+
+
+def _json_rows(value: Any) -> Iterator[Dict[str, Any]]:
+    if isinstance(value, list):
+        for item in value:
+            yield from _json_rows(item)
+    elif isinstance(value, dict):
+        # GeoJSON features carry their attributes in their properties
+        yield value["properties"] if isinstance(value.get("properties"), dict) else value
+    elif value is not None:
+        yield {"value": value}
+
+
+def _item_prefix(prefix: str) -> str:
+    return f"{prefix}.item" if prefix else "item"
+
+
+def _record_paths(value: Any, prefix: str = "") -> Iterator[str]:
+    # The arrays of objects of a parsed JSON value, outside of one another, in document order
+    if isinstance(value, list):
+        if any(isinstance(item, dict) for item in value):
+            yield prefix
+        else:
+            for item in value:
+                yield from _record_paths(item, _item_prefix(prefix))
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _record_paths(item, f"{prefix}.{key}" if prefix else key)
+
+
+def _stream_record_paths(events: Iterator[Tuple[str, str, Any]]) -> List[str]:
+    # Same as _record_paths, from the parsing events of ijson
+    paths: List[str] = []
+    for prefix, event, _ in events:
+        if event != "start_map" or not (prefix == "item" or prefix.endswith(".item")):
+            continue
+        path = prefix[:-len(".item")] if prefix != "item" else ""
+        if not any(path == found or path.startswith(f"{_item_prefix(found)}.") for found in paths):
+            paths.append(path)
+    return paths
+
+
+def _json_items(value: Any, keys: List[str]) -> Iterator[Any]:
+    # The items of the arrays at a path of a parsed JSON value, as ijson.items yields them
+    if not keys:
+        if isinstance(value, list):
+            yield from value
+    elif isinstance(value, list) and keys[0] == "item":
+        for item in value:
+            yield from _json_items(item, keys[1:])
+    elif isinstance(value, dict) and keys[0] in value:
+        yield from _json_items(value[keys[0]], keys[1:])
+
+
+def _read_json(path: str, batch_size: int) -> Iterator[Table]:
+    # Each array of objects, such as the records of a CKAN datastore dump or the features of a GeoJSON file, is a
+    # table named by its path in the document
+    try:
+        import ijson
+    except ImportError:
+        # Without ijson, the file has to be parsed at once
+        logging.getLogger(__name__).warning(
+            f"ijson is not installed, loading {path} in memory instead of streaming it."
+        )
+        with _open_text(path) as file:
+            data = json.load(file)
+        paths = list(_record_paths(data))
+        if paths:
+            for records_path in paths:
+                keys = records_path.split(".") if records_path else []
+                yield records_path, (row for item in _json_items(data, keys) for row in _json_rows(item))
+            return
+        for key, value in (data.items() if isinstance(data, dict) else [("", data)]):
+            yield key, _json_rows(value if isinstance(value, list) or not key else {key: value})
+        return
+    with open(path, "rb") as file:
+        offset = len(codecs.BOM_UTF8) if file.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+        # A first pass finds the arrays of objects, whose items are then streamed one by one
+        file.seek(offset)
+        paths = _stream_record_paths(ijson.parse(file))
+        if paths:
+            for records_path in paths:
+                file.seek(offset)
+                yield records_path, (
+                    row for item in ijson.items(file, _item_prefix(records_path)) for row in _json_rows(item)
+                )
+            return
+        file.seek(offset)
+        if file.read(4096).lstrip().startswith(b"["):
+            file.seek(offset)
+            yield "", (row for item in ijson.items(file, "item") for row in _json_rows(item))
+        else:
+            file.seek(offset)
+            for key, value in ijson.kvitems(file, ""):
+                yield key, _json_rows(value if isinstance(value, list) else {key: value})
+
+
+def _read_sqlite(path: str, batch_size: int) -> Iterator[Table]:
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = [name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )]
+
+        def rows(table: str) -> Iterator[Dict[str, Any]]:
+            cursor = connection.execute(f'SELECT * FROM "{table}"')
+            columns = [column[0] for column in cursor.description]
+            while batch := cursor.fetchmany(batch_size):
+                for row in batch:
+                    yield dict(zip(columns, row))
+
+        for table in tables:
+            yield table, rows(table)
+    finally:
+        connection.close()
+
+
+def _read_pdf(path: str, batch_size: int) -> Iterator[Table]:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("Reading PDF files requires pypdf")
+    reader = PdfReader(path)
+    yield "", ({"page": i + 1, "text": page.extract_text()} for i, page in enumerate(reader.pages))
+
+
+READERS = {
+    "csv": _read_csv,
+    "xlsx": _read_xlsx,
+    "xls": _read_xls,
+    "json": _read_json,
+    "sqlite": _read_sqlite,
+    "pdf": _read_pdf
+}
+
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value).strip()
+
+
+def _render_row(row: Dict[str, Any]) -> str:
+    return "; ".join(
+        f"{key}: {_format_value(value)}"
+        for key, value in row.items()
+        if key is not None and value is not None and _format_value(value)
+    )
+
+
+def _source_name(package: str, name: str) -> str:
+    # Documents are saved under their source, which must not contain dots. Resources of the same name in several
+    # formats, or whose names only differ by punctuation, must not share a source, or their files would collide
+    resource, extension = os.path.splitext(name)
+    digest = hashlib.blake2b(f"{package}/{name}".encode("utf-8"), digest_size=4).hexdigest()
+    return re.sub(r"\W+", "_", f"{package}--{resource}-{extension.lstrip('.')}").strip("_") + f"-{digest}"
+
+
+def extract_resource(path: str, package: str = "", rows_per_document: int = 20,
+                     batch_size: int = 1000) -> Iterator[Document]:
+    """
+    Lazily extracts documents from a downloaded resource. The resource is read in batches of rows, one table or
+    sheet at a time, and each group of rows is rendered as a document, so the whole file is never held in memory.
+
+    Args:
+        path (str): The path of the resource.
+        package (str, optional): The name of the package of the resource. Defaults to none.
+        rows_per_document (int, optional): The number of rows rendered in each document. Defaults to 20.
+        batch_size (int, optional): The number of rows fetched at once from databases. Defaults to 1000.
+
+    Yields:
+        Document: The documents.
+
+    Raises:
+        ValueError: Raised if the format of the resource is not supported, or requires a missing library.
+    """
+    name = os.path.basename(path)
+    resource, extension = os.path.splitext(name)
+    resource_format = extension.lstrip(".").lower()
+    if resource_format not in READERS:
+        raise ValueError(f"Unsupported resource format: {resource_format}")
+    source = _source_name(package, name)
+
+    for table, rows in READERS[resource_format](path, batch_size):
+        rows = iter(rows)
+        start = 0
+        while group := list(islice(rows, rows_per_document)):
+            lines = [line for line in map(_render_row, group) if line]
+            if lines:
+                header = [f"Package: {package}", f"Resource: {resource}"] + ([f"Table: {table}"] if table else [])
+                metadata = {
+                    "source": source,
+                    "package": package,
+                    "resource": name,
+                    "format": resource_format,
+                    "rows": f"{start + 1}-{start + len(group)}"
+                }
+                if table:
+                    metadata["table"] = table
+                yield Document(page_content="\n".join(header + lines), metadata=metadata)
+            start += len(group)
+
+
+def list_resources(input_dir: str) -> List[Tuple[str, str]]:
+    """
+    Lists the resources downloaded to a directory, skipping partial downloads and HTTP metadata.
+
+    Args:
+        input_dir (str): The output directory of the downloader, containing the "datasets" directory.
+
+    Returns:
+        List[Tuple[str, str]]: The path and package name of each resource.
+    """
+    datasets_dir = os.path.join(input_dir, "datasets")
+    if not os.path.isdir(datasets_dir):
+        datasets_dir = input_dir
+    resources = []
+    with os.scandir(datasets_dir) as packages:
+        for package in sorted(packages, key=lambda entry: entry.name):
+            if not package.is_dir():
+                continue
+            with os.scandir(package.path) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if not entry.is_file() or entry.name.endswith(SKIPPED_SUFFIXES):
+                        continue
+                    if os.path.splitext(entry.name)[1].lstrip(".").lower() in EXTRACTABLE_FORMATS:
+                        resources.append((entry.path, package.name))
+    return resources
+
+
+class _Counted:
+    def __init__(self, docs: Iterable[Document]) -> None:
+        self.docs = docs
+        self.count = 0
+
+    def __iter__(self) -> Iterator[Document]:
+        for doc in self.docs:
+            self.count += 1
+            yield doc
+
+
+def _extract_to_directory(path: str, package: str, output_dir: str, rows_per_document: int,
+                          batch_size: int) -> Tuple[int, Optional[str]]:
+    docs = _Counted(extract_resource(path, package, rows_per_document, batch_size))
+    try:
+        save_documents(output_dir, docs)
+    except Exception as e:
+        return docs.count, str(e)
+    return docs.count, None
+
+
+def extract_datasets(input_dir: str, output: str, workers: int = 4, rows_per_document: int = 20,
+                     batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Extracts documents from all the resources downloaded to a directory.
+
+    Resources are extracted in a process pool, each worker streaming the documents of a resource to the output
+    directory. A packed output corpus is written by a single process.
+
+    Args:
+        input_dir (str): The output directory of the downloader.
+        output (str): The output directory or packed .jsonl corpus of the documents.
+        workers (int, optional): The number of worker processes. Defaults to 4.
+        rows_per_document (int, optional): The number of rows rendered in each document. Defaults to 20.
+        batch_size (int, optional): The number of rows fetched at once from databases. Defaults to 1000.
+
+    Returns:
+        Dict[str, int]: The number of extracted resources, failed resources and documents.
+    """
+    logger = logging.getLogger(__name__)
+    resources = list_resources(input_dir)
+    summary = {"resources": 0, "failed": 0, "documents": 0}
+
+    def record(path: str, count: int, error: Optional[str]) -> None:
+        resource_format = os.path.splitext(path)[1].lstrip(".").lower()
+        summary["documents"] += count
+        DOCUMENTS.inc(count)
+        if error is None:
+            summary["resources"] += 1
+            RESOURCES.inc(format=resource_format, status="extracted")
+        else:
+            summary["failed"] += 1
+            RESOURCES.inc(format=resource_format, status="failed")
+            logger.error(f"Error extracting {path}: {error}.")
+
+    if is_packed(output):
+        def docs() -> Iterator[Document]:
+            for path, package in resources:
+                counted = _Counted(extract_resource(path, package, rows_per_document, batch_size))
+                try:
+                    yield from counted
+                    record(path, counted.count, None)
+                except Exception as e:
+                    record(path, counted.count, str(e))
+        save_documents(output, docs())
+        return summary
+
+    os.makedirs(output, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_extract_to_directory, path, package, output, rows_per_document, batch_size): path
+            for path, package in resources
+        }
+        for future in as_completed(futures):
+            record(futures[future], *future.result())
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(levelname).4s] %(message)s")
+
+    parser = argparse.ArgumentParser(description="Extract documents from the downloaded resources.")
+    parser.add_argument("--input", type=str, required=True,
+                        help="The output directory of the downloader.")
+    parser.add_argument("--output", type=str, required=True,
+                        help="The output directory or packed .jsonl corpus to save the documents.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="The number of worker processes.")
+    parser.add_argument("--rows-per-document", type=int, default=20,
+                        help="The number of rows rendered in each document.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="The number of rows fetched at once from databases.")
+
+    args = parser.parse_args()
+    print(extract_datasets(
+        input_dir=args.input,
+        output=args.output,
+        workers=args.workers,
+        rows_per_document=args.rows_per_document,
+        batch_size=args.batch_size
+    ))
+    logging.getLogger(__name__).info(f"Metrics:\n{REGISTRY.summary('extractor_')}")
@@ -0,0 +1,81 @@
+import argparse
+import base64
+import os
+from typing import List, Literal, Optional, Union
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI
+from pydantic import BaseModel, Field
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.fakes import FakeEmbeddings
+
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str], List[int], List[List[int]]] = Field(..., description="The texts or token ids.")
+    model: str = Field(..., description="The name of the embedding model, echoed in the response.")
+    encoding_format: Literal["float", "base64"] = Field("float", description="The format of the embeddings.")
+    dimensions: Optional[int] = Field(None, ge=1, description="The number of dimensions of the embeddings.")
+
+
+def _texts(inputs: Union[str, List[str], List[int], List[List[int]]]) -> List[str]:
+    # OpenAIEmbeddings sends token ids, which are embedded as words so that texts sharing tokens stay similar
+    if isinstance(inputs, str):
+        return [inputs]
+    if inputs and isinstance(inputs[0], int):
+        return [" ".join(map(str, inputs))]
+    return [text if isinstance(text, str) else " ".join(map(str, text)) for text in inputs]
+
+
+def create_app(dim: int = 1536, latency: float = 0.0) -> FastAPI:
+    """
+    Creates an OpenAI-compatible embeddings API answering with FakeEmbeddings, to measure the throughput of the
+    indexer without calling OpenAI. Point the indexer at it with --embedding-base-url http://localhost:8001/v1.
+
+    Args:
+        dim (int): The default number of dimensions of the embeddings. Defaults to 1536.
+        latency (float): The latency in seconds of each request, simulating the round-trip of the API. Defaults to 0.
+
+    Returns:
+        FastAPI: The application.
+    """
+    app = FastAPI(title="Fake embeddings", version="1.0")
+    embeddings = {}
+
+    @app.post("/embeddings")
+    @app.post("/v1/embeddings")
+    async def embed(request: EmbeddingRequest) -> dict:
+        texts = _texts(request.input)
+        size = request.dimensions or dim
+        if size not in embeddings:
+            embeddings[size] = FakeEmbeddings(dim=size, latency=latency)
+        vectors = await embeddings[size].aembed_documents(texts)
+        if request.encoding_format == "base64":
+            vectors = [base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode() for vector in vectors]
+        num_tokens = sum(len(text.split()) for text in texts)
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)],
+            "model": request.model,
+            "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens}
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake OpenAI-compatible embeddings for throughput runs.")
+    parser.add_argument("--host", type=str, default="localhost",
+                        help="Host to bind to. Defaults to \"localhost\".")
+    parser.add_argument("--port", type=int, default=8001,
+                        help="Port to bind to. Defaults to 8001.")
+    parser.add_argument("--dim", type=int, default=1536,
+                        help="Default number of dimensions of the embeddings. Defaults to 1536.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Latency in seconds of each request. Defaults to 0.")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(dim=args.dim, latency=args.latency), host=args.host, port=args.port)
@@ -1,56 +1,197 @@
 import argparse
+import hashlib
+import os
 import re
-from typing import List
+from functools import partial
+from typing import Dict, List, Iterable, Iterator, Optional, Tuple
 
+import numpy as np
 from langchain_core.documents import Document
 
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.parallel import map_batches
+
+_SPACE_BEFORE_PUNCTUATION = re.compile(r" (?=[.,:;?!])")
+_MISSING_SPACE_AFTER_PUNCTUATION = re.compile(r"([.,:;?!])(\S)")
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes the whitespace and punctuation spacing of a text.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        str: The normalized text.
+    """
+    # Strip and collapse whitespaces in a single pass, leaving at most one space before punctuation
+    text = " ".join(text.split())
+    # Remove space before punctuation
+    text = _SPACE_BEFORE_PUNCTUATION.sub("", text)
+    # Ensure there's a space after punctuation
+    return _MISSING_SPACE_AFTER_PUNCTUATION.sub(r"\1 \2", text)
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    Computes the 64-bit SimHash fingerprint of a text from its word shingles. Near-duplicate texts have
+    fingerprints differing by only a few bits.
+
+    Args:
+        text (str): The text.
+        shingle_size (int): The number of words of each shingle. Defaults to 3.
 
-def filter_content(docs: List[Document]) -> List[Document]:
+    Returns:
+        int: The fingerprint.
+    """
+    words = _WORD_PATTERN.findall(text.lower())
+    shingles = {
+        " ".join(words[i:i + shingle_size])
+        for i in range(max(1, len(words) - shingle_size + 1))
+    }
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles),
+        dtype=np.uint8
+    ).reshape(-1, 8)
+    # Each bit of the fingerprint is the majority vote of that bit over the shingle hashes
+    votes = np.unpackbits(hashes, axis=1).sum(axis=0, dtype=np.int64)
+    return int.from_bytes(np.packbits(votes * 2 > len(shingles)).tobytes(), "big")
+
+
+class NearDuplicateFilter:
+    """
+    Detects near-duplicate texts by the Hamming distance of their SimHash fingerprints. Fingerprints are split into
+    bands indexed in hash tables: two fingerprints within max_distance bits share at least one identical band when
+    there are more bands than max_distance, so only the fingerprints sharing a band are compared.
+    """
+
+    def __init__(self, max_distance: int = 3, num_bands: Optional[int] = None) -> None:
+        if num_bands is None:
+            # The smallest power of two greater than max_distance
+            num_bands = max(4, 1 << max_distance.bit_length())
+        if num_bands <= max_distance or 64 % num_bands:
+            raise ValueError("num_bands must divide 64 and be greater than max_distance")
+        self.max_distance = max_distance
+        self.num_bands = num_bands
+        self.band_bits = 64 // num_bands
+        self.bands: List[Dict[int, List[int]]] = [{} for _ in range(num_bands)]
+
+    def _bands(self, fingerprint: int) -> Iterator[Tuple[int, int]]:
+        mask = (1 << self.band_bits) - 1
+        for band in range(self.num_bands):
+            yield band, (fingerprint >> (band * self.band_bits)) & mask
+
+    def is_duplicate(self, fingerprint: int) -> bool:
+        """
+        Checks whether a fingerprint is near a fingerprint seen before, and remembers it otherwise.
+
+        Args:
+            fingerprint (int): The SimHash fingerprint.
+
+        Returns:
+            bool: Whether the fingerprint is a near duplicate.
+        """
+        bands = list(self._bands(fingerprint))
+        for band, key in bands:
+            for other in self.bands[band].get(key, ()):
+                if (fingerprint ^ other).bit_count() <= self.max_distance:
+                    return True
+        for band, key in bands:
+            self.bands[band].setdefault(key, []).append(fingerprint)
+        return False
+
+
+def _filter_batch(docs: List[Document], fingerprint: bool) -> Tuple[List[Document], Optional[List[int]]]:
     for doc in docs:
-        # Remove leading and trailing whitespaces
-        doc.page_content = doc.page_content.strip()
-        # Remove extra whitespaces between words
-        doc.page_content = re.sub(r"\s+", " ", doc.page_content)
-        # Remove space before punctuation
-        doc.page_content = re.sub(r"\s([.,:;?!])", r"\1", doc.page_content)
-        # Ensure there's a space after punctuation
-        doc.page_content = re.sub(r"([.,:;?!])(\S)", r"\1 \2", doc.page_content)
-    return docs
+        doc.page_content = normalize_text(doc.page_content)
+    return docs, [simhash(doc.page_content) for doc in docs] if fingerprint else None
+
 
-def filter_metadata(docs: List[Document], keys: List[str]) -> List[Document]:
+def filter_content(docs: Iterable[Document], workers: int = 1, batch_size: int = 256,
+                   dedupe: bool = False, max_distance: int = 3) -> Iterator[Document]:
     """
-    Filters the metadata of a list of Document objects based on a list of keys.
+    Lazily normalizes the whitespace and punctuation spacing of the content of Document objects.
+
+    With more than one worker, batches of documents are normalized in a process pool and yielded in the original
+    order. Near-duplicate documents, such as bulletins republished with minor edits, can also be dropped, keeping
+    the first one.
 
     Args:
-        docs (List[Document]): The list of Document objects.
+        docs (Iterable[Document]): The Document objects.
+        workers (int, optional): The number of worker processes. Defaults to 1 (in-process).
+        batch_size (int, optional): The number of documents sent to a worker at once. Defaults to 256.
+        dedupe (bool, optional): Whether to drop near-duplicate documents. Defaults to False.
+        max_distance (int, optional): The maximum number of differing bits between the SimHash fingerprints of
+            near-duplicate documents. Defaults to 3.
+
+    Yields:
+        Document: The filtered Document objects.
+    """
+    duplicates = NearDuplicateFilter(max_distance=max_distance) if dedupe else None
+    for batch, fingerprints in map_batches(partial(_filter_batch, fingerprint=dedupe), docs, batch_size, workers):
+        if duplicates is None:
+            yield from batch
+            continue
+        for doc, fingerprint in zip(batch, fingerprints):
+            if not duplicates.is_duplicate(fingerprint):
+                yield doc
+
+
+def filter_metadata(docs: Iterable[Document], keys: List[str]) -> Iterator[Document]:
+    """
+    Lazily filters the metadata of Document objects based on a list of keys.
+
+    Args:
+        docs (Iterable[Document]): The Document objects.
         keys (List[str]): The list of keys to keep in the metadata.
 
-    Returns:
-        List[Document]: The filtered list of Document objects.
+    Yields:
+        Document: The filtered Document objects.
     """
     for doc in docs:
         doc.metadata = {k: v for k, v in doc.metadata.items() if k in keys}
-    return docs
+        yield doc
 
 
 if __name__ == "__main__":
-    import os
-    import sys
-    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from utils.document import get_documents, save_documents
+    from utils.document import iter_documents, save_documents
+    from utils.manifest import run_incremental
 
     parser = argparse.ArgumentParser(description="Filter documents metadata.")
     parser.add_argument("--input", type=str, required=True,
-                        help="The input directory containing the documents.")
+                        help="The input directory or packed .jsonl corpus containing the documents.")
     parser.add_argument("--output", type=str, required=True,
-                        help="The output directory to save the filtered documents.")
+                        help="The output directory or packed .jsonl corpus to save the filtered documents.")
     parser.add_argument("--keys", type=str, nargs='+',
                         help="The keys to keep in the metadata.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process the sources that changed since the last incremental run into the output "
+                             "directory. The \"source\" key is always kept in the metadata.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of worker processes.")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="The number of documents sent to a worker at once.")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Drop near-duplicate documents, keeping the first one.")
+    parser.add_argument("--max-distance", type=int, default=3,
+                        help="The maximum number of differing bits between the SimHash fingerprints of near-duplicate "
+                             "documents.")
 
     args = parser.parse_args()
 
-    docs = get_documents(path=args.input)
-    docs = filter_content(docs=docs)
-    if args.keys:
-        docs = filter_metadata(docs=docs, keys=args.keys)
-    save_documents(path=args.output, documents=docs)
+    def process(docs):
+        docs = filter_content(docs=docs, workers=args.workers, batch_size=args.batch_size, dedupe=args.dedupe,
+                              max_distance=args.max_distance)
+        if args.keys:
+            keys = args.keys + ["source"] if args.incremental else args.keys
+            docs = filter_metadata(docs=docs, keys=keys)
+        return docs
+
+    if args.incremental:
+        print(run_incremental(args.input, args.output, process, params={"keys": sorted(args.keys or [])}))
+    else:
+        save_documents(path=args.output, documents=process(iter_documents(path=args.input)))
@@ -1,19 +1,162 @@
 import argparse
-import json
+import asyncio
+import logging
 import os
-from typing import Union, List, Literal
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextlib import suppress
+from itertools import islice
+from typing import Union, List, Literal, Iterable, Iterator, Dict, Optional
 
 from langchain.indexes import SQLRecordManager, index, IndexingResult
-import langchain_community.vectorstores as vectorstores
 from langchain_core.embeddings import Embeddings
-from langchain_openai import OpenAIEmbeddings
 
 from langchain_core.documents.base import Document
 
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.cache import write_index_version
+from utils.document import iter_documents
+from utils.embeddings import CachedEmbeddings, get_embeddings
+from utils.filters import normalize_metadata
+from utils.lexical import BM25_INDEX_FILE, BM25Index
+from utils.manifest import Manifest, hash_sources
+from utils.metrics import REGISTRY
+from utils.vectorstore import LocalVectorStore, get_vector_store_class
+
+INDEX_MANIFEST_FILE = "index_manifest.json"
+
+INDEXED_DOCUMENTS = REGISTRY.counter("indexer_documents_total", "Documents passed to the indexer.")
+INDEXED_TOKENS = REGISTRY.counter("indexer_tokens_total", "Tokens of the documents passed to the indexer.")
+INDEX_RESULTS = REGISTRY.counter("indexer_results_total", "Outcome of the indexed documents.", labels=("result",))
+INDEX_SECONDS = REGISTRY.histogram("indexer_run_seconds", "Duration of the index updates.")
+EMBEDDING_SECONDS = REGISTRY.histogram("indexer_embedding_request_seconds", "Duration of the embedding requests.")
+EMBEDDING_RETRIES = REGISTRY.counter("indexer_embedding_retries_total", "Retries of failed embedding requests.")
+
+
+def _is_retryable(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    status_code = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return type(error).__name__ in ("RateLimitError", "APIConnectionError", "APITimeoutError")
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def _embed_batch(embeddings: CachedEmbeddings, texts: List[str], semaphore: asyncio.Semaphore,
+                       max_retries: int, delay: float) -> None:
+    async with semaphore:
+        for retry_index in range(max_retries + 1):
+            try:
+                with EMBEDDING_SECONDS.time():
+                    await embeddings.aembed_documents(texts)
+                return
+            except Exception as e:
+                if retry_index == max_retries or not _is_retryable(e):
+                    raise
+                EMBEDDING_RETRIES.inc()
+                # Exponential backoff with jitter, unless the server tells us how long to wait
+                await asyncio.sleep(_retry_after(e) or delay * 2 ** retry_index * (0.5 + random.random()))
+
+
+def _embed_batches(docs: Iterable[Document], embeddings: CachedEmbeddings, batch_size: int,
+                   max_concurrency: int, max_retries: int, delay: float) -> Iterator[List[Document]]:
+    """
+    Embeds batches of documents concurrently in a background event loop and yields each batch, in order, once its
+    embeddings are in the cache. At most twice max_concurrency batches are held in memory at any time.
+    """
+    batches = queue.Queue(maxsize=max_concurrency)
+    docs = iter(docs)
+
+    async def produce() -> None:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        pending = deque()
+
+        async def flush() -> None:
+            batch, task = pending.popleft()
+            await task
+            await asyncio.to_thread(batches.put, batch)
+
+        while batch := await asyncio.to_thread(lambda: list(islice(docs, batch_size))):
+            texts = [doc.page_content for doc in batch]
+            pending.append((batch, asyncio.create_task(_embed_batch(embeddings, texts, semaphore, max_retries, delay))))
+            while len(pending) >= max_concurrency or (pending and pending[0][1].done()):
+                await flush()
+        while pending:
+            await flush()
+
+    def run() -> None:
+        try:
+            asyncio.run(produce())
+            batches.put(None)
+        except BaseException as e:
+            batches.put(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    while (batch := batches.get()) is not None:
+        if isinstance(batch, BaseException):
+            raise batch
+        yield batch
+
+
+def _load_documents(path: str) -> Iterator[Document]:
+    try:
+        yield from iter_documents(path)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Failed to load documents from {path}: {e}")
+
+
+def _index_lexically(docs: Iterable[Document], lexical_index: BM25Index, cleanup: Optional[str],
+                     source_key: str) -> Iterator[Document]:
+    # Mirror the cleanup of the vector store: a full cleanup starts over, an incremental one replaces each source
+    if cleanup == "full":
+        lexical_index.clear()
+    seen_sources = set()
+    for doc in docs:
+        source = doc.metadata.get(source_key)
+        if cleanup == "incremental" and source not in seen_sources:
+            lexical_index.remove_source(source)
+        seen_sources.add(source)
+        lexical_index.add(doc, source_key=source_key)
+        yield doc
+
+
+def _normalize_metadata(docs: Iterable[Document]) -> Iterator[Document]:
+    for doc in docs:
+        doc.metadata = normalize_metadata(doc.metadata)
+        yield doc
+
+
+def _measure(docs: Iterable[Document], stats: Dict[str, int], model_name: str) -> Iterator[Document]:
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model_name)
+    except Exception:
+        encoding = None
+    for doc in docs:
+        stats["docs"] += 1
+        INDEXED_DOCUMENTS.inc()
+        if encoding is not None:
+            num_tokens = len(encoding.encode_ordinary(doc.page_content))
+            stats["tokens"] += num_tokens
+            INDEXED_TOKENS.inc(num_tokens)
+        yield doc
+
 
 def clear_index(db_path: str, db_type: str = "Chroma", namespace: str = None) -> None:
     """
-    Clears the index in the given database.
+    Clears the index in the given database, along with its BM25 index and its manifest.
 
     Parameters:
         db_path (str): The path to the database.
@@ -21,27 +164,54 @@ def clear_index(db_path: str, db_type: str = "Chroma", namespace: str = None) ->
         namespace (str, optional): The namespace for the record manager. Defaults to "db_type/indexing".
     """
     update_index([], db_path=db_path, db_type=db_type, namespace=namespace, cleanup="full")
+    # Otherwise hybrid retrieval would keep returning the cleared documents, and the next run with the manifest would
+    # skip the sources it already indexed
+    for name in (BM25_INDEX_FILE, INDEX_MANIFEST_FILE):
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(db_path, name))
+    write_index_version(db_path)
 
 
-def update_index(docs: Union[List[Document], str],
+def update_index(docs: Union[Iterable[Document], str],
                  db_path: str, db_type: str = "Chroma", namespace: str = None, source_key: str = "source",
-                 embedding_function: Union[Embeddings, str] = OpenAIEmbeddings(model="text-embedding-3-small"),
-                 cleanup: Union[Literal["incremental", "full"], None] = "full") -> IndexingResult:
+                 embedding_function: Union[Embeddings, str] = "text-embedding-3-small",
+                 cleanup: Union[Literal["incremental", "full"], None] = "full",
+                 cache_embeddings: bool = True, batch_size: int = 100, max_concurrency: int = None,
+                 max_retries: int = 6, delay: float = 1.0, embedding_base_url: str = None,
+                 use_manifest: bool = False, bm25: bool = False) -> IndexingResult:
     """
-    Updates the index with the given documents.
+    Updates the index with the given documents. The publication date found in the metadata of the documents is
+    indexed as a timestamp, so that retrieval can be filtered by date, source, package and region.
 
     Parameters:
-        docs (Union[List[Document], str]): The documents to index. This can be a list of Document objects or
-            a string representing the path to a directory containing the documents.
+        docs (Union[Iterable[Document], str]): The documents to index. This can be an iterable of Document objects
+            or a string representing the path to a directory or packed corpus containing the documents.
         db_path (str): The path to the database.
         db_type (str, optional): The type of the database. Defaults to "Chroma".
         namespace (str, optional): The namespace for the record manager. Defaults to "db_type/indexing".
         source_key (str, optional): The key to use for the source ID in the index. Defaults to "source".
         embedding_function (Union[Embeddings, str], optional): The function to use for creating embeddings.
             This can be an Embeddings object or a string representing the name of the OpenAI embedding model to use.
-            Defaults to OpenAIEmbeddings(model="text-embedding-3-small").
+            Defaults to "text-embedding-3-small".
         cleanup (Union[Literal["incremental", "full"], None], optional): The cleanup strategy to use when indexing.
             This can be "incremental", "full", or None. Defaults to "full".
+        cache_embeddings (bool, optional): Whether to cache the embeddings on disk in the database directory, so that
+            unchanged documents are never embedded twice. Defaults to True.
+        batch_size (int, optional): The number of documents embedded and written to the vector store and the record
+            manager at once. Defaults to 100.
+        max_concurrency (int, optional): If set, documents are streamed in batches and embedded with up to this many
+            concurrent requests before being written. Requires the embedding cache. Defaults to None (sequential).
+        max_retries (int, optional): The maximum number of retries of a rate-limited embedding request in concurrent
+            mode. Defaults to 6.
+        delay (float, optional): The initial delay (in seconds) of the exponential backoff between retries.
+            Defaults to 1.0.
+        embedding_base_url (str, optional): The base URL of the OpenAI-compatible embeddings API, used when the
+            embedding function is given by name. Defaults to None (OpenAI).
+        use_manifest (bool, optional): Whether to only index the sources whose content changed since the last run
+            with a manifest, with incremental cleanup of just those sources, and to remove the sources that
+            disappeared. Requires docs to be a path. Defaults to False.
+        bm25 (bool, optional): Whether to also maintain a BM25 index of the documents in the database directory, for
+            hybrid retrieval. Defaults to False.
 
     Returns:
         IndexingResult: The result of the indexing operation.
@@ -51,25 +221,23 @@ def update_index(docs: Union[List[Document], str],
             the docs parameter is not a list of Document objects or a valid path;
             the db_path does not exist;
             the db_type is not supported;
-            the embedding function or vector store cannot be created.
+            the embedding function or vector store cannot be created;
+            concurrent mode is requested without the embedding cache;
+            the manifest is requested without a path to the documents.
     """
+    logger = logging.getLogger(__name__)
+    start_time = time.perf_counter()
 
     # Load documents
+    path = None
     if isinstance(docs, str):
         path = docs
         if not os.path.exists(path):
             raise ValueError(f"Path {path} does not exist")
-        try:
-            docs = [
-                Document(
-                    page_content=open(os.path.join(path, f), "r", encoding="utf-8").read(),
-                    metadata=json.load(open(os.path.join(path, f"{f}.meta"), "r", encoding="utf-8"))
-                ) for f in os.listdir(path) if f.endswith(".txt")
-            ]
-        except Exception as e:
-            raise ValueError(f"Failed to load documents from {path}: {e}")
-    elif not all(isinstance(doc, Document) for doc in docs):
-        raise ValueError("docs must be a list of Document objects")
+        docs = _load_documents(path)
+    elif isinstance(docs, list):
+        if not all(isinstance(doc, Document) for doc in docs):
+            raise ValueError("docs must be a list of Document objects")
 
     # Create record manager
     os.makedirs(db_path, exist_ok=True)
@@ -84,33 +252,111 @@ def update_index(docs: Union[List[Document], str],
     # Create embeddings
     try:
         if isinstance(embedding_function, str):
-            embedding_function = OpenAIEmbeddings(model=embedding_function)
+            embedding_function = get_embeddings(
+                embedding_function,
+                db_path=db_path if cache_embeddings else None,
+                **({"openai_api_base": embedding_base_url} if embedding_base_url else {})
+            )
+        elif cache_embeddings and not isinstance(embedding_function, CachedEmbeddings):
+            embedding_function = CachedEmbeddings(
+                embedding_function,
+                db_path=db_path,
+                namespace=getattr(embedding_function, "model", type(embedding_function).__name__)
+            )
     except Exception as e:
         raise ValueError(f"Failed to create embedding function: {e}")
 
     # Create vector store
     try:
-        vector_store = getattr(vectorstores, db_type)(
+        vector_store = get_vector_store_class(db_type)(
             persist_directory=db_path,
             embedding_function=embedding_function
         )
     except Exception as e:
         raise ValueError(f"Failed to create vector store: {e}")
 
+    # Only index the sources that changed since the last run, and remove the sources that disappeared
+    manifest = None
+    num_removed = 0
+    lexical_index = BM25Index.load(db_path) if bm25 else None
+    if use_manifest:
+        if path is None:
+            raise ValueError("The manifest requires docs to be a path")
+        manifest = Manifest(
+            os.path.join(db_path, INDEX_MANIFEST_FILE),
+            params={"db_type": db_type, "namespace": record_namespace, "source_key": source_key}
+        )
+        hashes = hash_sources(_load_documents(path), source_key)
+        changed, removed = manifest.diff(hashes)
+        for source in removed:
+            keys = record_manager.list_keys(group_ids=[source])
+            if keys:
+                vector_store.delete(keys)
+                record_manager.delete_keys(keys)
+                num_removed += len(keys)
+            if lexical_index is not None:
+                lexical_index.remove_source(source)
+            manifest.remove(source)
+        docs = (doc for doc in _load_documents(path) if doc.metadata.get(source_key) in changed)
+        cleanup = "incremental"
+
+    # Index the publication date as a timestamp, so that retrieval can be filtered by date
+    docs = _normalize_metadata(docs)
+
+    if max_concurrency:
+        # Embed documents ahead of the writes, so that the vector store only hits the embedding cache
+        if not isinstance(embedding_function, CachedEmbeddings):
+            raise ValueError("Concurrent indexing requires the embedding cache")
+        docs = (
+            doc
+            for batch in _embed_batches(docs, embedding_function, batch_size, max_concurrency, max_retries, delay)
+            for doc in batch
+        )
+    if lexical_index is not None:
+        docs = _index_lexically(docs, lexical_index, cleanup, source_key)
+    stats = {"docs": 0, "tokens": 0}
+    model_name = getattr(embedding_function, "namespace", None) or getattr(embedding_function, "model", "")
+    docs = _measure(docs, stats, model_name)
+
     # Index documents
-    return index(
+    result = index(
         docs_source=docs,
         record_manager=record_manager,
         vector_store=vector_store,
+        batch_size=batch_size,
         cleanup=cleanup,
         source_id_key=source_key
     )
 
+    if lexical_index is not None:
+        lexical_index.save(db_path)
+    if manifest is not None:
+        result["num_deleted"] += num_removed
+        for source in changed:
+            manifest.update(source, hashes[source])
+        manifest.save()
+
+    elapsed = time.perf_counter() - start_time
+    INDEX_SECONDS.observe(elapsed)
+    for key in ("num_added", "num_updated", "num_skipped", "num_deleted"):
+        INDEX_RESULTS.inc(result[key], result=key[len("num_"):])
+    logger.info(f"Indexed {stats['docs']} document(s) ({stats['tokens']} tokens) in {elapsed:.2f}s: "
+                f"{stats['docs'] / elapsed:.1f} docs/s, {stats['tokens'] / elapsed:.1f} tokens/s.")
+
+    # Reclaim the rows of deleted documents in stores that only mark them as deleted
+    if result["num_deleted"] and isinstance(vector_store, LocalVectorStore):
+        vector_store.compact()
+
+    # Bump the index version so that answer caches built on the previous index are invalidated
+    if result["num_added"] or result["num_updated"] or result["num_deleted"]:
+        write_index_version(db_path)
+    return result
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Update index with given documents.")
     parser.add_argument("--docs", type=str, required=True,
-                        help="Path to the documents or a list of Document objects.")
+                        help="Path to the directory or packed .jsonl corpus containing the documents.")
     parser.add_argument("--db-path", type=str, required=True,
                         help="Path to the database.")
     parser.add_argument("--db-type", type=str, default="Chroma",
@@ -124,8 +370,24 @@ if __name__ == "__main__":
                              "Defaults \"text-embedding-3-small\".")
     parser.add_argument("--cleanup", type=str, default="full", choices=["incremental", "full", None],
                         help="Cleanup strategy to use when indexing. Defaults to \"full\".")
+    parser.add_argument("--no-embedding-cache", action="store_true",
+                        help="Disable the on-disk embedding cache in the database directory.")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of documents embedded and written at once. Defaults to 100.")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Embed batches with up to this many concurrent requests. Defaults to sequential.")
+    parser.add_argument("--max-retries", type=int, default=6,
+                        help="Maximum number of retries of a rate-limited embedding request. Defaults to 6.")
+    parser.add_argument("--embedding-base-url", type=str, default=None,
+                        help="Base URL of an OpenAI-compatible embeddings API, e.g. http://localhost:8001/v1 for "
+                             "the fake server of scripts/fake_embeddings_server.py in throughput runs.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only index the sources that changed since the last incremental run.")
+    parser.add_argument("--bm25", action="store_true",
+                        help="Also maintain a BM25 index of the documents for hybrid retrieval.")
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(levelname).4s] %(message)s")
 
     result = update_index(
         docs=args.docs,
@@ -134,6 +396,14 @@ if __name__ == "__main__":
         namespace=args.namespace,
         source_key=args.source,
         embedding_function=args.embedding,
-        cleanup=args.cleanup
+        cleanup=args.cleanup,
+        cache_embeddings=not args.no_embedding_cache,
+        batch_size=args.batch_size,
+        max_concurrency=args.max_concurrency,
+        max_retries=args.max_retries,
+        embedding_base_url=args.embedding_base_url,
+        use_manifest=args.incremental,
+        bm25=args.bm25
     )
     print(result)
+    logging.getLogger(__name__).info(f"Metrics:\n{REGISTRY.summary('indexer_')}")
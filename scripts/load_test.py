@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import httpx
+import numpy as np
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chatbot import ChatBot
+from server import create_app
+from utils.fakes import FakeChatModel, FakeEmbeddings
+from utils.vectorstore import LocalVectorStore
+
+WORDS = ("montréal québec gatineau sherbrooke hydro route pont budget école hôpital élection festival neige "
+         "transport santé logement emploi culture parc rivière conseil municipal").split()
+
+
+def _create_bot(db_path: str, num_docs: int, first_token_latency: float, token_latency: float,
+                embedding_latency: float) -> ChatBot:
+    rng = np.random.default_rng(0)
+    embeddings = FakeEmbeddings(latency=embedding_latency)
+    store = LocalVectorStore(persist_directory=db_path, embedding_function=embeddings)
+    store.add_texts(
+        [" ".join(rng.choice(WORDS, size=40)) for _ in range(num_docs)],
+        metadatas=[{"source": f"https://example.com/{i}"} for i in range(num_docs)]
+    )
+    return ChatBot(
+        model_name="gpt-3.5-turbo",
+        embeddings_model_name="fake",
+        db_type="LocalVectorStore",
+        db_path=db_path,
+        search_kwargs={"k": 5, "fetch_k": 20},
+        model=FakeChatModel(first_token_latency=first_token_latency, token_latency=token_latency),
+        embeddings=embeddings,
+        time_stages=True
+    )
+
+
+async def _run(app, requests: int, concurrency: int, stream: bool) -> Dict[str, float]:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    peak_threads = threading.active_count()
+    semaphore = asyncio.Semaphore(concurrency)
+    route = "/main/stream" if stream else "/main/invoke"
+
+    async def request(client: httpx.AsyncClient, i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(route, json={
+                "input": {"role": "user", "content": f"Quelles nouvelles de {WORDS[i % len(WORDS)]} ?"},
+                "config": {"configurable": {"session_id": f"session-{i}"}}
+            })
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def sample_threads() -> None:
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_threads())
+    transport = httpx.ASGITransport(app=app)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+        await asyncio.gather(*(request(client, i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "statuses": statuses,
+        "elapsed_s": elapsed,
+        "throughput_rps": requests / elapsed,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "peak_threads": peak_threads
+    }
+
+
+def load_test(requests: int = 200, concurrency: int = 50, stream: bool = False, num_docs: int = 1000,
+              first_token_latency: float = 0.2, token_latency: float = 0.01, embedding_latency: float = 0.05,
+              max_concurrency: int = 64) -> Dict[str, float]:
+    """
+    Measures the latency and throughput of the server under concurrent chats, in process and offline: the model and
+    the embeddings are fakes with a simulated latency, and the index is a local vector store of random documents.
+
+    Args:
+        requests (int): The total number of requests. Defaults to 200.
+        concurrency (int): The number of requests in flight at once. Defaults to 50.
+        stream (bool): Whether to request the streaming route instead of the invoke route. Defaults to False.
+        num_docs (int): The number of documents in the index. Defaults to 1000.
+        first_token_latency (float): The latency (in seconds) of the first token of the model. Defaults to 0.2.
+        token_latency (float): The latency (in seconds) of each next token of the model. Defaults to 0.01.
+        embedding_latency (float): The latency (in seconds) of an embedding request. Defaults to 0.05.
+        max_concurrency (int): The concurrency limit of the server. Defaults to 64.
+
+    Returns:
+        Dict[str, float]: The latency percentiles, throughput, peak number of threads and timings of the stages of
+            the chain.
+    """
+    with tempfile.TemporaryDirectory() as db_path:
+        bot = _create_bot(db_path, num_docs, first_token_latency, token_latency, embedding_latency)
+        app = create_app(bot, max_concurrency=max_concurrency)
+        results = asyncio.run(_run(app, requests, concurrency, stream))
+        results["stages"] = bot.timer.summary()
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the server with a fake model and embeddings.")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="Total number of requests. Defaults to 200.")
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="Number of requests in flight at once. Defaults to 50.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Request the streaming route instead of the invoke route.")
+    parser.add_argument("--num-docs", type=int, default=1000,
+                        help="Number of documents in the index. Defaults to 1000.")
+    parser.add_argument("--first-token-latency", type=float, default=0.2,
+                        help="Latency in seconds of the first token of the model. Defaults to 0.2.")
+    parser.add_argument("--token-latency", type=float, default=0.01,
+                        help="Latency in seconds of each next token of the model. Defaults to 0.01.")
+    parser.add_argument("--embedding-latency", type=float, default=0.05,
+                        help="Latency in seconds of an embedding request. Defaults to 0.05.")
+    parser.add_argument("--max-concurrency", type=int, default=64,
+                        help="Concurrency limit of the server. Defaults to 64.")
+
+    args = parser.parse_args()
+    results = load_test(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        stream=args.stream,
+        num_docs=args.num_docs,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        embedding_latency=args.embedding_latency,
+        max_concurrency=args.max_concurrency
+    )
+    print(json.dumps(results, indent=2))
@@ -1,33 +1,194 @@
-from fastapi import FastAPI
+import argparse
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from langserve import add_routes
+from pydantic import BaseModel, Field
 import uvicorn
 
 from chatbot import ChatBot
+from utils.concurrency import ConcurrencyLimitMiddleware
+from utils.filters import parse_filters
+from utils.metrics import REGISTRY
 
-if __name__ == "__main__":
-    app = FastAPI(
-        title="LangChain Server",
-        version="1.0",
-        description="",
-    )
+# Environment variable passing the settings of the chatbot to the worker processes
+SERVER_CONFIG_ENV = "HACKQC24_SERVER_CONFIG"
+
+
+class BulkRequest(BaseModel):
+    questions: List[str] = Field(..., description="Independent questions to answer.")
+    role: str = Field("user", description="Role of the author of the questions.")
+    max_concurrency: int = Field(8, ge=1, le=32, description="Maximum number of answers generated at once.")
+    filters: Optional[Dict[str, Any]] = Field(None, description="Metadata filters of the retrieved documents.")
 
-    bot = ChatBot(
+
+def create_bot(db_type: str = "Chroma", db_path: str = "./db", shared_history: bool = False) -> ChatBot:
+    """
+    Creates the chatbot served by the API.
+
+    Args:
+        db_type (str): The type of the vector store. Defaults to "Chroma".
+        db_path (str): The path to the database directory. Defaults to "./db".
+        shared_history (bool): Whether the conversations are read from and written to the history database on every
+            message, so that they can be shared by several worker processes. Defaults to False.
+
+    Returns:
+        ChatBot: The chatbot.
+    """
+    return ChatBot(
         model_name="gpt-3.5-turbo",
         embeddings_model_name="text-embedding-3-small",
-        db_type="Chroma",
-        db_path="./db",
+        db_type=db_type,
+        db_path=db_path,
         search_type="mmr",
         search_kwargs={
             "k": 5,
             "fetch_k": 50,
             "lambda_mult": 0.25
-        }
+        },
+        max_sessions=4096,
+        session_timeout=3600.0,
+        history_db_path=os.path.join(db_path, "history.sql"),
+        history_token_limit=2000,
+        time_stages=True,
+        shared_history=shared_history
+    )
+
+
+def create_worker_app() -> FastAPI:
+    """
+    Creates the application of a worker process, from the settings passed by the parent process in the environment.
+
+    Returns:
+        FastAPI: The application.
+    """
+    config = json.loads(os.environ.get(SERVER_CONFIG_ENV, "{}"))
+    reload_interval = config.pop("reload_interval", None)
+    return create_app(create_bot(**config), reload_interval=reload_interval)
+
+
+async def _watch_index(bot: ChatBot, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(bot.reload_index)
+
+
+def create_app(bot: ChatBot, max_concurrency: int = 64, max_waiting: int = 256, warm_up: bool = True,
+               reload_interval: Optional[float] = None) -> FastAPI:
+    """
+    Creates the API of a chatbot. The routes run the chain asynchronously, so that a single worker serves many
+    concurrent chats while they wait on the model, and the number of requests in flight is capped. The metrics of
+    the process are exposed in the Prometheus text format at /metrics, and /health answers as soon as the worker is
+    up, both outside of the concurrency limit. Each worker process has its own metrics, so /metrics reports those of
+    the worker that answered the scrape. The chatbot is warmed up on startup, before the server accepts connections.
+    Independent questions can be answered in bulk at /main/bulk, which streams the answers as newline-delimited JSON
+    as they are generated. The index version is polled in the background, and the vector store is reloaded without
+    interrupting requests when the indexer updates it. The sessions are saved on shutdown.
+
+    Args:
+        bot (ChatBot): The chatbot to serve.
+        max_concurrency (int): The maximum number of requests processed at once. Defaults to 64.
+        max_waiting (int): The maximum number of requests waiting for a slot before new ones are rejected with a
+            503. Defaults to 256.
+        warm_up (bool): Whether to build the chatbot and load its index on startup. Defaults to True.
+        reload_interval (Optional[float]): The interval in seconds between checks of the index version. Defaults to
+            None, for no reloads.
+
+    Returns:
+        FastAPI: The application.
+    """
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if warm_up:
+            await asyncio.to_thread(bot.warm_up)
+        watcher = asyncio.create_task(_watch_index(bot, reload_interval)) if reload_interval else None
+        yield
+        if watcher is not None:
+            watcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await watcher
+        # Save the sessions kept in memory, so that the conversations resume after a restart
+        await asyncio.to_thread(bot.sessions.flush)
+
+    app = FastAPI(
+        title="LangChain Server",
+        version="1.0",
+        description="",
+        lifespan=lifespan,
     )
+    app.add_middleware(ConcurrencyLimitMiddleware, max_concurrency=max_concurrency, max_waiting=max_waiting)
 
     add_routes(
         app,
         bot.get_main(),
         path="/main",
+        config_keys=["configurable"],
     )
 
-    uvicorn.run(app, host="localhost", port=8000)
+    # LangServe already serves /main/batch, which runs the whole chain on each input
+    @app.post("/main/bulk")
+    async def bulk(request: BulkRequest) -> StreamingResponse:
+        # Reject invalid filters before the response starts streaming
+        try:
+            parse_filters(request.filters)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        async def answers() -> AsyncIterator[str]:
+            async for index, answer in bot.abatch_responses(
+                    request.questions, role=request.role, max_concurrency=request.max_concurrency,
+                    return_exceptions=True, filters=request.filters
+            ):
+                result = {"error": str(answer)} if isinstance(answer, Exception) else {"output": answer}
+                yield json.dumps({"index": index, **result}, ensure_ascii=False) + "\n"
+
+        return StreamingResponse(answers(), media_type="application/x-ndjson")
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics() -> PlainTextResponse:
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/health")
+    def health() -> dict:
+        return {"status": "ok"}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the chatbot.")
+    parser.add_argument("--host", type=str, default="localhost",
+                        help="Host to bind to. Defaults to \"localhost\".")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port to bind to. Defaults to 8000.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes. Defaults to 1. Workers share the conversations through the "
+                             "history database, and the index through the page cache with a LocalVectorStore, "
+                             "whereas other stores are loaded by each worker. Each worker exposes its own "
+                             "metrics at /metrics.")
+    parser.add_argument("--db-type", type=str, default="Chroma",
+                        help="Type of the database. Defaults to \"Chroma\".")
+    parser.add_argument("--db-path", type=str, default="./db",
+                        help="Path to the database. Defaults to \"./db\".")
+    parser.add_argument("--reload-interval", type=float, default=10.0,
+                        help="Interval in seconds between checks for an updated index, 0 to never reload. "
+                             "Defaults to 10.")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # Each worker imports the application factory, so the settings are passed in the environment
+        os.environ[SERVER_CONFIG_ENV] = json.dumps({
+            "db_type": args.db_type,
+            "db_path": args.db_path,
+            "shared_history": True,
+            "reload_interval": args.reload_interval
+        })
+        uvicorn.run("server:create_worker_app", factory=True, host=args.host, port=args.port, workers=args.workers)
+    else:
+        bot = create_bot(db_type=args.db_type, db_path=args.db_path)
+        uvicorn.run(create_app(bot, reload_interval=args.reload_interval), host=args.host, port=args.port)
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from chatbot import ChatBot
+from utils.cache import write_index_version
+from utils.fakes import FakeChatModel, FakeEmbeddings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Adds documents to the store from another process, as the indexer does while the server is running
+ADD_TEXTS = """
+import sys
+import time
+from utils.cache import write_index_version
+from utils.fakes import FakeEmbeddings
+from utils.vectorstore import get_vector_store_class
+db_type, db_path, start, stop = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4])
+db = get_vector_store_class(db_type)(persist_directory=db_path, embedding_function=FakeEmbeddings())
+db.add_texts([f"document {i} about the budget" for i in range(start, stop)])
+if hasattr(db, "persist"):
+    db.persist()
+write_index_version(db_path)
+"""
+
+
+def _add_texts(db_type, db_path, start, stop):
+    env = {**os.environ, "PYTHONPATH": ROOT, "ANONYMIZED_TELEMETRY": "False"}
+    subprocess.run([sys.executable, "-c", ADD_TEXTS, db_type, db_path, str(start), str(stop)], env=env, check=True)
+
+
+def _search(db):
+    return {doc.page_content for doc in db.similarity_search("budget", k=10)}
+
+
+@pytest.fixture
+def bot_factory(tmp_path, monkeypatch):
+    monkeypatch.setenv("ANONYMIZED_TELEMETRY", "False")
+
+    def factory(db_type, **kwargs):
+        return ChatBot(model_name="gpt-3.5-turbo", embeddings_model_name="fake", db_type=db_type,
+                       db_path=str(tmp_path / "db"), search_type="similarity", model=FakeChatModel(),
+                       embeddings=FakeEmbeddings(), **kwargs)
+
+    return factory
+
+
+@pytest.mark.parametrize("db_type", ["Chroma", "LocalVectorStore"])
+def test_reload_serves_documents_added_by_another_process(bot_factory, db_type):
+    bot = bot_factory(db_type)
+    _add_texts(db_type, bot.db_path, 0, 3)
+    bot.warm_up()
+    assert len(_search(bot.db)) == 3
+
+    _add_texts(db_type, bot.db_path, 3, 5)
+    previous_db = bot.db
+    assert bot.reload_index()
+    # Requests in flight finish on the previous store
+    assert len(_search(previous_db)) == 3
+    assert len(_search(bot.db)) == 5
+    assert not bot.reload_index()
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_cache_only_serves_opening_questions(bot_factory, asynchronous):
+    bot = bot_factory("LocalVectorStore", cache_threshold=0.99)
+    bot.db.add_texts(["the budget of the city", "the new bridge"])
+
+    def ask(message, session_id):
+        if asynchronous:
+            return asyncio.run(bot.aget_response(message, session_id))
+        return bot.get_response(message, session_id)
+
+    answer = ask("what is the budget", "first")
+    assert ask("what is the budget", "second") == answer
+    assert (bot.cache.hits, len(bot.cache.answers)) == (1, 1)
+
+    # A follow-up question depends on the history of its session, and is neither served from nor stored in the cache
+    ask("what is the budget", "first")
+    ask("and the bridge", "first")
+    ask("and the bridge", "third")
+    assert (bot.cache.hits, len(bot.cache.answers)) == (1, 2)
+    assert len(bot.sessions.get("first").messages) == 6
+
+
+class _ListStore(VectorStore):
+    # A store re-ranking with maximal marginal relevance itself, without exposing the embeddings of its documents
+    def __init__(self, texts, embeddings):
+        self.texts = texts
+        self.vectors = np.asarray(embeddings.embed_documents(texts))
+        self.embedding_function = embeddings
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        return cls(texts, embedding)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        scores = self.vectors @ np.asarray(self.embedding_function.embed_query(query))
+        return [Document(page_content=self.texts[i]) for i in np.argsort(-scores)[:k]]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        indices = maximal_marginal_relevance(np.asarray(self.embedding_function.embed_query(query)), self.vectors,
+                                             k=k, lambda_mult=lambda_mult)
+        return [Document(page_content=self.texts[i]) for i in indices]
+
+
+def test_mmr_falls_back_to_the_store_search(bot_factory):
+    bot = bot_factory("LocalVectorStore", search_kwargs={"k": 2})
+    bot.search_type = "mmr"
+    store = _ListStore(["the budget", "the budget of the city", "the new bridge"], bot.embeddings)
+    docs = bot._build_retriever(store).invoke("budget")
+    assert [doc.page_content for doc in docs] == ["the budget", "the new bridge"]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_streaming_records_the_whole_answer(bot_factory, asynchronous):
+    bot = bot_factory("LocalVectorStore")
+    bot.db.add_texts(["the budget of the city"])
+
+    async def astream(message):
+        return [chunk async for chunk in bot.astream_response(message, "session")]
+
+    for message in ("what is the budget", "and the bridge"):
+        if asynchronous:
+            chunks = asyncio.run(astream(message))
+        else:
+            chunks = list(bot.stream_response(message, "session"))
+        # The answer is streamed token by token
+        assert len(chunks) == bot.model.num_tokens
+    messages = bot.sessions.get("session").messages
+    assert [type(message).__name__ for message in messages] == ["HumanMessage", "AIMessage"] * 2
+    assert messages[1].content == "".join(bot.get_response("what is the budget", "other"))
+    assert messages[3].content == "".join(chunks)
+
+
+class _CountingChatModel(FakeChatModel):
+    calls: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(messages[-1].content)
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(messages[-1].content)
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_batch_stops_generating_when_the_caller_stops(bot_factory, asynchronous):
+    bot = bot_factory("LocalVectorStore")
+    bot.db.add_texts(["the budget of the city"])
+    bot.model = _CountingChatModel(first_token_latency=0.05)
+    questions = [f"question {i}" for i in range(20)]
+
+    async def afirst():
+        answers = bot.abatch_responses(questions, max_concurrency=2)
+        first = await answers.__anext__()
+        await answers.aclose()
+        await asyncio.sleep(0.2)
+        return first
+
+    if asynchronous:
+        first = asyncio.run(afirst())
+    else:
+        answers = bot.batch_responses(questions, max_concurrency=2)
+        first = next(answers)
+        answers.close()
+        time.sleep(0.2)
+    assert first[1].startswith("user: question")
+    # Only the answers already being generated are finished
+    assert len(bot.model.calls) <= 4
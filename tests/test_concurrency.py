@@ -0,0 +1,33 @@
+import asyncio
+
+from utils.concurrency import ConcurrencyLimitMiddleware
+
+
+def test_metrics_are_served_when_the_worker_is_saturated():
+    async def run():
+        release = asyncio.Event()
+
+        async def app(scope, receive, send):
+            if scope["path"] == "/slow":
+                await release.wait()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        middleware = ConcurrencyLimitMiddleware(app, max_concurrency=1, max_waiting=0)
+
+        async def request(path):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await middleware({"type": "http", "path": path}, None, send)
+            return messages[0]["status"]
+
+        slow = asyncio.create_task(request("/slow"))
+        await asyncio.sleep(0)
+        statuses = [await asyncio.wait_for(request(path), 1) for path in ("/main/invoke", "/metrics", "/health")]
+        release.set()
+        return statuses, await slow
+
+    assert asyncio.run(run()) == ([503, 200, 200], 200)
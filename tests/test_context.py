@@ -0,0 +1,45 @@
+from langchain_core.documents import Document
+
+from utils.context import ContextPacker, merge_chunks
+
+TEXT = " ".join(f"phrase {i} du bulletin municipal." for i in range(40))
+
+
+def test_merge_chunks_joins_overlapping_and_contained_chunks():
+    first, second, third = TEXT[:400], TEXT[300:700], TEXT[650:]
+    # The third chunk only overlaps the second, which is merged last
+    assert merge_chunks([third, first, second]) == [(TEXT, 0)]
+    assert merge_chunks([TEXT[100:200], TEXT[:400]]) == [(TEXT[:400], 0)]
+    # Overlaps shorter than the minimum are not merged
+    assert merge_chunks([TEXT[:400], TEXT[390:700]], min_overlap=32) == [(TEXT[:400], 0), (TEXT[390:700], 1)]
+
+
+def _packer(token_budget):
+    packer = ContextPacker(token_budget=token_budget)
+    # Count characters deterministically, whether or not the tokenizer is available offline
+    packer.encoding = None
+    return packer
+
+
+def test_packer_merges_chunks_of_a_source_in_rank_order():
+    docs = [
+        Document(page_content=TEXT[300:700], metadata={"source": "https://example.com/a"}),
+        Document(page_content="Autre bulletin.", metadata={"source": "https://example.com/b"}),
+        Document(page_content=TEXT[:400], metadata={"source": "https://example.com/a"}),
+        Document(page_content="Autre bulletin.", metadata={"source": "https://example.com/b"}),
+    ]
+    assert _packer(10000).pack(docs) == (
+        f"{TEXT[:700]}\nSource: https://example.com/a\n\nAutre bulletin.\nSource: https://example.com/b"
+    )
+
+
+def test_packer_respects_the_token_budget():
+    docs = [Document(page_content=TEXT, metadata={"source": f"https://example.com/{i}"}) for i in range(3)]
+    packer = _packer(600)
+    context = packer.pack(docs)
+    blocks = context.split("\n\n")
+    # The first document fits, the second is truncated to the remaining budget, and the third is dropped
+    assert len(blocks) == 2 and blocks[0] == f"{TEXT}\nSource: https://example.com/0"
+    assert blocks[1].endswith("\nSource: https://example.com/1") and len(blocks[1]) < len(blocks[0])
+    assert sum(packer.count_tokens(block) + 1 for block in blocks) <= 600 + len(blocks)
+    assert _packer(0).pack(docs) == ""
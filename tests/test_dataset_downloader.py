@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from scripts.dataset_downloader import HostLimiter, create_session, download_resource, get_packages
+
+
+class _Resource:
+    def __init__(self, body: bytes, etag: str) -> None:
+        self.body = body
+        self.etag = etag
+        # Number of bytes sent before the connection is dropped, for the next full response only
+        self.fail_after = None
+        self.requests = []
+
+
+@pytest.fixture
+def server():
+    resource = _Resource(b"old content " * 100, '"v1"')
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            resource.requests.append(dict(self.headers))
+            if self.headers.get("If-None-Match") == resource.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            start = 0
+            range_header = self.headers.get("Range")
+            if range_header and self.headers.get("If-Range", resource.etag) == resource.etag:
+                start = int(range_header.split("=")[1].rstrip("-"))
+            body = resource.body[start:]
+            self.send_response(206 if start else 200)
+            self.send_header("ETag", resource.etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if resource.fail_after is not None:
+                self.wfile.write(body[:resource.fail_after])
+                resource.fail_after = None
+                self.wfile.flush()
+                self.connection.close()
+                return
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}/resource.csv", resource
+    httpd.shutdown()
+
+
+def _read_json(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _download(url: str, path: str, max_retries: int = 1) -> bool:
+    # Small chunks, so that the bytes received before a failure are written to the partial file
+    return download_resource(create_session(), HostLimiter(4), url, path, "test", "test",
+                             max_retries=max_retries, delay=0, chunk_size=100)
+
+
+def test_download_then_not_modified(server, tmp_path):
+    url, resource = server
+    path = str(tmp_path / "resource.csv")
+    assert _download(url, path)
+    assert open(path, "rb").read() == resource.body
+    assert _download(url, path)
+    assert resource.requests[-1]["If-None-Match"] == '"v1"'
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_failed_update_is_not_mistaken_for_up_to_date(server, tmp_path):
+    url, resource = server
+    path = str(tmp_path / "resource.csv")
+    assert _download(url, path)
+
+    # The resource changes, and its download fails halfway
+    resource.body, resource.etag = b"new content " * 100, '"v2"'
+    resource.fail_after = 300
+    assert not _download(url, path)
+    assert os.path.exists(f"{path}.part")
+    assert _read_json(f"{path}.http.json")["etag"] == '"v1"'
+
+    # The retry resumes the partial download rather than sending the new ETag as a validator
+    assert _download(url, path)
+    assert "If-None-Match" not in resource.requests[-1]
+    assert resource.requests[-1]["Range"] == "bytes=300-"
+    assert open(path, "rb").read() == resource.body
+    assert _read_json(f"{path}.http.json")["etag"] == '"v2"'
+    assert not os.path.exists(f"{path}.part")
+    assert not os.path.exists(f"{path}.part.http.json")
+
+
+def test_resources_with_the_same_file_name_are_kept_apart(tmp_path):
+    bodies = {f"/resource-{i}.csv": f"resource {i}\n".encode("utf-8") * 50 for i in range(3)}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            if self.path.startswith("/api/package_show"):
+                base = f"http://127.0.0.1:{self.server.server_port}"
+                body = json.dumps({"success": True, "result": {"title": "Finances", "resources": [
+                    {"id": "a", "name": "Budget: 2024", "format": "CSV", "url": f"{base}/resource-0.csv"},
+                    {"id": "b", "name": "Budget 2024", "format": "CSV", "url": f"{base}/resource-1.csv"},
+                    {"id": "c", "name": "budget 2024", "format": "CSV", "url": f"{base}/resource-2.csv"},
+                ]}}).encode("utf-8")
+            else:
+                body = bodies[self.path]
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        get_packages(output_dir=str(tmp_path), package_list=["finances"], max_retries=1, delay=0,
+                     base_url=f"http://127.0.0.1:{httpd.server_port}/api/", workers=4, chunk_size=10)
+    finally:
+        httpd.shutdown()
+
+    package_dir = tmp_path / "datasets" / "Finances"
+    contents = sorted(path.read_bytes() for path in package_dir.iterdir() if path.suffix == ".csv")
+    assert contents == sorted(bodies.values())
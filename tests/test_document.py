@@ -0,0 +1,44 @@
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+from utils.document import PACKED_INDEX_EXTENSION, PackedCorpus, get_documents, save_documents
+
+DOCS = [
+    Document(page_content=f"Texte {i} avec des accents: é à ç\nsur deux lignes",
+             metadata={"source": f"bulletin-{i % 2}.html", "rank": i})
+    for i in range(5)
+]
+
+
+@pytest.mark.parametrize("name", ["corpus.jsonl", "corpus"])
+def test_documents_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    # Documents are written as they are generated
+    save_documents(path, (doc for doc in DOCS))
+    docs = sorted(get_documents(path), key=lambda doc: doc.metadata["rank"])
+    assert [(doc.page_content, doc.metadata) for doc in docs] == [(doc.page_content, doc.metadata) for doc in DOCS]
+
+
+def test_packed_corpus_reads_documents_by_id(tmp_path):
+    path = str(tmp_path / "corpus.jsonl")
+    save_documents(path, DOCS)
+    assert sorted(os.listdir(tmp_path)) == ["corpus.jsonl", f"corpus.jsonl{PACKED_INDEX_EXTENSION}"]
+    with PackedCorpus(path) as corpus:
+        assert len(corpus) == 5
+        assert corpus.ids() == [f"bulletin-{i % 2}.{i}" for i in range(5)]
+        # Records are read at their offset, in any order
+        for i in (4, 0, 2):
+            doc = corpus.get(f"bulletin-{i % 2}.{i}")
+            assert doc.page_content == DOCS[i].page_content and doc.metadata == DOCS[i].metadata
+        assert "bulletin-0.0" in corpus and "bulletin-1.0" not in corpus
+        with pytest.raises(KeyError):
+            corpus.get("bulletin-1.0")
+
+
+def test_empty_packed_corpus(tmp_path):
+    path = str(tmp_path / "corpus.jsonl")
+    save_documents(path, [])
+    with PackedCorpus(path) as corpus:
+        assert len(corpus) == 0 and list(corpus) == []
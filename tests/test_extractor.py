@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+import sys
+
+import pytest
+
+from scripts.extractor import extract_datasets, extract_resource
+
+
+def _write_package(root, package: str) -> str:
+    package_dir = os.path.join(root, "datasets", package)
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, "Budget.csv"), "w", encoding="utf-8") as file:
+        file.write("poste;montant\n" + "".join(f"poste {i};{i * 100}\n" for i in range(5)))
+    with open(os.path.join(package_dir, "Budget.json"), "w", encoding="utf-8") as file:
+        json.dump([{"poste": f"poste {i}", "montant": i * 100} for i in range(5)], file)
+    return package_dir
+
+
+def test_resources_with_the_same_name_do_not_collide(tmp_path):
+    _write_package(str(tmp_path), "Finances")
+    output = str(tmp_path / "documents")
+    summary = extract_datasets(str(tmp_path), output, workers=2, rows_per_document=2)
+    texts = [name for name in os.listdir(output) if name.endswith(".txt")]
+    assert summary == {"resources": 2, "failed": 0, "documents": 6}
+    assert len(texts) == 6
+    sources = set()
+    for name in texts:
+        with open(os.path.join(output, f"{name}.meta"), "r", encoding="utf-8") as file:
+            sources.add(json.load(file)["source"])
+    assert len(sources) == 2
+
+
+def test_json_fallback_warns(tmp_path, monkeypatch, caplog):
+    package_dir = _write_package(str(tmp_path), "Finances")
+    # Simulate a missing ijson
+    monkeypatch.setitem(sys.modules, "ijson", None)
+    with caplog.at_level(logging.WARNING):
+        docs = list(extract_resource(os.path.join(package_dir, "Budget.json"), "Finances", rows_per_document=5))
+    assert len(docs) == 1
+    assert "montant: 400" in docs[0].page_content
+    assert "ijson is not installed" in caplog.text
+
+
+@pytest.mark.parametrize("streamed", [True, False])
+def test_nested_records_are_extracted_row_by_row(tmp_path, monkeypatch, streamed):
+    path = str(tmp_path / "Budget.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"help": "https://example.com/api", "success": True, "result": {
+            "fields": [{"id": "poste", "type": "text"}, {"id": "montant", "type": "int"}],
+            "records": [{"poste": f"poste {i}", "montant": i * 100, "tags": [{"name": "a"}]} for i in range(5)],
+            "total": 5
+        }}, file)
+    if streamed:
+        pytest.importorskip("ijson")
+        # The file must never be loaded at once
+        monkeypatch.setattr(json, "load", None)
+    else:
+        monkeypatch.setitem(sys.modules, "ijson", None)
+    docs = list(extract_resource(path, "Finances", rows_per_document=2))
+    assert [(doc.metadata["table"], doc.metadata["rows"]) for doc in docs] == [
+        ("result.fields", "1-2"), ("result.records", "1-2"), ("result.records", "3-4"), ("result.records", "5-5")
+    ]
+    assert "poste: poste 4" in docs[-1].page_content and "montant: 400" in docs[-1].page_content
+
+
+def test_geojson_features_are_rows(tmp_path):
+    path = str(tmp_path / "Parcs.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-73.5, 45.5]},
+             "properties": {"nom": f"parc {i}"}} for i in range(3)
+        ]}, file)
+    docs = list(extract_resource(path, "Parcs", rows_per_document=5))
+    assert len(docs) == 1 and docs[0].metadata["table"] == "features"
+    assert "nom: parc 2" in docs[0].page_content and "coordinates" not in docs[0].page_content
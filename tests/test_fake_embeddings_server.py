@@ -0,0 +1,28 @@
+import numpy as np
+import openai
+from fastapi.testclient import TestClient
+
+from scripts.fake_embeddings_server import create_app
+from utils.fakes import FakeEmbeddings
+
+
+def test_serves_the_fake_embeddings_to_the_openai_client():
+    with TestClient(create_app(dim=64)) as http_client:
+        client = openai.OpenAI(api_key="fake", base_url="http://testserver/v1", http_client=http_client)
+        # The client requests base64 embeddings by default
+        response = client.embeddings.create(input=["the budget of the city", "the new bridge"],
+                                            model="text-embedding-3-small")
+        expected = FakeEmbeddings(dim=64).embed_documents(["the budget of the city", "the new bridge"])
+        assert [data.index for data in response.data] == [0, 1]
+        assert np.allclose([data.embedding for data in response.data], expected)
+
+        response = client.embeddings.create(input=[[10, 20, 30], [10, 20]], model="text-embedding-3-small",
+                                            encoding_format="float", dimensions=8)
+        assert [len(data.embedding) for data in response.data] == [8, 8]
+        assert response.usage.total_tokens == 5
+
+
+def test_rejects_invalid_requests():
+    with TestClient(create_app()) as client:
+        assert client.post("/embeddings", json={"input": ["budget"]}).status_code == 422
+        assert client.post("/embeddings", json={"input": {"text": "budget"}, "model": "fake"}).status_code == 422
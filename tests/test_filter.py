@@ -0,0 +1,45 @@
+import random
+
+from langchain_core.documents import Document
+
+from scripts.filter import NearDuplicateFilter, filter_content, normalize_text, simhash
+
+BULLETIN = ("La Ville de Montréal annonce la fermeture du pont Jacques-Cartier pour des travaux d'entretien majeurs "
+            "prévus entre le 12 et le 15 avril, avec des détours balisés par les rues avoisinantes et un service de "
+            "navettes gratuites offert aux usagers du transport collectif pendant toute la durée du chantier.")
+
+
+def test_simhash_is_close_for_near_duplicates():
+    fingerprint = simhash(BULLETIN)
+    assert simhash(BULLETIN.upper()) == fingerprint
+    assert (simhash(BULLETIN.replace("15 avril", "16 avril")) ^ fingerprint).bit_count() <= 8
+    assert (simhash("Le festival de neige de Québec accueille ses premiers visiteurs ce samedi.")
+            ^ fingerprint).bit_count() > 8
+
+
+def test_near_duplicate_filter_finds_all_pairs_within_max_distance():
+    rng = random.Random(0)
+    duplicates = NearDuplicateFilter(max_distance=3)
+    seen = []
+    for _ in range(2000):
+        if seen and rng.random() < 0.5:
+            # Flip up to 5 random bits of a fingerprint seen before
+            fingerprint = rng.choice(seen)
+            for bit in rng.sample(range(64), rng.randint(0, 5)):
+                fingerprint ^= 1 << bit
+        else:
+            fingerprint = rng.getrandbits(64)
+        expected = any((fingerprint ^ other).bit_count() <= 3 for other in seen)
+        assert duplicates.is_duplicate(fingerprint) == expected
+        if not expected:
+            seen.append(fingerprint)
+
+
+def test_filter_content_drops_near_duplicates_and_normalizes():
+    docs = [
+        Document(page_content=BULLETIN),
+        Document(page_content="  Le festival de neige ouvre ce samedi ,au parc.  "),
+        Document(page_content=BULLETIN.replace("15 avril", "16 avril")),
+    ]
+    contents = [doc.page_content for doc in filter_content(docs, dedupe=True, max_distance=8, batch_size=2)]
+    assert contents == [normalize_text(BULLETIN), "Le festival de neige ouvre ce samedi, au parc."]
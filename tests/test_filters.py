@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from utils.filters import SECONDS_PER_DAY, matches, normalize_metadata, parse_date, parse_filters, to_chroma_where
+
+JANUARY = 1704067200.0  # 2024-01-01T00:00:00Z
+FEBRUARY = 1706745600.0  # 2024-02-01T00:00:00Z
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-01-01", JANUARY),
+    ("2024-01-01T00:00:00Z", JANUARY),
+    ("2024-01-01T01:00:00+01:00", JANUARY),
+    ("Mon, 01 Jan 2024 00:00:00 GMT", JANUARY),
+    (JANUARY, JANUARY),
+    ("not a date", None),
+    ("", None),
+    (True, None),
+    (None, None),
+])
+def test_parse_date(value, expected):
+    assert parse_date(value) == expected
+
+
+def test_normalize_metadata_uses_the_preferred_date():
+    assert normalize_metadata({"modified": "2024-02-01", "published": "2024-01-01"})["timestamp"] == JANUARY
+    assert normalize_metadata({"date": "unknown", "modified": "2024-02-01"})["timestamp"] == FEBRUARY
+    assert normalize_metadata({"source": "a"}) == {"source": "a"}
+
+
+def test_parse_filters():
+    parsed = parse_filters({"after": "2024-01-01", "before": "2024-02-01", "source": "a", "region": ["b", "c"],
+                            "package": None})
+    assert parsed == {"after": JANUARY, "before": FEBRUARY, "source": ["a"], "region": ["b", "c"]}
+    assert parse_filters(parsed) == parsed
+    assert parse_filters(None) == {}
+
+
+def test_max_age_days_keeps_the_narrowest_bound():
+    now = time.time()
+    assert parse_filters({"after": "2024-01-01", "max_age_days": 1})["after"] >= now - SECONDS_PER_DAY - 1
+    assert parse_filters({"max_age_days": 100000, "after": "2024-01-01"})["after"] == JANUARY
+
+
+@pytest.mark.parametrize("filters", [
+    {"after": "not a date"}, {"colour": "blue"}, {"region": 5}, {"source": ["a", 5]}, {"max_age_days": "a week"},
+    {"max_age_days": [7]}, {"max_age_days": True}
+])
+def test_parse_filters_rejects_invalid_filters(filters):
+    with pytest.raises(ValueError):
+        parse_filters(filters)
+
+
+def test_matches():
+    filters = parse_filters({"after": "2024-01-01", "before": "2024-02-01", "region": ["Montréal", "Québec"]})
+    assert matches({"timestamp": JANUARY, "region": "Québec"}, filters)
+    assert not matches({"timestamp": FEBRUARY, "region": "Québec"}, filters)
+    assert not matches({"timestamp": JANUARY, "region": "Gatineau"}, filters)
+    # Documents without a date never pass a date filter
+    assert not matches({"region": "Québec"}, filters)
+    assert matches({}, {})
+
+
+def test_to_chroma_where():
+    assert to_chroma_where({}) is None
+    assert to_chroma_where({"source": ["a"]}) == {"source": {"$in": ["a"]}}
+    assert to_chroma_where(parse_filters({"after": "2024-01-01", "region": "b"})) == {
+        "$and": [{"timestamp": {"$gte": JANUARY}}, {"region": {"$in": ["b"]}}]
+    }
@@ -0,0 +1,178 @@
+import sqlite3
+import threading
+
+import pytest
+import tiktoken
+from langchain_core.messages import HumanMessage
+
+from utils.history import MessageHistory, SessionHistoryStore
+
+
+def test_write_through_keeps_messages_added_concurrently(tmp_path):
+    db_path = str(tmp_path / "history.db")
+    # One store per worker process, each with its own lock
+    stores = [SessionHistoryStore(db_path=db_path, write_through=True, message_limit=None) for _ in range(4)]
+
+    def add_messages(worker, store):
+        for i in range(25):
+            store.add_message("session", HumanMessage(content=f"{worker}-{i}"))
+
+    threads = [threading.Thread(target=add_messages, args=(worker, store)) for worker, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    messages = [message.content for message in stores[0].get("session").messages]
+    assert sorted(messages) == sorted(f"{worker}-{i}" for worker in range(4) for i in range(25))
+    # Each worker sees its own messages in order
+    assert [message for message in messages if message.startswith("0-")] == [f"0-{i}" for i in range(25)]
+
+
+class _WordEncoding:
+    # Offline stand-in for the tiktoken encoding, counting one token per word
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model_name: _WordEncoding())
+
+
+def test_token_window_keeps_the_latest_messages(word_tokens):
+    history = MessageHistory(message_limit=None, token_limit=20)
+    for i in range(5):
+        history.add_message(HumanMessage(content=f"message {i} of the conversation"))
+    # Each message is 5 words and 4 tokens of overhead
+    assert [message.content for message in history.messages] == [f"message {i} of the conversation" for i in (3, 4)]
+    assert history.token_count == 18
+    # The latest message is kept even if it alone exceeds the budget
+    evicted = history.add_message(HumanMessage(content="word " * 30))
+    assert len(evicted) == 2 and len(history.messages) == 1
+
+
+def test_evicted_messages_are_summarized(word_tokens):
+    calls = []
+
+    def summarizer(summary, messages):
+        calls.append((summary, [message.content for message in messages]))
+        return f"{summary}+{len(messages)}"
+
+    history = MessageHistory(message_limit=2, summarizer=summarizer)
+    for i in range(4):
+        history.add_message(HumanMessage(content=str(i)))
+    assert calls == [("", ["0"]), ("+1", ["1"])]
+    assert [message.content for message in history.get_messages()] == [
+        "Summary of the earlier conversation: +1+1", "2", "3"
+    ]
+
+
+@pytest.mark.parametrize("write_through", [False, True])
+def test_sessions_are_summarized_outside_the_lock(tmp_path, write_through):
+    db_path = str(tmp_path / "history.db")
+    other = SessionHistoryStore(db_path=db_path, write_through=True)
+    store = None
+    blocked = []
+
+    def summarizer(summary, messages):
+        # Other sessions, in this process and in others, can be updated while the model summarizes
+        for target in (store, other):
+            thread = threading.Thread(target=target.add_message, args=("other", HumanMessage(content="hello")))
+            thread.start()
+            thread.join(timeout=5)
+            blocked.append(thread.is_alive())
+        return f"summary of {len(messages)}"
+
+    store = SessionHistoryStore(db_path=db_path, write_through=write_through, message_limit=1,
+                                summarizer=summarizer)
+    store.add_message("session", HumanMessage(content="first"))
+    store.add_message("session", HumanMessage(content="second"))
+    assert blocked == [False, False]
+    store.flush()
+    history = SessionHistoryStore(db_path=db_path, write_through=True).get("session")
+    assert history.summary == "summary of 1"
+    assert [message.content for message in history.messages] == ["second"]
+
+
+def test_summary_changed_during_summarization_is_summarized_again(tmp_path):
+    store = None
+    calls = []
+
+    def summarizer(summary, messages):
+        calls.append((summary, [message.content for message in messages]))
+        if len(calls) == 1:
+            # Another worker evicts and summarizes a message of the same session meanwhile
+            store.add_message("session", HumanMessage(content="third"))
+        return f"{summary}+{messages[0].content}"
+
+    store = SessionHistoryStore(db_path=str(tmp_path / "history.db"), write_through=True, message_limit=1,
+                                summarizer=summarizer)
+    store.add_message("session", HumanMessage(content="first"))
+    store.add_message("session", HumanMessage(content="second"))
+    assert calls == [("", ["first"]), ("", ["second"]), ("+second", ["first"])]
+    assert store.get("session").summary == "+second+first"
+
+
+def test_reading_a_session_does_not_trim_it(tmp_path):
+    db_path = str(tmp_path / "history.db")
+    store = SessionHistoryStore(db_path=db_path, write_through=True, message_limit=10)
+    for i in range(5):
+        store.add_message("session", HumanMessage(content=str(i)))
+
+    def summarizer(summary, messages):
+        raise AssertionError("A read must not summarize")
+
+    store = SessionHistoryStore(db_path=db_path, write_through=True, message_limit=2, summarizer=summarizer)
+    assert len(store.get("session").messages) == 5
+
+
+def _contents(store, session_id):
+    return [message.content for message in store.get(session_id).messages]
+
+
+def test_sessions_are_isolated():
+    store = SessionHistoryStore()
+    store.add_message("a", HumanMessage(content="hello from a"))
+    store.add_message("b", HumanMessage(content="hello from b"))
+    assert _contents(store, "a") == ["hello from a"]
+    assert _contents(store, "b") == ["hello from b"]
+    store.clear("a")
+    assert _contents(store, "a") == [] and _contents(store, "b") == ["hello from b"]
+
+
+def test_sessions_spill_to_the_database_and_reload(tmp_path):
+    db_path = str(tmp_path / "history.db")
+    store = SessionHistoryStore(db_path=db_path, max_sessions=2)
+    for session_id in "abc":
+        store.add_message(session_id, HumanMessage(content=f"hello from {session_id}"))
+    # The least recently used session was written to the database when the third one was opened
+    assert len(store) == 2 and "a" not in store.sessions
+    assert _contents(store, "a") == ["hello from a"]
+    store.add_message("a", HumanMessage(content="again"))
+    store.flush()
+    restarted = SessionHistoryStore(db_path=db_path, max_sessions=2)
+    assert {session_id: _contents(restarted, session_id) for session_id in "abc"} == {
+        "a": ["hello from a", "again"], "b": ["hello from b"], "c": ["hello from c"]
+    }
+
+
+def test_connections_are_closed(tmp_path, monkeypatch):
+    store = SessionHistoryStore(db_path=str(tmp_path / "history.db"), max_sessions=1)
+    connections = []
+    connect = store._connect
+
+    def tracked_connect():
+        connections.append(connect())
+        return connections[-1]
+
+    monkeypatch.setattr(store, "_connect", tracked_connect)
+    for session_id in "abc":
+        store.add_message(session_id, HumanMessage(content="hello"))
+    store.get("a")
+    store.flush()
+    store.clear("b")
+    assert connections
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
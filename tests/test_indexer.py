@@ -0,0 +1,36 @@
+import json
+import os
+
+from scripts.indexer import INDEX_MANIFEST_FILE, clear_index, update_index
+from utils.cache import read_index_version
+from utils.fakes import FakeEmbeddings
+from utils.lexical import BM25Index
+
+
+def _write_docs(root, texts):
+    os.makedirs(root, exist_ok=True)
+    for name, text in texts.items():
+        with open(os.path.join(root, f"{name}.txt"), "w", encoding="utf-8") as file:
+            file.write(text)
+        with open(os.path.join(root, f"{name}.txt.meta"), "w", encoding="utf-8") as file:
+            json.dump({"source": f"https://example.com/{name}"}, file)
+
+
+def test_clear_index_clears_the_bm25_index_and_the_manifest(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "unused")
+    db_path = str(tmp_path / "db")
+    docs = str(tmp_path / "docs")
+    _write_docs(docs, {"budget": "Le budget de la ville", "pont": "Le nouveau pont"})
+    kwargs = {"db_path": db_path, "db_type": "LocalVectorStore", "embedding_function": FakeEmbeddings(),
+              "bm25": True, "use_manifest": True}
+    assert update_index(docs, **kwargs)["num_added"] == 2
+    assert len(BM25Index.load(db_path)) == 2
+    version = read_index_version(db_path)
+
+    clear_index(db_path, db_type="LocalVectorStore")
+    assert len(BM25Index.load(db_path)) == 0
+    assert not os.path.exists(os.path.join(db_path, INDEX_MANIFEST_FILE))
+    assert read_index_version(db_path) != version
+    # The unchanged documents are indexed again
+    assert update_index(docs, **kwargs)["num_added"] == 2
+    assert [doc.page_content for doc, _ in BM25Index.load(db_path).search("budget")] == ["Le budget de la ville"]
@@ -0,0 +1,34 @@
+from langchain_core.documents import Document
+
+from utils.filters import matches, normalize_metadata, parse_filters
+from utils.lexical import BM25Index
+
+
+def _index():
+    index = BM25Index()
+    for i, region in enumerate(["Montréal", "Québec", "Montréal", "Gatineau"]):
+        metadata = normalize_metadata({"source": f"https://example.com/{i}", "region": region,
+                                       "date": f"2024-0{i + 1}-15"})
+        index.add(Document(page_content=f"budget de la ville {i} " + "budget " * i, metadata=metadata))
+    index.add(Document(page_content="festival de neige", metadata={"source": "https://example.com/festival"}))
+    return index
+
+
+def test_search_ranks_by_bm25():
+    sources = [doc.metadata["source"] for doc, _ in _index().search("budget", k=3)]
+    assert sources == ["https://example.com/3", "https://example.com/2", "https://example.com/1"]
+
+
+def test_predicate_is_applied_once_per_matching_document():
+    index = _index()
+    filters = parse_filters({"region": "Montréal", "before": "2024-02-01"})
+    calls = []
+
+    def predicate(metadata):
+        calls.append(metadata["source"])
+        return matches(metadata, filters)
+
+    results = index.search("budget ville", k=4, predicate=predicate)
+    assert [doc.metadata["source"] for doc, _ in results] == ["https://example.com/0"]
+    # The documents without the terms of the query are never checked, and the others only once
+    assert sorted(calls) == [f"https://example.com/{i}" for i in range(4)]
@@ -0,0 +1,73 @@
+import json
+import os
+
+from langchain_core.documents import Document
+
+from utils.manifest import MANIFEST_FILE, Manifest, hash_sources, run_incremental
+
+
+def _write(root, name, text):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, f"{name}.txt"), "w", encoding="utf-8") as file:
+        file.write(text)
+    with open(os.path.join(root, f"{name}.txt.meta"), "w", encoding="utf-8") as file:
+        json.dump({"source": f"{name}.html"}, file)
+
+
+def _upper(docs):
+    for doc in docs:
+        yield Document(page_content=doc.page_content.upper(), metadata=doc.metadata)
+
+
+def _outputs(path):
+    outputs = {}
+    for name in os.listdir(path):
+        if name.endswith(".txt"):
+            with open(os.path.join(path, name), "r", encoding="utf-8") as file:
+                outputs[name] = file.read()
+    return outputs
+
+
+def test_hash_sources_ignores_the_order_of_the_documents():
+    docs = [Document(page_content=str(i), metadata={"source": "a"}) for i in range(3)]
+    assert hash_sources(docs) == hash_sources(docs[::-1])
+    assert hash_sources(docs) != hash_sources(docs[:2])
+
+
+def test_manifest_detects_added_changed_and_removed_sources(tmp_path):
+    path = str(tmp_path / MANIFEST_FILE)
+    manifest = Manifest(path, {"size": 1})
+    for source in ("kept", "changed", "removed"):
+        manifest.update(source, f"{source}-v1", [f"{source}.0.txt"])
+    manifest.save()
+
+    manifest = Manifest(path, {"size": 1})
+    changed, removed = manifest.diff({"kept": "kept-v1", "changed": "changed-v2", "added": "added-v1"})
+    assert (changed, removed) == ({"changed", "added"}, {"removed"})
+    assert manifest.remove("removed") == ["removed.0.txt"]
+    # Other parameters invalidate every source
+    assert Manifest(path, {"size": 2}).diff({"kept": "kept-v1"}) == ({"kept"}, {"changed", "removed"})
+
+
+def test_run_incremental_only_processes_changed_sources(tmp_path):
+    input_path, output_path = str(tmp_path / "input"), str(tmp_path / "output")
+    for name in ("kept", "changed", "removed"):
+        _write(input_path, name, f"{name} v1")
+    assert run_incremental(input_path, output_path, _upper, {"case": "upper"}) == {
+        "changed": 3, "removed": 0, "unchanged": 0
+    }
+    kept = [name for name in _outputs(output_path) if name.startswith("kept.")]
+    mtime = os.stat(os.path.join(output_path, kept[0])).st_mtime_ns
+
+    _write(input_path, "changed", "changed v2")
+    _write(input_path, "added", "added v1")
+    for name in ("removed.txt", "removed.txt.meta"):
+        os.remove(os.path.join(input_path, name))
+    processed = []
+    assert run_incremental(input_path, output_path, lambda docs: _upper(processed.append(doc) or doc for doc in docs),
+                           {"case": "upper"}) == {"changed": 2, "removed": 1, "unchanged": 1}
+
+    assert sorted(doc.metadata["source"] for doc in processed) == ["added.html", "changed.html"]
+    assert sorted(_outputs(output_path).values()) == ["ADDED V1", "CHANGED V2", "KEPT V1"]
+    assert os.stat(os.path.join(output_path, kept[0])).st_mtime_ns == mtime
+    assert not any(name.startswith("removed.") for name in os.listdir(output_path))
@@ -0,0 +1,32 @@
+from langchain_core.documents import Document
+
+from scripts.filter import filter_content
+from utils.parallel import map_batches
+
+
+def test_map_batches_yields_the_results_in_order():
+    for workers in (1, 2):
+        assert list(map_batches(sum, range(100), batch_size=7, workers=workers)) == \
+            [sum(range(start, min(start + 7, 100))) for start in range(0, 100, 7)]
+    assert list(map_batches(sum, [], batch_size=7, workers=2)) == []
+
+
+def test_map_batches_reads_the_items_lazily():
+    consumed = []
+
+    def items():
+        for item in range(1000):
+            consumed.append(item)
+            yield item
+
+    results = map_batches(len, items(), batch_size=10, workers=2)
+    assert next(results) == 10
+    # At most two batches per worker are in flight
+    assert len(consumed) <= 10 * 4 + 1
+    results.close()
+
+
+def test_filter_content_with_workers_keeps_the_order():
+    docs = [Document(page_content=f"document  {i} ,  normalized") for i in range(50)]
+    assert [doc.page_content for doc in filter_content(docs, workers=2, batch_size=4)] == \
+        [f"document {i}, normalized" for i in range(50)]
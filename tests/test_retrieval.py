@@ -0,0 +1,36 @@
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance as reference
+
+from utils.retrieval import maximal_marginal_relevance
+
+
+def test_mmr_matches_the_reference_implementation():
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(3, 16))
+    candidates = rng.normal(size=(3, 10, 16))
+    mask = np.ones((3, 10), dtype=bool)
+    for lambda_mult in (0.0, 0.5, 1.0):
+        selected = maximal_marginal_relevance(queries, candidates, mask, k=4, lambda_mult=lambda_mult)
+        for query, query_candidates, indices in zip(queries, candidates, selected):
+            assert indices.tolist() == reference(query, query_candidates, k=4, lambda_mult=lambda_mult)
+
+
+def test_mmr_skips_padding():
+    rng = np.random.default_rng(1)
+    queries = rng.normal(size=(2, 8))
+    candidates = rng.normal(size=(2, 5, 8))
+    mask = np.array([[True] * 5, [True, True, False, False, False]])
+    selected = maximal_marginal_relevance(queries, candidates, mask, k=4)
+    assert selected.shape == (2, 4)
+    assert sorted(selected[0].tolist()) == sorted(set(selected[0].tolist())) and -1 not in selected[0]
+    assert sorted(selected[1, :2].tolist()) == [0, 1]
+    assert selected[1, 2:].tolist() == [-1, -1]
+
+
+def test_mmr_prefers_diverse_candidates():
+    queries = np.array([[1.0, 1.0, 0.0]])
+    # Two copies of the most relevant candidate, and a less relevant but different one
+    candidates = np.array([[[1.0, 0.9, 0.0], [1.0, 0.9, 0.0], [0.0, 1.0, 0.2]]])
+    mask = np.ones((1, 3), dtype=bool)
+    assert maximal_marginal_relevance(queries, candidates, mask, k=2, lambda_mult=0.5).tolist() == [[0, 2]]
+    assert maximal_marginal_relevance(queries, candidates, mask, k=2, lambda_mult=1.0).tolist() == [[0, 1]]
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from chatbot import ChatBot
+from server import create_app
+from utils.fakes import FakeChatModel, FakeEmbeddings
+
+
+class _FailingChatModel(FakeChatModel):
+    # Fails to answer the questions mentioning a failure
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if "fail" in str(messages[-1].content):
+            raise RuntimeError("The model is unavailable")
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+
+@pytest.fixture
+def client(tmp_path):
+    bot = ChatBot(model_name="gpt-3.5-turbo", embeddings_model_name="fake", db_type="LocalVectorStore",
+                  db_path=str(tmp_path / "db"), search_type="similarity", model=_FailingChatModel(),
+                  embeddings=FakeEmbeddings())
+    bot.db.add_texts(["the budget of the city"], metadatas=[{"source": "https://example.com/budget"}])
+    with TestClient(create_app(bot, warm_up=False)) as client:
+        yield client
+
+
+def _status_code(response):
+    # LangServe streams the errors as server-sent events, after a successful response
+    if response.headers["content-type"].startswith("text/event-stream"):
+        for line in response.text.splitlines():
+            if line.startswith("data:") and "status_code" in line:
+                return json.loads(line[len("data:"):])["status_code"]
+    return response.status_code
+
+
+@pytest.mark.parametrize("path", ["/main/invoke", "/main/stream"])
+def test_invalid_filters_are_rejected(client, path):
+    for filters in ({"after": "not a date"}, {"colour": "blue"}):
+        response = client.post(path, json={"input": {"role": "user", "content": "budget", "filters": filters}})
+        assert _status_code(response) == 422
+
+
+def test_valid_filters_are_accepted(client):
+    response = client.post("/main/invoke", json={"input": {
+        "role": "user", "content": "budget", "filters": {"after": "2024-01-01", "source": "https://example.com/budget"}
+    }})
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize("filters", [{"after": "not a date"}, {"region": 5}, {"max_age_days": "a week"}])
+def test_bulk_rejects_invalid_filters(client, filters):
+    response = client.post("/main/bulk", json={"questions": ["budget"], "filters": filters})
+    assert response.status_code == 422
+
+
+def test_sessions_are_saved_on_shutdown(tmp_path):
+    def create_bot():
+        return ChatBot(model_name="gpt-3.5-turbo", embeddings_model_name="fake", db_type="LocalVectorStore",
+                       db_path=str(tmp_path / "db"), search_type="similarity", model=FakeChatModel(),
+                       embeddings=FakeEmbeddings(), history_db_path=str(tmp_path / "history.db"))
+
+    with TestClient(create_app(create_bot(), warm_up=False)) as client:
+        response = client.post("/main/invoke", json={"input": {"role": "user", "content": "budget"},
+                                                     "config": {"configurable": {"session_id": "session"}}})
+        assert response.status_code == 200
+    assert len(create_bot().sessions.get("session").messages) == 2
+
+
+def test_bulk_streams_the_answers_as_ndjson(client):
+    questions = ["what is the budget", "please fail", "and the bridge"]
+    response = client.post("/main/bulk", json={"questions": questions, "max_concurrency": 2})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda line: line["index"])
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    # A failed answer is reported on its own line without interrupting the others
+    assert lines[1] == {"index": 1, "error": "The model is unavailable"}
+    assert lines[0]["output"].startswith("user: what is the budget")
+    assert lines[2]["output"].startswith("user: and the bridge")
+
+
+@pytest.mark.parametrize("body", [{"questions": "budget"}, {"questions": ["budget"], "max_concurrency": 0},
+                                  {"questions": ["budget"], "max_concurrency": 100}])
+def test_bulk_rejects_invalid_requests(client, body):
+    assert client.post("/main/bulk", json=body).status_code == 422
+
+
+def test_bulk_without_questions(client):
+    response = client.post("/main/bulk", json={"questions": []})
+    assert response.status_code == 200 and response.text == ""
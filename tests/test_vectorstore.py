@@ -0,0 +1,77 @@
+import datetime
+import os
+import sqlite3
+
+import pytest
+
+from utils.fakes import FakeEmbeddings
+from utils.vectorstore import VECTORS_FILE, LocalVectorStore
+
+WORDS = "budget pont école hôpital festival neige transport logement parc rivière".split()
+
+
+def _search(store, query, **kwargs):
+    # Ties are in no particular order, and the unrelated documents are not compared
+    results = [(doc.page_content, round(score, 3))
+               for doc, score in store.similarity_search_with_score(query, k=4, **kwargs) if score > 0.01]
+    return sorted(results, key=lambda result: (-result[1], result[0]))
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_compact_keeps_the_live_documents(tmp_path, quantize):
+    path = str(tmp_path / "db")
+    store = LocalVectorStore(persist_directory=path, embedding_function=FakeEmbeddings(), quantize=quantize)
+    ids = store.add_texts(
+        [f"{word} {WORDS[(i + 3) % len(WORDS)]}" for i, word in enumerate(WORDS)],
+        metadatas=[{"region": "Montréal" if i % 2 else "Québec", "timestamp": float(i)} for i in range(len(WORDS))]
+    )
+    store.delete(ids[::3])
+    queries = [("budget pont", {}), ("neige parc", {"filter": {"region": "Montréal"}}),
+               ("logement parc", {"filter": {"after": 4.0}})]
+    expected = [_search(store, query, **kwargs) for query, kwargs in queries]
+    assert all(expected)
+    size = os.path.getsize(os.path.join(path, VECTORS_FILE))
+
+    store.compact()
+    assert [_search(store, query, **kwargs) for query, kwargs in queries] == expected
+    assert len(store.ids) == len(store.positions) == len(WORDS) - len(ids[::3])
+    assert os.path.getsize(os.path.join(path, VECTORS_FILE)) == size * len(store.ids) // len(WORDS)
+
+    # The compacted store reopens from disk, and keeps accepting documents and deletions
+    store = LocalVectorStore(persist_directory=path, embedding_function=FakeEmbeddings())
+    assert [_search(store, query, **kwargs) for query, kwargs in queries] == expected
+    store.add_texts(["budget pont"], ids=["new"])
+    store.delete([ids[1]])
+    assert _search(store, "budget pont")[0][0] == "budget pont"
+    assert all(text != f"{WORDS[1]} {WORDS[4]}" for text, _ in _search(store, WORDS[1]))
+
+
+def test_compact_empty_store(tmp_path):
+    store = LocalVectorStore(persist_directory=str(tmp_path / "db"), embedding_function=FakeEmbeddings())
+    store.delete(store.add_texts(["budget"]))
+    store.compact()
+    assert store.similarity_search("budget") == []
+    store.add_texts(["pont"])
+    assert [doc.page_content for doc in store.similarity_search("pont")] == ["pont"]
+
+
+@pytest.mark.parametrize("failure", ["metadata", "database"])
+def test_failed_add_leaves_the_store_consistent(tmp_path, failure):
+    path = str(tmp_path / "db")
+    store = LocalVectorStore(persist_directory=path, embedding_function=FakeEmbeddings())
+    store.add_texts(["budget pont"], ids=["budget"])
+    if failure == "metadata":
+        with pytest.raises(ValueError):
+            store.add_texts(["neige parc"], metadatas=[{"date": datetime.date(2024, 1, 1)}], ids=["budget"])
+    else:
+        with store.conn:
+            store.conn.execute("CREATE TRIGGER fail BEFORE INSERT ON documents WHEN NEW.text = 'neige parc' "
+                               "BEGIN SELECT RAISE(ABORT, 'insert failed'); END")
+        with pytest.raises(sqlite3.DatabaseError):
+            store.add_texts(["neige parc"], ids=["budget"])
+
+    # The replaced document is kept, and the rows added afterwards match their own vectors
+    store.add_texts(["festival neige"])
+    for current in (store, LocalVectorStore(persist_directory=path, embedding_function=FakeEmbeddings())):
+        assert _search(current, "budget pont") == [("budget pont", 1.0)]
+        assert _search(current, "festival neige") == [("festival neige", 1.0)]
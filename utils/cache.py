@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+INDEX_VERSION_FILE = "index_version"
+
+
+def write_index_version(db_path: str) -> str:
+    """
+    Writes a new random index version to the database directory, invalidating caches built on the previous index.
+
+    Args:
+        db_path (str): The path to the database directory.
+
+    Returns:
+        str: The new index version.
+    """
+    version = uuid.uuid4().hex
+    path = os.path.join(db_path, INDEX_VERSION_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        file.write(version)
+    os.replace(f"{path}.tmp", path)
+    return version
+
+
+def read_index_version(db_path: str) -> Optional[str]:
+    """
+    Reads the index version of the database directory.
+
+    Args:
+        db_path (str): The path to the database directory.
+
+    Returns:
+        Optional[str]: The index version, or None if the index was never versioned.
+    """
+    try:
+        with open(os.path.join(db_path, INDEX_VERSION_FILE), "r", encoding="utf-8") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class SemanticCache:
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, max_size: int = 1024,
+                 ttl: Optional[float] = None, db_path: Optional[str] = None) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.vectors: Optional[np.ndarray] = None
+        self.answers: List[str] = []
+        self.created_at = np.zeros(max_size)
+        self.used_at = np.zeros(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+        self.version_mtime = None
+
+    def _check_version(self) -> None:
+        if self.db_path is None:
+            return
+        try:
+            mtime = os.stat(os.path.join(self.db_path, INDEX_VERSION_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.version_mtime:
+            return
+        version = read_index_version(self.db_path)
+        if version != self.version:
+            self._clear()
+        self.version, self.version_mtime = version, mtime
+
+    def _clear(self) -> None:
+        self.vectors = None
+        self.answers = []
+
+    def embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def aembed(self, query: str) -> np.ndarray:
+        vector = np.asarray(await self.embeddings.aembed_query(query), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, vector: np.ndarray) -> Optional[str]:
+        with self.lock:
+            self._check_version()
+            if self.answers:
+                size = len(self.answers)
+                similarities = self.vectors[:size] @ vector
+                best = int(np.argmax(similarities))
+                now = time.monotonic()
+                expired = self.ttl is not None and now - self.created_at[best] > self.ttl
+                if similarities[best] >= self.threshold and not expired:
+                    self.used_at[best] = now
+                    self.hits += 1
+                    return self.answers[best]
+            self.misses += 1
+            return None
+
+    def update(self, vector: np.ndarray, answer: str) -> None:
+        with self.lock:
+            self._check_version()
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+            size = len(self.answers)
+            if size < self.max_size:
+                slot = size
+                self.answers.append(answer)
+            else:
+                # Replace the least recently used entry
+                slot = int(np.argmin(self.used_at))
+                self.answers[slot] = answer
+            now = time.monotonic()
+            self.vectors[slot] = vector
+            self.created_at[slot] = now
+            self.used_at[slot] = now
+
+    def clear(self) -> None:
+        with self.lock:
+            self._clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.answers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
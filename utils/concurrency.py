@@ -0,0 +1,59 @@
+import asyncio
+import json
+from typing import Any, Callable, Iterable, Optional
+
+from utils.metrics import REGISTRY
+
+REJECTED_REQUESTS = REGISTRY.counter(
+    "http_requests_rejected_total",
+    "Requests rejected because too many requests were waiting."
+)
+
+
+class ConcurrencyLimitMiddleware:
+    """
+    ASGI middleware capping the number of HTTP requests processed at once by a worker. Requests beyond the limit
+    wait for a slot, and are rejected with a 503 once too many of them are waiting, instead of piling up until the
+    worker runs out of memory or threads. Streaming responses hold their slot until the stream ends. The metrics
+    and health checks are exempt, so that a saturated worker can still be monitored.
+    """
+
+    def __init__(self, app: Callable, max_concurrency: int = 64, max_waiting: Optional[int] = 256,
+                 exempt_paths: Iterable[str] = ("/metrics", "/health")) -> None:
+        self.app = app
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.exempt_paths = frozenset(exempt_paths)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.active = 0
+
+    async def _reject(self, send: Callable) -> None:
+        body = json.dumps({"detail": "Too many concurrent requests"}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> Any:
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+        if self.semaphore is None:
+            # Created lazily, so that it belongs to the event loop of the server
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.semaphore.locked() and self.max_waiting is not None and self.waiting >= self.max_waiting:
+            REJECTED_REQUESTS.inc()
+            return await self._reject(send)
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            self.active -= 1
+            self.semaphore.release()
@@ -0,0 +1,130 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+# Rough number of characters per token, used when the tokenizer of the model is unavailable
+CHARS_PER_TOKEN = 4
+
+
+def _overlap(left: str, right: str, min_overlap: int) -> int:
+    # Length of the longest suffix of left that is a prefix of right, if at least min_overlap characters long
+    if len(left) < min_overlap or len(right) < min_overlap:
+        return 0
+    head = right[:min_overlap]
+    start = left.find(head, max(0, len(left) - len(right)))
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(head, start + 1)
+    return 0
+
+
+def merge_chunks(texts: List[str], min_overlap: int = 32) -> List[Tuple[str, int]]:
+    """
+    Merges the chunks of a single source that overlap or contain one another, such as consecutive chunks of a
+    splitter with an overlap.
+
+    Args:
+        texts (List[str]): The chunks, best ranked first.
+        min_overlap (int): The minimum number of overlapping characters for two chunks to be merged. Defaults to 32.
+
+    Returns:
+        List[Tuple[str, int]]: The merged chunks, with the best rank of the chunks they were merged from.
+    """
+    merged: List[Tuple[str, int]] = []
+    for rank, text in enumerate(texts):
+        piece = (text, rank)
+        # Merging two pieces can make the result overlap a third one, so merge until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for i, (other, other_rank) in enumerate(merged):
+                best_rank = min(piece[1], other_rank)
+                if piece[0] in other:
+                    combined = other
+                elif other in piece[0]:
+                    combined = piece[0]
+                elif overlap := _overlap(other, piece[0], min_overlap):
+                    combined = other + piece[0][overlap:]
+                elif overlap := _overlap(piece[0], other, min_overlap):
+                    combined = piece[0] + other[overlap:]
+                else:
+                    continue
+                del merged[i]
+                piece = (combined, best_rank)
+                changed = True
+                break
+        merged.append(piece)
+    return merged
+
+
+class ContextPacker:
+    """
+    Assembles retrieved documents into the context of a prompt: chunks of the same source are merged and
+    deduplicated, only their content and source link are kept, and they are packed in rank order up to a token
+    budget, the last one being truncated to fit.
+    """
+
+    def __init__(self, token_budget: int = 2000, model_name: str = "gpt-3.5-turbo",
+                 source_keys: Sequence[str] = ("url", "source"), min_overlap: int = 32) -> None:
+        self.token_budget = token_budget
+        self.source_keys = source_keys
+        self.min_overlap = min_overlap
+        try:
+            import tiktoken
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except Exception:
+            self.encoding = None
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            return -(-len(text) // CHARS_PER_TOKEN)
+        return len(self.encoding.encode_ordinary(text))
+
+    def _truncate(self, text: str, num_tokens: int) -> str:
+        if self.encoding is None:
+            return text[:num_tokens * CHARS_PER_TOKEN]
+        return self.encoding.decode(self.encoding.encode_ordinary(text)[:num_tokens])
+
+    def _source(self, doc: Document) -> Optional[str]:
+        for key in self.source_keys:
+            if doc.metadata.get(key):
+                return str(doc.metadata[key])
+        return None
+
+    def pack(self, docs: List[Document]) -> str:
+        """
+        Packs documents into a context.
+
+        Args:
+            docs (List[Document]): The retrieved documents, best ranked first.
+
+        Returns:
+            str: The context.
+        """
+        sources: Dict[Optional[str], List[Tuple[str, int]]] = {}
+        for rank, doc in enumerate(docs):
+            sources.setdefault(self._source(doc), []).append((doc.page_content.strip(), rank))
+        pieces = []
+        for source, chunks in sources.items():
+            ranks = [rank for _, rank in chunks]
+            for text, index in merge_chunks([text for text, _ in chunks], self.min_overlap):
+                pieces.append((ranks[index], text, source))
+        pieces.sort(key=lambda piece: piece[0])
+
+        blocks = []
+        remaining = self.token_budget
+        for _, text, source in pieces:
+            footer = f"\nSource: {source}" if source else ""
+            cost = self.count_tokens(text) + self.count_tokens(footer) + 1
+            if cost > remaining:
+                available = remaining - self.count_tokens(footer) - 1
+                if available > 0:
+                    blocks.append(self._truncate(text, available) + footer)
+                break
+            blocks.append(text + footer)
+            remaining -= cost
+        return "\n\n".join(blocks)
+
+    def __call__(self, docs: List[Document]) -> str:
+        return self.pack(docs)
@@ -1,15 +1,168 @@
 import json
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
 from langchain_core.documents import Document
 
+PACKED_EXTENSION = ".jsonl"
+PACKED_INDEX_EXTENSION = ".idx"
+
+
+def is_packed(path: str) -> bool:
+    """
+    Checks whether a path refers to a packed corpus rather than a directory of text and metadata files.
+
+    Args:
+        path (str): The path to check.
+
+    Returns:
+        bool: True if the path has the packed corpus extension.
+    """
+    return path.endswith(PACKED_EXTENSION)
+
+
+class PackedCorpus:
+    """
+    Read-only view of a packed corpus: a JSON Lines file with one {"id", "page_content", "metadata"} record per
+    document, and an index file mapping each document id to the byte offset and length of its record.
+    The corpus is memory-mapped, so opening it is cheap and documents are decoded only when accessed.
+    """
+
+    def __init__(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise ValueError(f"Path {path} does not exist")
+        self.path = path
+        with open(f"{path}{PACKED_INDEX_EXTENSION}", "r", encoding="utf-8") as index_file:
+            self.offsets: dict[str, tuple[int, int]] = {
+                doc_id: (offset, length) for doc_id, offset, length in json.load(index_file)
+            }
+        self.file = open(path, "rb")
+        self.buffer: Optional[mmap.mmap] = None
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self) -> "PackedCorpus":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.offsets
+
+    def __iter__(self) -> Iterator[Document]:
+        for doc_id in self.offsets:
+            yield self.get(doc_id)
+
+    def ids(self) -> list[str]:
+        return list(self.offsets)
+
+    def get(self, doc_id: str) -> Document:
+        """
+        Reads a document by id.
+
+        Args:
+            doc_id (str): The id of the document.
+
+        Returns:
+            Document: The document.
+
+        Raises:
+            KeyError: If the corpus does not contain the document.
+        """
+        offset, length = self.offsets[doc_id]
+        record = json.loads(self.buffer[offset:offset + length])
+        metadata = record["metadata"]
+        if "source" not in metadata:
+            metadata["source"] = record["id"]
+        return Document(page_content=record["page_content"], metadata=metadata)
+
+    def close(self) -> None:
+        if self.buffer is not None:
+            self.buffer.close()
+        self.file.close()
+
+
+def _save_packed(path: str, documents: Iterable[Document], source_key: str) -> None:
+    # Write to temporary files first, so that readers never see a partially written corpus
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    index = []
+    offset = 0
+    with open(f"{path}.tmp", "wb") as file:
+        for i, doc in enumerate(documents):
+            source = doc.metadata.get(source_key, "document").split('.')[0]
+            doc_id = f"{source}.{i}"
+            record = json.dumps(
+                {"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata},
+                ensure_ascii=False
+            ).encode("utf-8")
+            file.write(record + b"\n")
+            index.append((doc_id, offset, len(record)))
+            offset += len(record) + 1
+    with open(f"{path}{PACKED_INDEX_EXTENSION}.tmp", "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+    os.replace(f"{path}{PACKED_INDEX_EXTENSION}.tmp", f"{path}{PACKED_INDEX_EXTENSION}")
+
+
+def _read_document(path: str, name: str) -> tuple[str, dict]:
+    with open(os.path.join(path, name), "r", encoding="utf-8") as file:
+        page_content = file.read()
+    with open(os.path.join(path, f"{name}.meta"), "r", encoding="utf-8") as meta_file:
+        metadata = json.load(meta_file)
+    if "source" not in metadata:
+        metadata["source"] = name
+    return page_content, metadata
+
+
+def iter_documents(path: str, batch_size: int = 256, max_workers: int = 8) -> Iterator[Document]:
+    """
+    Lazily reads all text and its associated metadata files from a given directory, or all documents of a packed
+    corpus if the path has the packed corpus extension.
+
+    Files are read by a thread pool one batch ahead of the consumer, so at most two batches are held in memory
+    and the first documents are available before the whole directory has been read.
+
+    Args:
+        path (str): The path to the directory containing the text files, or to a packed corpus.
+        batch_size (int): The number of documents read ahead at once. Defaults to 256.
+        max_workers (int): The number of threads reading files. Defaults to 8.
+
+    Yields:
+        Document: The Document objects representing the text files and its associated metadata.
+
+    Raises:
+        ValueError: If the provided path does not exist.
+    """
+    if not os.path.exists(path):
+        raise ValueError(f"Path {path} does not exist")
+    if is_packed(path):
+        with PackedCorpus(path) as corpus:
+            yield from corpus
+        return
+    with os.scandir(path) as entries, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        names = (entry.name for entry in entries if entry.name.endswith(".txt") and entry.is_file())
+        futures = [executor.submit(_read_document, path, name) for name in islice(names, batch_size)]
+        while futures:
+            next_futures = [executor.submit(_read_document, path, name) for name in islice(names, batch_size)]
+            for future in futures:
+                page_content, metadata = future.result()
+                yield Document(page_content=page_content, metadata=metadata)
+            futures = next_futures
+
 
 def get_documents(path: str) -> list[Document]:
     """
     Reads all text and its associated metadata files from a given directory and returns a list of Document objects.
 
     Args:
-        path (str): The path to the directory containing the text files.
+        path (str): The path to the directory containing the text files, or to a packed corpus.
 
     Returns:
         list[Document]: A list of Document objects representing the text files and its associated metadata.
@@ -17,32 +170,24 @@ def get_documents(path: str) -> list[Document]:
     Raises:
         ValueError: If the provided path does not exist or if there is an error in reading the files.
     """
-    if not os.path.exists(path):
-        raise ValueError(f"Path {path} does not exist")
-    docs = []
-    for f in os.listdir(path):
-        if not f.endswith(".txt"):
-            continue
-        with open(os.path.join(path, f), "r", encoding="utf-8") as file:
-            page_content = file.read()
-        with open(os.path.join(path, f"{f}.meta"), "r", encoding="utf-8") as meta_file:
-            metadata = json.load(meta_file)
-            if "source" not in metadata:
-                metadata["source"] = f
-        docs.append(Document(page_content=page_content, metadata=metadata))
-    return docs
-
-
-def save_documents(path: str, documents: list[Document], source_key: str = "source") -> None:
-    """
-    Saves a list of Document objects to a specified directory. Each Document object is saved as two files:
+    return list(iter_documents(path))
+
+
+def save_documents(path: str, documents: Iterable[Document], source_key: str = "source") -> None:
+    """
+    Saves Document objects to a specified directory. Each Document object is saved as two files:
     a text file containing the page content and a metadata file in JSON format.
+    If the path has the packed corpus extension, the Document objects are saved to a single packed corpus instead.
+    Documents are written as they are consumed, so a generator is never materialized.
 
     Args:
-        path (str): The directory where the Document objects will be saved.
-        documents (list[Document]): A list of Document objects to be saved.
+        path (str): The directory or packed corpus where the Document objects will be saved.
+        documents (Iterable[Document]): The Document objects to be saved.
         source_key (str): The key in the metadata to use as the source of the document. Defaults to "source".
     """
+    if is_packed(path):
+        _save_packed(path, documents, source_key)
+        return
     os.makedirs(path, exist_ok=True)
     for i, doc in enumerate(documents):
         source = doc.metadata.get(source_key, "document").split('.')[0]
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_FILE = "embedding_cache.sql"
+
+
+def hash_text(text: str) -> str:
+    """
+    Computes the content hash used as the key of an embedding.
+
+    Args:
+        text (str): The embedded text.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest of the text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that stores every computed vector in a SQLite database, keyed by the content hash of the
+    text and namespaced by the embedding model, with an in-process LRU in front of it.
+    """
+
+    def __init__(self, embeddings: Embeddings, db_path: str, namespace: str,
+                 lru_size: int = 10000) -> None:
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.lru_size = lru_size
+        self.lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(db_path, exist_ok=True)
+        self.path = os.path.join(db_path, EMBEDDING_CACHE_FILE)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def _get_lru(self, key: str) -> Optional[List[float]]:
+        vector = self.lru.get(key)
+        if vector is not None:
+            self.lru.move_to_end(key)
+        return vector
+
+    def _put_lru(self, key: str, vector: List[float]) -> None:
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def _lookup(self, namespace: str, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                vector = self._get_lru(f"{namespace}:{key}")
+                if vector is None:
+                    missing.append(key)
+                else:
+                    found[key] = vector
+            # Stay below SQLite's limit on the number of bound parameters
+            for i in range(0, len(missing), 500):
+                batch = missing[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE namespace = ? "
+                    f"AND key IN ({', '.join('?' * len(batch))})",
+                    (namespace, *batch)
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    self._put_lru(f"{namespace}:{key}", vector)
+                    found[key] = vector
+        return found
+
+    def _store(self, namespace: str, vectors: Dict[str, List[float]]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (namespace, key, vector) VALUES (?, ?, ?)",
+                [
+                    (namespace, key, np.asarray(vector, dtype=np.float32).tobytes())
+                    for key, vector in vectors.items()
+                ]
+            )
+            for key, vector in vectors.items():
+                self._put_lru(f"{namespace}:{key}", vector)
+
+    def _missing(self, texts: List[str], keys: List[str], found: Dict[str, List[float]]) -> Dict[str, str]:
+        return {key: text for text, key in zip(texts, keys) if key not in found}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [hash_text(text) for text in texts]
+        found = self._lookup(self.namespace, keys)
+        missing = self._missing(texts, keys, found)
+        if missing:
+            vectors = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self._store(self.namespace, vectors)
+            found.update(vectors)
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [hash_text(text) for text in texts]
+        found = await asyncio.to_thread(self._lookup, self.namespace, keys)
+        missing = self._missing(texts, keys, found)
+        if missing:
+            vectors = dict(zip(missing, await self.embeddings.aembed_documents(list(missing.values()))))
+            await asyncio.to_thread(self._store, self.namespace, vectors)
+            found.update(vectors)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Some models embed queries differently from documents, so they live in their own namespace
+        namespace = f"{self.namespace}/query"
+        key = hash_text(text)
+        vector = self._lookup(namespace, [key]).get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store(namespace, {key: vector})
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        namespace = f"{self.namespace}/query"
+        key = hash_text(text)
+        vector = (await asyncio.to_thread(self._lookup, namespace, [key])).get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._store, namespace, {key: vector})
+        return vector
+
+
+def get_embeddings(model_name: str, db_path: Optional[str] = None, **kwargs) -> Embeddings:
+    """
+    Creates the OpenAI embeddings for a model, cached on disk in the database directory if one is given.
+
+    Args:
+        model_name (str): The name of the OpenAI embedding model.
+        db_path (Optional[str]): The database directory holding the embedding cache. Defaults to None (no cache).
+        **kwargs: Additional keyword arguments passed to OpenAIEmbeddings.
+
+    Returns:
+        Embeddings: The embeddings.
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    embeddings = OpenAIEmbeddings(model=model_name, **kwargs)
+    if db_path is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, db_path=db_path, namespace=model_name)
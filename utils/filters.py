@@ -0,0 +1,148 @@
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Union
+
+# Metadata keys holding the publication date of a document, by order of preference
+DATE_KEYS = ("date", "published", "published_at", "pubDate", "metadata_modified", "modified")
+# Normalized metadata key holding the publication date as a POSIX timestamp
+TIMESTAMP_KEY = "timestamp"
+# Metadata keys that can be filtered on by exact value
+LABEL_KEYS = ("source", "package", "region")
+
+SECONDS_PER_DAY = 86400
+
+
+def parse_date(value: Any) -> Optional[float]:
+    """
+    Parses a date in ISO 8601 or RFC 2822 format, or a POSIX timestamp. Dates without a timezone are assumed UTC.
+
+    Args:
+        value (Any): The date.
+
+    Returns:
+        Optional[float]: The POSIX timestamp of the date, or None if it cannot be parsed.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    try:
+        date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def normalize_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adds the publication date of a document as a POSIX timestamp to its metadata, so that it can be filtered by
+    date whatever the format of the original date.
+
+    Args:
+        metadata (Dict[str, Any]): The metadata of the document.
+
+    Returns:
+        Dict[str, Any]: The metadata, with the timestamp if a date was found.
+    """
+    for key in DATE_KEYS:
+        timestamp = parse_date(metadata.get(key))
+        if timestamp is not None:
+            return {**metadata, TIMESTAMP_KEY: timestamp}
+    return metadata
+
+
+def parse_filters(filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Parses metadata filters into bounds on the timestamp and lists of accepted values. Parsing parsed filters
+    returns them unchanged.
+
+    The filters are "after" and "before", dates bounding the publication date, "max_age_days", the maximum age of
+    the documents relative to now, and "source", "package" and "region", a value or a list of accepted values.
+
+    Args:
+        filters (Optional[Dict[str, Any]]): The filters.
+
+    Returns:
+        Dict[str, Any]: The parsed filters, with the "after" and "before" timestamps and the accepted values.
+
+    Raises:
+        ValueError: If a filter is unknown, a date cannot be parsed or a value has the wrong type.
+    """
+    parsed: Dict[str, Any] = {}
+    for key, value in (filters or {}).items():
+        if value is None:
+            continue
+        if key in ("after", "before"):
+            timestamp = parse_date(value)
+            if timestamp is None:
+                raise ValueError(f"Invalid date for the {key} filter: {value}")
+            # Keep the narrowest bound when max_age_days also bounds the date
+            bound = max if key == "after" else min
+            parsed[key] = bound(timestamp, parsed.get(key, timestamp))
+        elif key == "max_age_days":
+            try:
+                days = float(value) if not isinstance(value, bool) else None
+            except (TypeError, ValueError):
+                days = None
+            if days is None:
+                raise ValueError(f"Invalid number of days for the max_age_days filter: {value}")
+            after = time.time() - days * SECONDS_PER_DAY
+            parsed["after"] = max(after, parsed.get("after", after))
+        elif key in LABEL_KEYS:
+            values = [value] if isinstance(value, str) else value
+            if not isinstance(values, (list, tuple)) or not all(isinstance(item, str) for item in values):
+                raise ValueError(f"Invalid value for the {key} filter, expected a string or a list of strings: "
+                                 f"{value}")
+            parsed[key] = list(values)
+        else:
+            raise ValueError(f"Unknown filter: {key}")
+    return parsed
+
+
+def matches(metadata: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    """
+    Checks whether the metadata of a document passes parsed filters.
+
+    Args:
+        metadata (Dict[str, Any]): The normalized metadata of the document.
+        filters (Dict[str, Any]): The parsed filters.
+
+    Returns:
+        bool: Whether the document passes the filters. Documents without a date never pass a date filter.
+    """
+    timestamp = metadata.get(TIMESTAMP_KEY)
+    if "after" in filters and (timestamp is None or timestamp < filters["after"]):
+        return False
+    if "before" in filters and (timestamp is None or timestamp >= filters["before"]):
+        return False
+    return all(metadata.get(key) in filters[key] for key in LABEL_KEYS if key in filters)
+
+
+def to_chroma_where(filters: Dict[str, Any]) -> Optional[Dict[str, Union[Dict, List]]]:
+    """
+    Translates parsed filters into a Chroma where clause.
+
+    Args:
+        filters (Dict[str, Any]): The parsed filters.
+
+    Returns:
+        Optional[Dict[str, Union[Dict, List]]]: The where clause, or None if there is nothing to filter.
+    """
+    clauses = []
+    if "after" in filters:
+        clauses.append({TIMESTAMP_KEY: {"$gte": filters["after"]}})
+    if "before" in filters:
+        clauses.append({TIMESTAMP_KEY: {"$lt": filters["before"]}})
+    clauses += [{key: {"$in": filters[key]}} for key in LABEL_KEYS if key in filters]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
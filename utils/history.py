@@ -1,27 +1,95 @@
-from typing import List, Dict, Any
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import closing
+from typing import List, Dict, Any, Optional, Tuple, Callable, Deque
+
+import tiktoken
 
 from langchain_core.messages import (
-    BaseMessage, AIMessage, HumanMessage, ChatMessage, SystemMessage, FunctionMessage, ToolMessage
+    BaseMessage, AIMessage, HumanMessage, ChatMessage, SystemMessage, FunctionMessage, ToolMessage,
+    messages_from_dict, messages_to_dict
 )
 
 
 class MessageHistory:
     def __init__(self, history_key: str = "history",
-                 message_limit: int = 100) -> None:
-        self.messages: List[BaseMessage] = []
+                 message_limit: Optional[int] = 100, token_limit: Optional[int] = None,
+                 model_name: str = "gpt-3.5-turbo-0125",
+                 summarizer: Optional[Callable[[str, List[BaseMessage]], str]] = None) -> None:
+        self.messages: Deque[BaseMessage] = deque()
+        self.token_counts: Deque[int] = deque()
+        self.token_count = 0
+        self.summary = ""
         self.message_limit = message_limit
+        self.token_limit = token_limit
+        self.summarizer = summarizer
         self.history_key = history_key
+        self.encoding = tiktoken.encoding_for_model(model_name) if token_limit is not None else None
 
     def load_messages(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
-        return {"history": self.get_messages()}
+        return {self.history_key: self.get_messages()}
 
     def get_messages(self) -> List[BaseMessage]:
-        return self.messages
+        if self.summary:
+            return [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}"), *self.messages]
+        return list(self.messages)
+
+    def count_tokens(self, message: BaseMessage) -> int:
+        if self.encoding is None:
+            return 0
+        # Each message carries a few tokens of overhead for its role and separators
+        return len(self.encoding.encode(str(message.content))) + 4
 
-    def add_message(self, message: BaseMessage) -> None:
+    def _is_full(self) -> bool:
+        if self.message_limit is not None and len(self.messages) > self.message_limit:
+            return True
+        # Always keep the latest message, even if it alone exceeds the budget
+        return self.token_limit is not None and self.token_count > self.token_limit and len(self.messages) > 1
+
+    def _append(self, message: BaseMessage) -> None:
+        token_count = self.count_tokens(message)
         self.messages.append(message)
-        if len(self.messages) > self.message_limit:
-            self.messages = self.messages[-self.message_limit:]
+        self.token_counts.append(token_count)
+        self.token_count += token_count
+
+    def append(self, message: BaseMessage) -> List[BaseMessage]:
+        """
+        Adds a message and evicts the oldest messages beyond the limits, without summarizing them.
+
+        Args:
+            message (BaseMessage): The message.
+
+        Returns:
+            List[BaseMessage]: The evicted messages, oldest first.
+        """
+        self._append(message)
+        evicted = []
+        while self._is_full():
+            evicted.append(self.messages.popleft())
+            self.token_count -= self.token_counts.popleft()
+        return evicted
+
+    def add_message(self, message: BaseMessage) -> List[BaseMessage]:
+        evicted = self.append(message)
+        if evicted and self.summarizer is not None:
+            self.summary = self.summarizer(self.summary, evicted)
+        return evicted
+
+    def restore(self, messages: List[BaseMessage], summary: str = "") -> None:
+        """
+        Restores saved messages and their summary as they are, without evicting nor summarizing any of them.
+
+        Args:
+            messages (List[BaseMessage]): The messages, oldest first.
+            summary (str): The summary of the earlier messages. Defaults to no summary.
+        """
+        for message in messages:
+            self._append(message)
+        self.summary = summary
 
     def add_ai_message(self, content: str) -> None:
         self.add_message(AIMessage(content=content))
@@ -42,4 +110,165 @@ class MessageHistory:
         self.add_message(ToolMessage(content=content))
 
     def clear(self) -> None:
-        self.messages = []
+        self.messages.clear()
+        self.token_counts.clear()
+        self.token_count = 0
+        self.summary = ""
+
+
+class SessionHistoryStore:
+    def __init__(self, history_key: str = "history", max_sessions: int = 1024,
+                 idle_timeout: Optional[float] = 3600.0, db_path: Optional[str] = None,
+                 write_through: bool = False, **history_kwargs: Any) -> None:
+        if write_through and db_path is None:
+            raise ValueError("A write-through session store needs a database path")
+        self.history_key = history_key
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.history_kwargs = history_kwargs
+        self.sessions: "OrderedDict[str, Tuple[MessageHistory, float]]" = OrderedDict()
+        self.lock = threading.RLock()
+        self.db_path = db_path
+        # Sessions are read from and written to the database on every access, rather than kept in memory, so that
+        # several processes can serve the same conversations
+        self.write_through = write_through
+        if db_path is not None:
+            with closing(self._connect()) as conn, conn:
+                if write_through:
+                    # Readers and the writer do not block one another in WAL mode
+                    conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+                )
+
+    @property
+    def blocking(self) -> bool:
+        """Whether accessing a session may block on disk or on the summarizer, and belongs in a worker thread."""
+        return self.db_path is not None or self.history_kwargs.get("summarizer") is not None
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _new_history(self) -> MessageHistory:
+        return MessageHistory(history_key=self.history_key, **self.history_kwargs)
+
+    def _read(self, session_id: str, conn: Optional[sqlite3.Connection] = None) -> Optional[MessageHistory]:
+        if self.db_path is None:
+            return None
+        if conn is None:
+            with closing(self._connect()) as conn, conn:
+                return self._read(session_id, conn)
+        row = conn.execute(
+            "SELECT messages FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        history = self._new_history()
+        history.restore(messages_from_dict(data["messages"]), data.get("summary", ""))
+        return history
+
+    def _write(self, session_id: str, history: MessageHistory, conn: Optional[sqlite3.Connection] = None) -> None:
+        if self.db_path is None:
+            return
+        if conn is None:
+            with closing(self._connect()) as conn, conn:
+                return self._write(session_id, history, conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, messages, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps({
+                "messages": messages_to_dict(list(history.messages)),
+                "summary": history.summary
+            }), time.time())
+        )
+
+    def _evict(self, now: float) -> None:
+        # Sessions are kept in access order, so idle ones are always at the head
+        while self.sessions:
+            session_id, (history, last_access) = next(iter(self.sessions.items()))
+            idle = self.idle_timeout is not None and now - last_access > self.idle_timeout
+            if not idle and len(self.sessions) <= self.max_sessions:
+                break
+            self.sessions.popitem(last=False)
+            self._write(session_id, history)
+
+    def get(self, session_id: str) -> MessageHistory:
+        if self.write_through:
+            return self._read(session_id) or self._new_history()
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            history = entry[0] if entry is not None else self._read(session_id)
+            if history is None:
+                history = self._new_history()
+            self.sessions[session_id] = (history, now)
+            self._evict(now)
+            return history
+
+    def load_messages(self, session_id: str) -> Dict[str, Any]:
+        return self.get(session_id).load_messages({})
+
+    def add_message(self, session_id: str, message: BaseMessage) -> None:
+        if self.write_through:
+            # The session is read, updated and written in a single write transaction, so that the messages added
+            # concurrently by other processes are not overwritten
+            with self.lock, closing(self._connect()) as conn, conn:
+                conn.execute("BEGIN IMMEDIATE")
+                history = self._read(session_id, conn) or self._new_history()
+                evicted = history.append(message)
+                self._write(session_id, history, conn)
+        else:
+            with self.lock:
+                history = self.get(session_id)
+                evicted = history.append(message)
+        # The evicted messages are summarized without holding the lock nor the database, which would stall all the
+        # sessions while the model answers
+        if evicted and history.summarizer is not None:
+            self._summarize(session_id, history.summary, evicted, history.summarizer)
+
+    def _summarize(self, session_id: str, summary: str, evicted: List[BaseMessage],
+                   summarizer: Callable[[str, List[BaseMessage]], str]) -> None:
+        while summary is not None:
+            # The summary may change while the model answers, in which case the evicted messages are summarized
+            # again into the new one
+            summary = self._merge_summary(session_id, summary, summarizer(summary, evicted))
+
+    def _merge_summary(self, session_id: str, previous: str, summary: str) -> Optional[str]:
+        # Returns the current summary of the session if it is no longer the previous one, None once merged or if
+        # the session was cleared
+        if self.write_through:
+            with self.lock, closing(self._connect()) as conn, conn:
+                conn.execute("BEGIN IMMEDIATE")
+                history = self._read(session_id, conn)
+                if history is None or history.summary != previous:
+                    return history and history.summary
+                history.summary = summary
+                self._write(session_id, history, conn)
+                return None
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            history = entry[0] if entry is not None else self._read(session_id)
+            if history is None or history.summary != previous:
+                return history and history.summary
+            history.summary = summary
+            if entry is None:
+                # The session was spilled to the database in the meantime
+                self._write(session_id, history)
+            return None
+
+    def clear(self, session_id: str) -> None:
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            if self.db_path is not None:
+                with closing(self._connect()) as conn, conn:
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def flush(self) -> None:
+        with self.lock:
+            for session_id, (history, _) in self.sessions.items():
+                self._write(session_id, history)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
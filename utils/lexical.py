@@ -0,0 +1,253 @@
+import asyncio
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from utils.filters import matches, parse_filters
+from utils.manifest import hash_document
+from utils.retrieval import with_filters
+
+BM25_INDEX_FILE = "bm25_index.json"
+
+FRENCH_STOP_WORDS = frozenset("""
+a au aux avec ce ces cet cette d dans de des du elle en est et eux il ils je l la le les leur leurs lui m ma mais
+me meme mes moi mon n ne nos notre nous on ou par pas pour qu que qui s sa se ses son sont sur t ta te tes toi ton
+tu un une vos votre vous y ete etre fait plus comme aussi entre sans sous si tout tous toute toutes tres
+""".split())
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tokenizes French text for lexical search: lowercases, strips accents, drops stop words and plural endings.
+    Numbers are kept as tokens, since queries often refer to years, counts or identifiers.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        List[str]: The tokens.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = []
+    for token in _WORD_PATTERN.findall(text):
+        if token in FRENCH_STOP_WORDS:
+            continue
+        # Light stemming: "regions" and "region", "journaux" and "journau" match
+        if len(token) > 3 and token[-1] in "sx" and not token.isdigit():
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over documents, persisted as JSON next to the vector store. Documents are keyed by
+    their content hash and grouped by source, so that the index can follow the cleanup of the vector store.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.docs: Dict[str, Tuple[str, int, str, Dict[str, Any]]] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.sources: Dict[str, set] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, doc: Document, source_key: str = "source") -> None:
+        doc_id = hash_document(doc)
+        if doc_id in self.docs:
+            return
+        counts = Counter(tokenize(doc.page_content))
+        length = sum(counts.values())
+        source = doc.metadata.get(source_key)
+        self.docs[doc_id] = (source, length, doc.page_content, doc.metadata)
+        self.sources.setdefault(source, set()).add(doc_id)
+        self.total_length += length
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+
+    def remove_source(self, source: str) -> None:
+        for doc_id in self.sources.pop(source, set()):
+            _, length, text, _ = self.docs.pop(doc_id)
+            self.total_length -= length
+            for term in set(tokenize(text)):
+                postings = self.postings[term]
+                del postings[doc_id]
+                if not postings:
+                    del self.postings[term]
+
+    def clear(self) -> None:
+        self.docs.clear()
+        self.postings.clear()
+        self.sources.clear()
+        self.total_length = 0
+
+    def search(self, query: str, k: int = 4, predicate: Optional[Callable[[Dict[str, Any]], bool]] = None) \
+            -> List[Tuple[Document, float]]:
+        """
+        Searches the documents best matching the terms of a query.
+
+        Args:
+            query (str): The query.
+            k (int): The number of documents to return. Defaults to 4.
+            predicate (Optional[Callable[[Dict[str, Any]], bool]]): Whether a document is searched, given its
+                metadata. Defaults to all documents.
+
+        Returns:
+            List[Tuple[Document, float]]: The documents and their BM25 scores, best first.
+        """
+        if not self.docs:
+            return []
+        num_docs = len(self.docs)
+        average_length = self.total_length / num_docs or 1.0
+        scores: Dict[str, float] = {}
+        # Whether each document passes the predicate, checked once per document while accumulating the postings, so
+        # that the documents filtered out are never scored
+        allowed: Dict[str, bool] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings.items():
+                if predicate is not None:
+                    if doc_id not in allowed:
+                        allowed[doc_id] = predicate(self.docs[doc_id][3])
+                    if not allowed[doc_id]:
+                        continue
+                length = self.docs[doc_id][1]
+                norm = count + self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / norm
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            (Document(page_content=self.docs[doc_id][2], metadata=self.docs[doc_id][3]), score)
+            for doc_id, score in best
+        ]
+
+    def save(self, db_path: str) -> None:
+        path = os.path.join(db_path, BM25_INDEX_FILE)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+            json.dump({"k1": self.k1, "b": self.b, "docs": self.docs, "postings": self.postings}, file,
+                      ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, db_path: str) -> "BM25Index":
+        """
+        Loads the index persisted in a database directory, or an empty index if there is none.
+
+        Args:
+            db_path (str): The path to the database directory.
+
+        Returns:
+            BM25Index: The index.
+        """
+        path = os.path.join(db_path, BM25_INDEX_FILE)
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+        index = cls(k1=data["k1"], b=data["b"])
+        index.docs = {doc_id: tuple(entry) for doc_id, entry in data["docs"].items()}
+        index.postings = data["postings"]
+        for doc_id, (source, length, _, _) in index.docs.items():
+            index.sources.setdefault(source, set()).add(doc_id)
+            index.total_length += length
+        return index
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever fusing the ranks of a vector retriever and of a BM25 index with reciprocal rank fusion. The metadata
+    filters (see parse_filters) apply to the lexical search, those of the vector retriever to the vector search.
+    """
+
+    vector_retriever: BaseRetriever
+    lexical_index: BM25Index
+    k: int = 5
+    lexical_k: int = 20
+    rrf_k: int = 60
+    filters: Optional[Dict[str, Any]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def with_filters(self, filters: Optional[Dict[str, Any]]) -> "HybridRetriever":
+        """
+        Returns a copy of the retriever with additional metadata filters, overriding the filters of the same name.
+
+        Args:
+            filters (Optional[Dict[str, Any]]): The metadata filters, see parse_filters.
+
+        Returns:
+            HybridRetriever: The filtered retriever.
+        """
+        if not filters:
+            return self
+        return self.copy(update={
+            "vector_retriever": with_filters(self.vector_retriever, filters),
+            "filters": {**(self.filters or {}), **filters}
+        })
+
+    def _lexical_search(self, query: str) -> List[Document]:
+        filters = parse_filters(self.filters)
+        predicate = (lambda metadata: matches(metadata, filters)) if filters else None
+        return [doc for doc, _ in self.lexical_index.search(query, k=self.lexical_k, predicate=predicate)]
+
+    def fuse(self, rankings: List[List[Document]]) -> List[Document]:
+        scores: Dict[Tuple[str, Any], float] = {}
+        docs: Dict[Tuple[str, Any], Document] = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking):
+                key = (doc.page_content, doc.metadata.get("source"))
+                scores[key] = scores.get(key, 0.0) + 1 / (self.rrf_k + rank + 1)
+                docs.setdefault(key, doc)
+        return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:self.k]]
+
+    def batch_retrieve(self, queries: List[str]) -> List[List[Document]]:
+        """
+        Retrieves the documents of several queries, batching the vector retrieval when the vector retriever supports
+        it.
+
+        Args:
+            queries (List[str]): The queries.
+
+        Returns:
+            List[List[Document]]: The documents of each query.
+        """
+        if hasattr(self.vector_retriever, "batch_retrieve"):
+            vector_rankings = self.vector_retriever.batch_retrieve(queries)
+        else:
+            vector_rankings = self.vector_retriever.batch(queries)
+        return [
+            self.fuse([vector_docs, self._lexical_search(query)])
+            for query, vector_docs in zip(queries, vector_rankings)
+        ]
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: Optional[CallbackManagerForRetrieverRun] = None) -> List[Document]:
+        vector_docs = self.vector_retriever.invoke(query)
+        return self.fuse([vector_docs, self._lexical_search(query)])
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: Optional[AsyncCallbackManagerForRetrieverRun] = None) \
+            -> List[Document]:
+        vector_docs, lexical_docs = await asyncio.gather(
+            self.vector_retriever.ainvoke(query),
+            asyncio.to_thread(self._lexical_search, query)
+        )
+        return self.fuse([vector_docs, lexical_docs])
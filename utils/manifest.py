@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain_core.documents import Document
+
+from utils.document import is_packed, iter_documents
+
+MANIFEST_FILE = "manifest.json"
+
+
+def hash_document(doc: Document) -> str:
+    """
+    Computes the content hash of a document, covering both its content and its metadata.
+
+    Args:
+        doc (Document): The document.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest of the document.
+    """
+    data = json.dumps([doc.page_content, doc.metadata], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def hash_sources(docs: Iterable[Document], source_key: str = "source") -> Dict[str, str]:
+    """
+    Computes the content hash of each source, combining the hashes of all documents of the source regardless of
+    their order.
+
+    Args:
+        docs (Iterable[Document]): The documents.
+        source_key (str): The key in the metadata to use as the source of the document. Defaults to "source".
+
+    Returns:
+        Dict[str, str]: The hexadecimal SHA-256 digest of each source.
+    """
+    doc_hashes: Dict[str, List[str]] = {}
+    for doc in docs:
+        doc_hashes.setdefault(doc.metadata.get(source_key), []).append(hash_document(doc))
+    return {
+        source: hashlib.sha256("".join(sorted(hashes)).encode("utf-8")).hexdigest()
+        for source, hashes in doc_hashes.items()
+    }
+
+
+class Manifest:
+    """
+    Record of the sources processed by a pipeline stage: the content hash of each source and the outputs it
+    produced, together with the parameters of the stage. If the parameters change, every source is stale.
+    """
+
+    def __init__(self, path: str, params: Dict[str, Any]) -> None:
+        self.path = path
+        self.params = params
+        self.sources: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            self.sources = data.get("sources", {})
+            if data.get("params") != params:
+                # Keep the outputs, so that they can be removed, but invalidate every hash
+                for entry in self.sources.values():
+                    entry["hash"] = None
+
+    def diff(self, hashes: Dict[str, str]) -> Tuple[Set[str], Set[str]]:
+        """
+        Compares the current content hashes of the sources against the manifest.
+
+        Args:
+            hashes (Dict[str, str]): The current content hash of each source.
+
+        Returns:
+            Tuple[Set[str], Set[str]]: The sources that are new or changed, and the sources that were removed.
+        """
+        changed = {source for source, digest in hashes.items() if self.sources.get(source, {}).get("hash") != digest}
+        removed = set(self.sources) - set(hashes)
+        return changed, removed
+
+    def update(self, source: str, digest: str, outputs: Optional[List[str]] = None) -> None:
+        self.sources[source] = {"hash": digest, "outputs": outputs or []}
+
+    def remove(self, source: str) -> List[str]:
+        entry = self.sources.pop(source, None)
+        return entry["outputs"] if entry else []
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as file:
+            json.dump({"params": self.params, "sources": self.sources}, file, ensure_ascii=False)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def run_incremental(input_path: str, output_path: str,
+                    process: Callable[[Iterable[Document]], Iterable[Document]],
+                    params: Dict[str, Any], source_key: str = "source") -> Dict[str, int]:
+    """
+    Runs a pipeline stage only on the sources whose content or stage parameters changed since the last run.
+
+    The outputs of changed and removed sources are deleted, and the outputs of changed sources are written under
+    stable names derived from their source, so that unchanged outputs are left untouched. Every output document must
+    keep the source of the input document it was derived from.
+
+    Args:
+        input_path (str): The input directory or packed corpus containing the documents.
+        output_path (str): The output directory, which also holds the manifest of the stage.
+        process (Callable[[Iterable[Document]], Iterable[Document]]): The stage, mapping input documents to
+            output documents.
+        params (Dict[str, Any]): The parameters of the stage.
+        source_key (str): The key in the metadata to use as the source of the document. Defaults to "source".
+
+    Returns:
+        Dict[str, int]: The number of changed, removed and unchanged sources.
+
+    Raises:
+        ValueError: If the output path is a packed corpus, which cannot be updated in place.
+    """
+    if is_packed(output_path):
+        raise ValueError("Incremental runs require a directory output")
+    os.makedirs(output_path, exist_ok=True)
+    manifest = Manifest(os.path.join(output_path, MANIFEST_FILE), params)
+    hashes = hash_sources(iter_documents(input_path), source_key)
+    changed, removed = manifest.diff(hashes)
+
+    for source in changed | removed:
+        for name in manifest.remove(source):
+            for file_name in (name, f"{name}.meta"):
+                if os.path.exists(os.path.join(output_path, file_name)):
+                    os.remove(os.path.join(output_path, file_name))
+
+    outputs: Dict[str, List[str]] = {}
+    docs = (doc for doc in iter_documents(input_path) if doc.metadata.get(source_key) in changed)
+    for doc in process(docs):
+        source = doc.metadata.get(source_key)
+        names = outputs.setdefault(source, [])
+        # The digest keeps names unique across sources sharing the same stem
+        digest = hashlib.sha1(str(source).encode("utf-8")).hexdigest()[:8]
+        name = f"{str(source).split('.')[0]}.{digest}.{len(names)}.txt"
+        with open(os.path.join(output_path, name), "w", encoding="utf-8") as file:
+            file.write(doc.page_content)
+        with open(os.path.join(output_path, f"{name}.meta"), "w", encoding="utf-8") as meta_file:
+            json.dump(doc.metadata, meta_file, ensure_ascii=False)
+        names.append(name)
+
+    for source in changed:
+        manifest.update(source, hashes[source], outputs.get(source))
+    manifest.save()
+    return {"changed": len(changed), "removed": len(removed), "unchanged": len(hashes) - len(changed)}
@@ -0,0 +1,199 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, such as a number of requests or processed documents.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(self.labels, key)} {value:g}" for key, value in self.values.items()]
+
+    def summarize(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(self.labels, key)}: {value:g}" for key, value in self.values.items()]
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, such as latencies in seconds, counted in cumulative buckets.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels: str) -> Optional[float]:
+        """
+        Estimates a quantile by linear interpolation within its bucket, like histogram_quantile in Prometheus.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+            **labels (str): The labels of the series.
+
+        Returns:
+            Optional[float]: The estimated quantile, or None if nothing was observed.
+        """
+        with self.lock:
+            counts = list(self.counts.get(self._key(labels), []))
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    le = f'le="{bound}"' if bound == "+Inf" else f'le="{bound:g}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {self.sums[key]:g}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+    def summarize(self) -> List[str]:
+        with self.lock:
+            series = [(key, sum(counts), self.sums[key]) for key, counts in self.counts.items()]
+        lines = []
+        for key, count, total in series:
+            labels = dict(zip(self.labels, key))
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, key)}: count={count} mean={total / count:.4g} "
+                f"p50={self.quantile(0.5, **labels):.4g} p95={self.quantile(0.95, **labels):.4g}"
+            )
+        return lines
+
+
+class MetricsRegistry:
+    """
+    In-process registry of counters and histograms, rendered in the Prometheus text format or as a summary.
+    Metrics are created on first use, so that modules can declare the metrics they record at import time.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls: type, name: str, help: str, **kwargs) -> _Metric:
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels=labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            series = metric.render()
+            if series:
+                lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}", *series]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, prefix: str = "") -> str:
+        """
+        Summarizes the metrics in a human-readable form, for the end of a script.
+
+        Args:
+            prefix (str): Only summarize the metrics whose name starts with this prefix. Defaults to all metrics.
+
+        Returns:
+            str: The summary, one series per line.
+        """
+        return "\n".join(
+            line
+            for metric in list(self.metrics.values()) if metric.name.startswith(prefix)
+            for line in metric.summarize()
+        )
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "chatbot_stage_seconds",
+    "Duration of the stages of the chatbot chain.",
+    labels=("stage",)
+)
@@ -0,0 +1,45 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def map_batches(function: Callable[[List[T]], R], items: Iterable[T], batch_size: int, workers: int = 1,
+                initializer: Optional[Callable[..., Any]] = None, initargs: Tuple = ()) -> Iterator[R]:
+    """
+    Lazily applies a function to consecutive batches of items, in a process pool with more than one worker.
+
+    A bounded number of batches is in flight at once, so that the items are read as the results are consumed, and
+    the results are yielded in the order of the batches.
+
+    Args:
+        function (Callable[[List[T]], R]): The function applied to each batch. It must be picklable, such as a
+            module-level function or a partial of one, to run in a worker process.
+        items (Iterable[T]): The items.
+        batch_size (int): The number of items sent to the function at once.
+        workers (int): The number of worker processes. Defaults to 1 (in-process).
+        initializer (Optional[Callable[..., Any]]): The function called once in each worker process, or in the current
+            process without workers. Defaults to None.
+        initargs (Tuple): The arguments of the initializer. Defaults to ().
+
+    Yields:
+        R: The result of each batch.
+    """
+    items = iter(items)
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        while batch := list(islice(items, batch_size)):
+            yield function(batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        while batch := list(islice(items, batch_size)):
+            pending.append(executor.submit(function, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
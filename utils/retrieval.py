@@ -0,0 +1,220 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
+
+from utils.filters import parse_filters, to_chroma_where
+from utils.metrics import STAGE_SECONDS
+from utils.vectorstore import LocalVectorStore
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def maximal_marginal_relevance(queries: np.ndarray, candidates: np.ndarray, mask: np.ndarray,
+                               k: int = 4, lambda_mult: float = 0.5) -> np.ndarray:
+    """
+    Greedily selects k candidates per query maximizing marginal relevance, for a batch of queries at once.
+
+    The candidate-candidate similarities are computed in a single matrix product, and the maximum similarity of
+    each candidate to the selected set is updated incrementally instead of being recomputed at each step.
+
+    Args:
+        queries (np.ndarray): The query embeddings, of shape (q, d).
+        candidates (np.ndarray): The candidate embeddings of each query, padded to shape (q, n, d).
+        mask (np.ndarray): Whether each candidate is real rather than padding, of shape (q, n).
+        k (int): The number of candidates to select. Defaults to 4.
+        lambda_mult (float): The trade-off between relevance (1) and diversity (0). Defaults to 0.5.
+
+    Returns:
+        np.ndarray: The indices of the selected candidates, of shape (q, min(k, n)), padded with -1 for queries with
+            fewer candidates than k.
+    """
+    queries = _normalize(np.asarray(queries, dtype=np.float32))
+    candidates = _normalize(np.asarray(candidates, dtype=np.float32))
+    num_queries, num_candidates = mask.shape
+    k = min(k, num_candidates)
+    rows = np.arange(num_queries)
+
+    relevance = np.einsum("qnd,qd->qn", candidates, queries)
+    similarity = candidates @ candidates.transpose(0, 2, 1)
+    available = mask.copy()
+    max_similarity = np.zeros((num_queries, num_candidates), dtype=np.float32)
+    selected = np.full((num_queries, k), -1, dtype=np.int64)
+    for step in range(k):
+        # The first pick is purely by relevance, since nothing is selected yet
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity if step else relevance.copy()
+        scores[~available] = -np.inf
+        best = np.argmax(scores, axis=1)
+        valid = available[rows, best]
+        selected[valid, step] = best[valid]
+        available[rows[valid], best[valid]] = False
+        max_similarity = np.where(
+            valid[:, None],
+            np.maximum(max_similarity, similarity[rows, best]) if step else similarity[rows, best],
+            max_similarity
+        )
+    return selected
+
+
+def with_filters(retriever: BaseRetriever, filters: Optional[Dict[str, Any]]) -> BaseRetriever:
+    """
+    Restricts a retriever to the documents passing metadata filters.
+
+    Args:
+        retriever (BaseRetriever): The retriever, either a retriever with a with_filters method or the retriever of
+            a vector store.
+        filters (Optional[Dict[str, Any]]): The metadata filters, see parse_filters.
+
+    Returns:
+        BaseRetriever: The filtered retriever.
+
+    Raises:
+        ValueError: If the retriever does not support metadata filters.
+    """
+    if not filters:
+        return retriever
+    if hasattr(retriever, "with_filters"):
+        return retriever.with_filters(filters)
+    if not isinstance(retriever, VectorStoreRetriever):
+        raise ValueError(f"{type(retriever).__name__} does not support metadata filters")
+    # The filters replace any filter given in the search arguments, in the format of the store
+    parsed = parse_filters(filters)
+    native = parsed if isinstance(retriever.vectorstore, LocalVectorStore) else to_chroma_where(parsed)
+    return retriever.copy(update={"search_kwargs": {**retriever.search_kwargs, "filter": native}})
+
+
+class MMRRetriever(BaseRetriever):
+    """
+    Retriever fetching the candidates and their embeddings from the vector store in one call, then re-ranking them
+    with vectorized maximal marginal relevance. Several queries can be retrieved together with batch_retrieve.
+    The metadata filters in search_kwargs["filter"] (see parse_filters) are applied by the store before the search.
+    """
+
+    vectorstore: VectorStore
+    embeddings: Embeddings
+    search_kwargs: Dict[str, Any] = {}
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @staticmethod
+    def supports(vectorstore: VectorStore) -> bool:
+        """
+        Checks whether a vector store returns the embeddings of its candidates, which the retriever re-ranks.
+
+        Args:
+            vectorstore (VectorStore): The vector store.
+
+        Returns:
+            bool: Whether the retriever can search the vector store.
+        """
+        return isinstance(vectorstore, LocalVectorStore) or hasattr(vectorstore, "_collection")
+
+    def with_filters(self, filters: Optional[Dict[str, Any]]) -> "MMRRetriever":
+        """
+        Returns a copy of the retriever with additional metadata filters, overriding the filters of the same name.
+
+        Args:
+            filters (Optional[Dict[str, Any]]): The metadata filters, see parse_filters.
+
+        Returns:
+            MMRRetriever: The filtered retriever.
+        """
+        if not filters:
+            return self
+        search_kwargs = {**self.search_kwargs, "filter": {**(self.search_kwargs.get("filter") or {}), **filters}}
+        return self.copy(update={"search_kwargs": search_kwargs})
+
+    def _fetch_candidates(self, vectors: List[List[float]], fetch_k: int) \
+            -> List[Tuple[List[Document], np.ndarray]]:
+        # Dates relative to now are resolved on each search
+        filters = parse_filters(self.search_kwargs.get("filter"))
+        if isinstance(self.vectorstore, LocalVectorStore):
+            return self.vectorstore.candidates_by_vectors(vectors, fetch_k, filter=filters)
+        if not self.supports(self.vectorstore):
+            raise ValueError(f"{type(self.vectorstore).__name__} does not expose the embeddings of its documents")
+        collection = self.vectorstore._collection
+        # Chroma searches all the queries in a single call
+        results = collection.query(
+            query_embeddings=vectors,
+            n_results=fetch_k,
+            where=to_chroma_where(filters),
+            include=["documents", "metadatas", "embeddings"]
+        )
+        return [
+            (
+                [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)],
+                np.asarray(embeddings, dtype=np.float32)
+            )
+            for texts, metadatas, embeddings in zip(results["documents"], results["metadatas"], results["embeddings"])
+        ]
+
+    def retrieve_by_vectors(self, vectors: List[List[float]]) -> List[List[Document]]:
+        """
+        Retrieves the documents of several query embeddings at once.
+
+        Args:
+            vectors (List[List[float]]): The query embeddings.
+
+        Returns:
+            List[List[Document]]: The documents of each query.
+        """
+        if not vectors:
+            return []
+        k = self.search_kwargs.get("k", 4)
+        fetch_k = self.search_kwargs.get("fetch_k", 20)
+        lambda_mult = self.search_kwargs.get("lambda_mult", 0.5)
+        with STAGE_SECONDS.time(stage="vector_search"):
+            candidates = self._fetch_candidates(vectors, fetch_k)
+
+        num_candidates = max((len(docs) for docs, _ in candidates), default=0)
+        if num_candidates == 0:
+            return [[] for _ in vectors]
+        dim = len(vectors[0])
+        padded = np.zeros((len(vectors), num_candidates, dim), dtype=np.float32)
+        mask = np.zeros((len(vectors), num_candidates), dtype=bool)
+        for i, (docs, embeddings) in enumerate(candidates):
+            padded[i, :len(docs)] = embeddings
+            mask[i, :len(docs)] = True
+        selected = maximal_marginal_relevance(np.asarray(vectors), padded, mask, k=k, lambda_mult=lambda_mult)
+        return [
+            [docs[index] for index in indices if index >= 0]
+            for (docs, _), indices in zip(candidates, selected)
+        ]
+
+    def batch_retrieve(self, queries: List[str]) -> List[List[Document]]:
+        """
+        Retrieves the documents of several queries, embedding them in a single request.
+
+        Args:
+            queries (List[str]): The queries.
+
+        Returns:
+            List[List[Document]]: The documents of each query.
+        """
+        with STAGE_SECONDS.time(stage="embedding"):
+            if len(queries) == 1:
+                vectors = [self.embeddings.embed_query(queries[0])]
+            else:
+                # OpenAI embeds queries and documents identically, so the queries can share one request
+                vectors = self.embeddings.embed_documents(queries)
+        return self.retrieve_by_vectors(vectors)
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: Optional[CallbackManagerForRetrieverRun] = None) -> List[Document]:
+        return self.batch_retrieve([query])[0]
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: Optional[AsyncCallbackManagerForRetrieverRun] = None) \
+            -> List[Document]:
+        # Embed without blocking the event loop, and search the store in a worker thread
+        with STAGE_SECONDS.time(stage="embedding"):
+            vector = await self.embeddings.aembed_query(query)
+        return (await asyncio.to_thread(self.retrieve_by_vectors, [vector]))[0]
@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from utils.metrics import Histogram
+
+
+class StageTimer(BaseCallbackHandler):
+    """
+    Callback handler measuring the wall-clock duration of the named stages of a chain. A stage is any runnable,
+    retriever or model given a run name with with_config(run_name=...). Stages running concurrently overlap, so the
+    critical path of a run is shorter than the sum of its stages. The whole run is timed as the root stage, whatever
+    name the caller gives it. The durations can also be recorded in a histogram labelled by stage.
+    """
+
+    # Timing is cheap and thread-safe, so it never needs to be deferred to an executor
+    run_inline = True
+
+    def __init__(self, stages: Optional[Iterable[str]] = None, root_stage: Optional[str] = "total",
+                 max_samples: int = 10000, histogram: Optional[Histogram] = None) -> None:
+        self.stages = set(stages) if stages is not None else None
+        self.root_stage = root_stage
+        self.histogram = histogram
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.starts: Dict[UUID, Tuple[str, float]] = {}
+        self.durations: Dict[str, List[float]] = {}
+
+    def _start(self, run_id: UUID, name: Optional[str]) -> None:
+        if name is None or (self.stages is not None and name not in self.stages):
+            return
+        with self.lock:
+            self.starts[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id: UUID) -> None:
+        end = time.perf_counter()
+        with self.lock:
+            stage = self.starts.pop(run_id, None)
+            if stage is None:
+                return
+            name, start = stage
+            durations = self.durations.setdefault(name, [])
+            durations.append(end - start)
+            if len(durations) > self.max_samples:
+                del durations[:len(durations) - self.max_samples]
+        if self.histogram is not None:
+            self.histogram.observe(end - start, stage=name)
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        if parent_run_id is None and self.root_stage is not None:
+            with self.lock:
+                self.starts[run_id] = (self.root_stage, time.perf_counter())
+            return
+        self._start(run_id, kwargs.get("name"))
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self.lock:
+            self.starts.pop(run_id, None)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, kwargs.get("name"))
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self.on_chain_error(error, run_id=run_id)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            **kwargs: Any) -> None:
+        self._start(run_id, kwargs.get("name"))
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id, kwargs.get("name"))
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self.on_chain_error(error, run_id=run_id)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.durations.clear()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summarizes the durations of each stage measured so far.
+
+        Returns:
+            Dict[str, Dict[str, float]]: The number of runs, and the mean and maximum durations (in milliseconds) of
+                each stage.
+        """
+        with self.lock:
+            return {
+                name: {
+                    "count": len(durations),
+                    "mean_ms": 1000 * sum(durations) / len(durations),
+                    "max_ms": 1000 * max(durations)
+                }
+                for name, durations in self.durations.items() if durations
+            }
@@ -0,0 +1,429 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from utils.filters import LABEL_KEYS, TIMESTAMP_KEY, parse_filters
+
+VECTORS_FILE = "local_vectors.bin"
+STORE_FILE = "local_store.sql"
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store keeping normalized embeddings in a contiguous memory-mapped matrix, optionally quantized
+    to int8, with the ids, texts and metadata in a SQLite side table. Search is an exact cosine top-k computed with
+    NumPy over the whole matrix, in blocks to bound memory.
+
+    Rows are append-only: deleting or updating a document marks its row as deleted, and compact() rewrites the
+    matrix without the deleted rows.
+
+    The timestamp and the filterable labels of the documents are also kept in memory, so that searches can be
+    restricted to the rows passing metadata filters before any similarity is computed.
+    """
+
+    block_size = 65536
+
+    def __init__(self, persist_directory: str, embedding_function: Embeddings, quantize: bool = False) -> None:
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.lock = threading.RLock()
+        os.makedirs(persist_directory, exist_ok=True)
+        self.vectors_path = os.path.join(persist_directory, VECTORS_FILE)
+        self.conn = sqlite3.connect(os.path.join(persist_directory, STORE_FILE), timeout=30, check_same_thread=False)
+        # Searches in serving processes are not blocked by an indexer writing to the store in WAL mode
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "position INTEGER PRIMARY KEY, id TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL, "
+                "deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS documents_id ON documents (id)")
+            # The quantization of an existing store always wins over the argument
+            self.conn.execute("INSERT OR IGNORE INTO settings VALUES ('quantize', ?)", (json.dumps(quantize),))
+        self.quantize = json.loads(self._get_setting("quantize"))
+        self.dtype = np.int8 if self.quantize else np.float32
+        dim = self._get_setting("dim")
+        self.dim = int(dim) if dim is not None else None
+        self._load()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function
+
+    def _get_setting(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _load(self) -> None:
+        extracts = "".join(f", json_extract(metadata, '$.{key}')" for key in (TIMESTAMP_KEY, *LABEL_KEYS))
+        rows = self.conn.execute(f"SELECT position, id, deleted{extracts} FROM documents ORDER BY position").fetchall()
+        self.ids: List[str] = [row[1] for row in rows]
+        self.alive = np.array([not row[2] for row in rows], dtype=bool)
+        self.positions = {row[1]: row[0] for row in rows if not row[2]}
+        self.timestamps = np.zeros(0)
+        self.label_codes: Dict[str, Dict[Any, int]] = {key: {} for key in LABEL_KEYS}
+        self.labels: Dict[str, np.ndarray] = {key: np.zeros(0, dtype=np.int32) for key in LABEL_KEYS}
+        self._add_filter_values([row[3] for row in rows], [dict(zip(LABEL_KEYS, row[4:])) for row in rows])
+        self.matrix = self._map(len(rows))
+
+    def _add_filter_values(self, timestamps: List[Optional[float]], labels: List[dict]) -> None:
+        # Labels are stored as integer codes, so that filtering on them is a vectorized comparison
+        self.timestamps = np.concatenate([
+            self.timestamps,
+            np.array([t if isinstance(t, (int, float)) else np.nan for t in timestamps], dtype=np.float64)
+        ])
+        for key, codes in self.label_codes.items():
+            self.labels[key] = np.concatenate([
+                self.labels[key],
+                np.array([
+                    codes.setdefault(value if isinstance(value, (str, int, float)) else None, len(codes))
+                    for value in (values.get(key) for values in labels)
+                ], dtype=np.int32)
+            ])
+
+    def _filter_mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        filters = parse_filters(filters)
+        if not filters:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        # Comparisons with NaN are false, so documents without a date never pass a date filter
+        if "after" in filters:
+            mask &= self.timestamps >= filters["after"]
+        if "before" in filters:
+            mask &= self.timestamps < filters["before"]
+        for key in LABEL_KEYS:
+            if key in filters:
+                codes = [self.label_codes[key][value] for value in filters[key] if value in self.label_codes[key]]
+                mask &= np.isin(self.labels[key], codes)
+        return mask
+
+    def _map(self, size: int) -> np.ndarray:
+        if size == 0 or self.dim is None:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(size, self.dim))
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if self.quantize:
+            return np.round(vectors * 127).astype(np.int8)
+        return vectors
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.float32)
+        return rows / 127 if self.quantize else rows
+
+    def warm_up(self) -> None:
+        """
+        Reads the whole matrix once, so that its pages are in memory before the first search.
+        """
+        with self.lock:
+            matrix = self.matrix
+        for start in range(0, len(matrix), self.block_size):
+            np.asarray(matrix[start:start + self.block_size]).sum()
+
+    def add_vectors(self, texts: List[str], vectors: List[List[float]], metadatas: Optional[List[dict]] = None,
+                    ids: Optional[List[str]] = None) -> List[str]:
+        """
+        Adds precomputed embeddings to the store. Existing documents with the same ids are replaced. The batch is
+        added entirely or not at all.
+
+        Args:
+            texts (List[str]): The texts of the documents.
+            vectors (List[List[float]]): The embeddings of the texts.
+            metadatas (Optional[List[dict]]): The metadata of the documents. Defaults to empty metadata.
+            ids (Optional[List[str]]): The ids of the documents. Defaults to random ids.
+
+        Returns:
+            List[str]: The ids of the added documents.
+
+        Raises:
+            ValueError: If the lengths of the arguments differ, the metadata cannot be serialized to JSON, or the
+                embeddings do not have the dimension of the store.
+        """
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [uuid.uuid4().hex for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        if not len(texts) == len(vectors) == len(metadatas) == len(ids):
+            raise ValueError("Expected as many texts, embeddings, metadata and ids")
+        # Validate the whole batch before touching the matrix, whose rows must stay aligned with the side table
+        try:
+            serialized = [json.dumps(metadata, ensure_ascii=False) for metadata in metadatas]
+        except TypeError as e:
+            raise ValueError(f"The metadata of the documents must be serializable to JSON: {e}")
+        encoded = self._encode(vectors)
+        with self.lock:
+            dim = self.dim if self.dim is not None else encoded.shape[1]
+            if encoded.shape[1] != dim:
+                raise ValueError(f"Expected embeddings of dimension {dim}, got {encoded.shape[1]}")
+            start = len(self.ids)
+            replaced = [self.positions[doc_id] for doc_id in ids if doc_id in self.positions]
+            try:
+                with open(self.vectors_path, "ab") as file:
+                    # Drop any rows left over by an interrupted add before appending
+                    file.truncate(start * dim * encoded.itemsize)
+                    file.write(encoded.tobytes())
+                with self.conn:
+                    if self.dim is None:
+                        self.conn.execute("INSERT INTO settings VALUES ('dim', ?)", (str(dim),))
+                    self.conn.executemany("UPDATE documents SET deleted = 1 WHERE position = ?",
+                                          [(position,) for position in replaced])
+                    self.conn.executemany(
+                        "INSERT INTO documents (position, id, text, metadata) VALUES (?, ?, ?, ?)",
+                        [
+                            (start + i, doc_id, text, metadata)
+                            for i, (doc_id, text, metadata) in enumerate(zip(ids, texts, serialized))
+                        ]
+                    )
+            except BaseException:
+                # The side table was rolled back, so the appended rows would shift every later row
+                with open(self.vectors_path, "ab") as file:
+                    file.truncate(start * dim * encoded.itemsize)
+                raise
+            self.dim = dim
+            for doc_id in ids:
+                self.positions.pop(doc_id, None)
+            self.alive[replaced] = False
+            self.ids.extend(ids)
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+            self._add_filter_values([metadata.get(TIMESTAMP_KEY) for metadata in metadatas], metadatas)
+            self.positions.update({doc_id: start + i for i, doc_id in enumerate(ids)})
+            self.matrix = self._map(len(self.ids))
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_vectors(texts, self.embedding_function.embed_documents(texts), metadatas, ids)
+
+    def _delete(self, ids: List[str]) -> None:
+        positions = [self.positions.pop(doc_id) for doc_id in ids if doc_id in self.positions]
+        if not positions:
+            return
+        with self.conn:
+            self.conn.executemany("UPDATE documents SET deleted = 1 WHERE position = ?", [(p,) for p in positions])
+        self.alive[positions] = False
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        with self.lock:
+            self._delete(list(ids or []))
+        return True
+
+    def compact(self) -> None:
+        """
+        Rewrites the matrix and the side table without the deleted rows.
+        """
+        with self.lock:
+            alive = np.flatnonzero(self.alive)
+            with open(f"{self.vectors_path}.tmp", "wb") as file:
+                for start in range(0, len(alive), self.block_size):
+                    file.write(np.ascontiguousarray(self.matrix[alive[start:start + self.block_size]]).tobytes())
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS compacted")
+                self.conn.execute("CREATE TABLE compacted AS SELECT * FROM documents WHERE 0")
+                self.conn.execute(
+                    "INSERT INTO compacted SELECT ROW_NUMBER() OVER (ORDER BY position) - 1, id, text, metadata, 0 "
+                    "FROM documents WHERE deleted = 0"
+                )
+                self.conn.execute("DELETE FROM documents")
+                self.conn.execute("INSERT INTO documents SELECT * FROM compacted")
+                self.conn.execute("DROP TABLE compacted")
+            os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+            self._load()
+
+    def _top_k(self, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None) \
+            -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the positions and cosine similarities of the k best rows for each normalized query."""
+        alive = self.alive if mask is None else self.alive & mask
+        best_positions = [np.zeros(0, dtype=np.int64) for _ in queries]
+        best_scores = [np.zeros(0, dtype=np.float32) for _ in queries]
+        for start in range(0, len(self.ids), self.block_size):
+            block_alive = alive[start:start + self.block_size]
+            rows = np.flatnonzero(block_alive)
+            if not len(rows):
+                continue
+            if len(rows) < len(block_alive) // 2:
+                # Only score the rows passing the filters, when they are a small slice of the block
+                scores = self._decode(self.matrix[start + rows]) @ queries.T
+                block_positions = start + rows
+            else:
+                scores = self._decode(self.matrix[start:start + self.block_size]) @ queries.T
+                scores[~block_alive] = -np.inf
+                block_positions = np.arange(start, start + len(scores))
+            for i in range(len(queries)):
+                candidates = np.concatenate([best_scores[i], scores[:, i]])
+                positions = np.concatenate([best_positions[i], block_positions])
+                top = np.argpartition(-candidates, min(k, len(candidates)) - 1)[:k]
+                best_scores[i], best_positions[i] = candidates[top], positions[top]
+        results = []
+        for positions, scores in zip(best_positions, best_scores):
+            order = np.argsort(-scores)
+            keep = np.isfinite(scores[order])
+            results.append((positions[order][keep], scores[order][keep]))
+        return results
+
+    def _documents(self, positions: Iterable[int]) -> List[Optional[Document]]:
+        positions = [int(p) for p in positions]
+        if not positions:
+            return []
+        rows = self.conn.execute(
+            f"SELECT position, id, text, metadata FROM documents WHERE position IN ({', '.join('?' * len(positions))})",
+            positions
+        ).fetchall()
+        # Another process may have compacted the store since the matrix was mapped, moving documents to other
+        # positions, so rows that no longer hold the mapped document are returned as None until the store is reloaded
+        by_position = {
+            row[0]: Document(page_content=row[2], metadata=json.loads(row[3]))
+            for row in rows if row[1] == self.ids[row[0]]
+        }
+        return [by_position.get(p) for p in positions]
+
+    def _normalize_queries(self, embeddings: List[List[float]]) -> np.ndarray:
+        queries = np.asarray(embeddings, dtype=np.float32)
+        return queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    def similarity_search_by_vectors_with_score(self, embeddings: List[List[float]], k: int = 4,
+                                                filter: Optional[Dict[str, Any]] = None) \
+            -> List[List[Tuple[Document, float]]]:
+        """
+        Searches several queries at once, sharing a single pass over the matrix.
+
+        Args:
+            embeddings (List[List[float]]): The query embeddings.
+            k (int): The number of documents to return per query. Defaults to 4.
+            filter (Optional[Dict[str, Any]]): The metadata filters of the documents, see parse_filters. Defaults to
+                no filters.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: The documents and cosine similarities of each query.
+        """
+        if not embeddings:
+            return []
+        with self.lock:
+            if self.dim is None:
+                return [[] for _ in embeddings]
+            results = self._top_k(self._normalize_queries(embeddings), k, self._filter_mask(filter))
+            return [
+                [(doc, score) for doc, score in zip(self._documents(positions), scores.tolist()) if doc is not None]
+                for positions, scores in results
+            ]
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[Dict[str, Any]] = None) \
+            -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embedding_function.embed_query(query), k=k, filter=kwargs.get("filter")
+        )
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Map cosine similarities from [-1, 1] to relevance scores in [0, 1]
+        return lambda score: (score + 1) / 2
+
+    def candidates_by_vectors(self, embeddings: List[List[float]], fetch_k: int,
+                              filter: Optional[Dict[str, Any]] = None) -> List[Tuple[List[Document], np.ndarray]]:
+        """
+        Fetches the best candidates of several queries together with their embeddings, for re-ranking.
+
+        Args:
+            embeddings (List[List[float]]): The query embeddings.
+            fetch_k (int): The number of candidates to fetch per query.
+            filter (Optional[Dict[str, Any]]): The metadata filters of the candidates, see parse_filters. Defaults
+                to no filters.
+
+        Returns:
+            List[Tuple[List[Document], np.ndarray]]: The candidate documents of each query and their embeddings.
+        """
+        with self.lock:
+            if self.dim is None or not embeddings:
+                return [([], np.zeros((0, self.dim or 0), dtype=np.float32)) for _ in embeddings]
+            candidates = []
+            for positions, _ in self._top_k(self._normalize_queries(embeddings), fetch_k, self._filter_mask(filter)):
+                docs = self._documents(positions)
+                keep = [i for i, doc in enumerate(docs) if doc is not None]
+                candidates.append(([docs[i] for i in keep], self._decode(self.matrix[positions[keep]])))
+            return candidates
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        from utils.retrieval import maximal_marginal_relevance
+
+        docs, candidates = self.candidates_by_vectors([embedding], fetch_k, filter=kwargs.get("filter"))[0]
+        if not docs:
+            return []
+        selected = maximal_marginal_relevance(
+            np.asarray([embedding]), candidates[None], np.ones((1, len(docs)), dtype=bool),
+            k=k, lambda_mult=lambda_mult
+        )[0]
+        return [docs[index] for index in selected if index >= 0]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding_function.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs
+        )
+
+    @classmethod
+    def from_texts(cls: Type["LocalVectorStore"], texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None, persist_directory: str = "./db",
+                   ids: Optional[List[str]] = None, **kwargs: Any) -> "LocalVectorStore":
+        store = cls(persist_directory=persist_directory, embedding_function=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+class QuantizedLocalVectorStore(LocalVectorStore):
+    """
+    LocalVectorStore keeping its embeddings quantized to int8, a quarter of the memory of float32.
+    """
+
+    def __init__(self, persist_directory: str, embedding_function: Embeddings) -> None:
+        super().__init__(persist_directory, embedding_function, quantize=True)
+
+
+LOCAL_VECTOR_STORES = {
+    "LocalVectorStore": LocalVectorStore,
+    "QuantizedLocalVectorStore": QuantizedLocalVectorStore
+}
+
+
+def get_vector_store_class(db_type: str) -> Type[VectorStore]:
+    """
+    Resolves a vector store class by name, among the built-in local stores and the LangChain community stores.
+
+    Args:
+        db_type (str): The name of the vector store class.
+
+    Returns:
+        Type[VectorStore]: The vector store class.
+
+    Raises:
+        ValueError: If no vector store has this name.
+    """
+    if db_type in LOCAL_VECTOR_STORES:
+        return LOCAL_VECTOR_STORES[db_type]
+    import langchain_community.vectorstores as vectorstores
+
+    try:
+        return getattr(vectorstores, db_type)
+    except (AttributeError, ImportError):
+        raise ValueError(f"Unsupported vector store {db_type}")